@@ -5,7 +5,17 @@ from . import endmemberpenaltyfunc
 from . import plotting
 from . import parse_config
 from . import util
-from .ompacore import OMPAProblem, ConvertedParamGroup
+from . import smoothness
+from . import report
+from . import cache
+from . import export
+from . import ambiguity
+from .ompacore import (OMPAProblem, ConvertedParamGroup, export_solns,
+                       export_solns_to_csv)
+from .export import ExportWriter
+from .report import SolveReport
+from .util import InfeasibleError
+from .cache import SolveCache
 from .thermocline_array import ThermoclineArrayOMPAProblem 
 from .endmemberpenaltyfunc import EndMemExpPenaltyFunc, GeneralPenaltyFunc
 from .plotting import (plot_ompasoln_endmember_fractions,
@@ -0,0 +1,387 @@
+from __future__ import division, print_function
+import time
+import numpy as np
+import scipy.optimize
+import scipy.sparse
+from .native_solver import NativeSolveResult
+from .util import apply_A
+
+
+#Number of observations whose LPs are stacked into one block-diagonal LP;
+# bounds the size of the sparse constraint matrices handed to HiGHS
+LP_CHUNK_SIZE = 250
+#Observations whose phase-1 violation (the part of their inequality
+# constraints that could not be satisfied) exceeds this are infeasible
+PHASE1_TOL = 1e-7
+LINPROG_STATUS_NAMES = {0: "optimal", 1: "iteration_limit", 2: "infeasible",
+                        3: "unbounded", 4: "numerical_error"}
+
+
+def build_block_lp(obs_A, obs_b, upper_resids, lower_resids,
+                   usagepenalty, orig_penalty, endmember_available,
+                   num_converted_variables, converted_vars_signs):
+    #Stacks the residual limit LPs of several observations into one LP with
+    # a block-diagonal constraint matrix (one block per observation). Each
+    # observation's block is
+    #  usagepenalty@x[:num_endmembers] <= orig_penalty (if usagepenalty)
+    #  x@A <= b + upper_resids
+    #  -x@A <= -(b + lower_resids)
+    #  sum(x[:num_endmembers]) == 1
+    #with x[:num_endmembers] >= 0 (== 0 if unavailable) and the converted
+    # variable signs as bounds. obs_A has dims of observations X vars X
+    # params. Returns A_ub, b_ub, A_eq, b_eq and bounds
+    num_obs, num_vars, num_params = obs_A.shape
+    num_endmembers = num_vars-num_converted_variables
+    blocks = [obs_A.transpose(0,2,1), -obs_A.transpose(0,2,1)]
+    rhs = [obs_b + upper_resids, -(obs_b + lower_resids)]
+    if (usagepenalty is not None):
+        penalty_rows = np.zeros((num_obs, 1, num_vars))
+        penalty_rows[:, 0, :num_endmembers] = usagepenalty
+        blocks = [penalty_rows]+blocks
+        rhs = [orig_penalty[:,None]]+rhs
+    blocks = np.concatenate(blocks, axis=1)
+    num_block_rows = blocks.shape[1]
+    row_idxs, col_idxs = np.broadcast_arrays(
+        np.arange(num_obs)[:,None,None]*num_block_rows
+         + np.arange(num_block_rows)[None,:,None],
+        np.arange(num_obs)[:,None,None]*num_vars
+         + np.arange(num_vars)[None,None,:])
+    nonzero = (blocks != 0)
+    A_ub = scipy.sparse.csr_array(
+        (blocks[nonzero], (row_idxs[nonzero], col_idxs[nonzero])),
+        shape=(num_obs*num_block_rows, num_obs*num_vars))
+    b_ub = np.concatenate(rhs, axis=1).ravel()
+
+    A_eq = scipy.sparse.kron(scipy.sparse.eye_array(num_obs),
+              np.concatenate([np.ones(num_endmembers),
+                  np.zeros(num_converted_variables)])[None,:], format="csr")
+    b_eq = np.ones(num_obs)
+
+    lower = np.concatenate([
+        np.zeros((num_obs, num_endmembers)),
+        np.tile(np.where(converted_vars_signs > 0, 0.0, -np.inf)[None,:],
+                (num_obs,1))], axis=1)
+    upper = np.concatenate([
+        (np.where(endmember_available, np.inf, 0.0)
+         if endmember_available is not None
+         else np.full((num_obs, num_endmembers), np.inf)),
+        np.tile(np.where(converted_vars_signs > 0, np.inf, 0.0)[None,:],
+                (num_obs,1))], axis=1)
+    bounds = np.stack([lower.ravel(), upper.ravel()], axis=1)
+    return A_ub, b_ub, A_eq, b_eq, bounds
+
+
+def find_feasible_obs(num_obs, A_ub, b_ub, A_eq, b_eq, bounds):
+    #Phase 1: minimizes the total violation t of each observation's
+    # inequality constraints. The blocks are independent, so each t is
+    # minimized separately and is (numerically) zero iff the observation's
+    # LP is feasible. Returns None if the phase-1 LP itself fails
+    num_block_rows = A_ub.shape[0]//num_obs
+    res = scipy.optimize.linprog(
+        c=np.concatenate([np.zeros(A_ub.shape[1]), np.ones(num_obs)]),
+        A_ub=scipy.sparse.hstack([A_ub,
+               scipy.sparse.kron(scipy.sparse.eye_array(num_obs),
+                                 -np.ones((num_block_rows,1)))], format="csr"),
+        b_ub=b_ub,
+        A_eq=(scipy.sparse.hstack([A_eq,
+                scipy.sparse.csr_array((num_obs, num_obs))], format="csr")
+              if A_eq is not None else None),
+        b_eq=b_eq,
+        bounds=np.concatenate([bounds, np.tile([[0, np.inf]], (num_obs,1))],
+                              axis=0),
+        method="highs")
+    if (res.status != 0):
+        return None
+    return res.x[A_ub.shape[1]:] <= PHASE1_TOL
+
+
+def solve_block_lps(build_block, lp_obj_weights, num_obs, num_signcombos,
+                    chunk_size, report):
+    #Minimizes each row of lp_obj_weights for every observation and sign
+    # combo, stacking chunk_size observations into one block-diagonal LP.
+    # build_block(combo_idx, obs_idxs) returns the A_ub, b_ub, A_eq, b_eq
+    # and bounds of the stacked LP of obs_idxs. If a stacked LP is
+    # infeasible, a phase-1 LP finds the observations that are feasible and
+    # only those are re-solved (feasibility doesn't depend on the
+    # objective, so this carries over to the remaining objectives); other
+    # failures (including a failed phase-1 LP) are bisected down to single
+    # observations.
+    #Returns the LP solutions (objectives X sign combos X observations X
+    # LP variables; NaN where not solved) and objective values (inf where
+    # not solved)
+    num_lp_vars = lp_obj_weights.shape[1]
+    objs = np.full((len(lp_obj_weights), num_signcombos, num_obs), np.inf)
+    xs = np.full((len(lp_obj_weights), num_signcombos, num_obs, num_lp_vars),
+                 np.nan)
+
+    def solve_obs(combo_idx, obs_idxs, obj_idxs, feasibility_checked=False):
+        A_ub, b_ub, A_eq, b_eq, bounds = build_block(combo_idx, obs_idxs)
+        failed_obj_idxs = []
+        for i, obj_idx in enumerate(obj_idxs):
+            solve_start = time.time()
+            res = scipy.optimize.linprog(
+                      c=np.tile(lp_obj_weights[obj_idx], len(obs_idxs)),
+                      A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=b_eq,
+                      bounds=bounds, method="highs")
+            if (report is not None):
+                report.record_solver_call(
+                    prob=NativeSolveResult(
+                        status=LINPROG_STATUS_NAMES.get(res.status, "error"),
+                        value=res.fun, num_iters=res.nit),
+                    engine="highs", num_obs=len(obs_idxs),
+                    wall_time=time.time()-solve_start)
+            if (res.status == 0):
+                x = res.x.reshape((len(obs_idxs), num_lp_vars))
+                xs[obj_idx, combo_idx, obs_idxs] = x
+                objs[obj_idx, combo_idx, obs_idxs] =\
+                    x@lp_obj_weights[obj_idx]
+            elif (len(obs_idxs) == 1):
+                continue
+            elif (res.status == 2 and feasibility_checked==False):
+                feasible = find_feasible_obs(num_obs=len(obs_idxs),
+                               A_ub=A_ub, b_ub=b_ub, A_eq=A_eq, b_eq=b_eq,
+                               bounds=bounds)
+                if (feasible is None):
+                    failed_obj_idxs.extend(obj_idxs[i:])
+                    break
+                if (np.any(feasible)):
+                    solve_obs(combo_idx, obs_idxs[feasible], obj_idxs[i:],
+                              feasibility_checked=True)
+                break
+            else:
+                failed_obj_idxs.append(obj_idx)
+        if (len(failed_obj_idxs) > 0):
+            half = len(obs_idxs)//2
+            solve_obs(combo_idx, obs_idxs[:half], failed_obj_idxs,
+                      feasibility_checked)
+            solve_obs(combo_idx, obs_idxs[half:], failed_obj_idxs,
+                      feasibility_checked)
+
+    for chunk_start in range(0, num_obs, chunk_size):
+        obs_idxs = np.arange(chunk_start, min(chunk_start+chunk_size, num_obs))
+        for combo_idx in range(num_signcombos):
+            solve_obs(combo_idx, obs_idxs, list(range(len(lp_obj_weights))))
+    return xs, objs
+
+
+def select_best_signcombos(xs, objs, obj_weights):
+    #Picks each observation's best sign combo for every objective (as with
+    # np.argmin over a list, ties go to the first sign combo). Returns
+    # (x, best_signcombo_idxs, found), without the leading objectives axis
+    # if obj_weights is a single vector
+    num_objs, num_signcombos, num_obs = objs.shape
+    best_signcombo_idxs = np.argmin(objs, axis=1)
+    obj_idxs, obs_idxs = np.meshgrid(np.arange(num_objs), np.arange(num_obs),
+                                     indexing="ij")
+    found = np.isfinite(objs[obj_idxs, best_signcombo_idxs, obs_idxs])
+    x = xs[obj_idxs, best_signcombo_idxs, obs_idxs]
+    if (np.ndim(obj_weights) == 1):
+        return x[0], best_signcombo_idxs[0], found[0]
+    return x, best_signcombo_idxs, found
+
+
+def batched_residual_limit_lp(obj_weights, omp_A, obs_b, upper_resids,
+                              lower_resids, num_converted_variables,
+                              signcombos_to_try, usagepenalty=None,
+                              orig_penalty=None, endmember_available=None,
+                              chunk_size=LP_CHUNK_SIZE, report=None):
+    """
+        Solves the LPs of OMPASoln.core_quantify_ambiguity_via_residual_limits
+        (minimize obj_weights@x for every observation and every converted
+        variable sign combo) with HiGHS, stacking chunk_size observations
+        into one block-diagonal LP per sign combo (see solve_block_lps).
+        omp_A is either shared (vars X params) or per-observation
+        (observations X vars X params). obj_weights can also be a matrix
+        with one objective per row, in which case the constraints of each
+        chunk are built once and reused for all of the objectives.
+        Returns (x, best_signcombo_idxs, found), where x holds each
+        observation's solution for its best sign combo (NaN if no sign
+        combo was feasible, as marked by found); with a matrix of
+        obj_weights, each of these has an extra leading objectives axis.
+    """
+    def build_block(combo_idx, obs_idxs):
+        return build_block_lp(
+            obs_A=(omp_A[obs_idxs] if omp_A.ndim==3 else
+                   np.broadcast_to(omp_A, (len(obs_idxs),)+omp_A.shape)),
+            obs_b=obs_b[obs_idxs], upper_resids=upper_resids[obs_idxs],
+            lower_resids=lower_resids[obs_idxs],
+            usagepenalty=(usagepenalty[obs_idxs]
+                          if usagepenalty is not None else None),
+            orig_penalty=(orig_penalty[obs_idxs]
+                          if usagepenalty is not None else None),
+            endmember_available=(endmember_available[obs_idxs]
+                          if endmember_available is not None else None),
+            num_converted_variables=num_converted_variables,
+            converted_vars_signs=signcombos_to_try[combo_idx])
+
+    xs, objs = solve_block_lps(build_block=build_block,
+        lp_obj_weights=np.atleast_2d(obj_weights), num_obs=len(obs_b),
+        num_signcombos=len(signcombos_to_try), chunk_size=chunk_size,
+        report=report)
+    return select_best_signcombos(xs=xs, objs=objs, obj_weights=obj_weights)
+
+
+def build_nullspace_block_lp(nullspace, orig_x, num_converted_variables,
+                             converted_vars_signs, usagepenalty):
+    #Block-diagonal LP over nullspace coordinates v, where each
+    # observation's solution is x = orig_x + nullspace@v (so its
+    # predictions, and hence its residuals, are those of orig_x and its
+    # endmember fractions still sum to 1). Each observation's block is
+    #  -nullspace[:num_endmembers]@v <= orig_x[:num_endmembers]
+    #  -signs*(nullspace[num_endmembers:]@v) <= signs*orig_x[num_endmembers:]
+    #  usagepenalty@(nullspace[:num_endmembers]@v) <= 0 (if usagepenalty)
+    num_obs, num_vars = orig_x.shape
+    num_endmembers = num_vars-num_converted_variables
+    nullspace_dim = nullspace.shape[1]
+    signs = np.concatenate([np.ones(num_endmembers),
+                            converted_vars_signs]).astype(float)
+    blocks = [np.broadcast_to(-signs[:,None]*nullspace,
+                              (num_obs, num_vars, nullspace_dim))]
+    rhs = [signs[None,:]*orig_x]
+    if (usagepenalty is not None):
+        blocks.append((usagepenalty@nullspace[:num_endmembers])[:,None,:])
+        rhs.append(np.zeros((num_obs, 1)))
+    blocks = np.concatenate(blocks, axis=1)
+    num_block_rows = blocks.shape[1]
+    row_idxs, col_idxs = np.broadcast_arrays(
+        np.arange(num_obs)[:,None,None]*num_block_rows
+         + np.arange(num_block_rows)[None,:,None],
+        np.arange(num_obs)[:,None,None]*nullspace_dim
+         + np.arange(nullspace_dim)[None,None,:])
+    nonzero = (blocks != 0)
+    A_ub = scipy.sparse.csr_array(
+        (blocks[nonzero], (row_idxs[nonzero], col_idxs[nonzero])),
+        shape=(num_obs*num_block_rows, num_obs*nullspace_dim))
+    bounds = np.tile([[-np.inf, np.inf]], (num_obs*nullspace_dim, 1))
+    return (A_ub, np.concatenate(rhs, axis=1).ravel(), None, None, bounds)
+
+
+def batched_nullspace_lp(obj_weights, nullspace, orig_x,
+                         num_converted_variables, signcombos_to_try,
+                         usagepenalty=None, chunk_size=LP_CHUNK_SIZE,
+                         report=None):
+    """
+        Minimizes obj_weights@x over the solutions x = orig_x + nullspace@v
+        that keep the endmember fractions nonnegative, the converted
+        variables within the sign combo and (if usagepenalty) the usage
+        penalty no larger than that of orig_x, for every observation and
+        sign combo. nullspace (vars X nullspace dims, see
+        OMPAProblem.get_nullspace) is shared by all observations, so each
+        LP only has nullspace dims variables. Returns the same as
+        batched_residual_limit_lp.
+    """
+    def build_block(combo_idx, obs_idxs):
+        return build_nullspace_block_lp(nullspace=nullspace,
+            orig_x=orig_x[obs_idxs],
+            num_converted_variables=num_converted_variables,
+            converted_vars_signs=signcombos_to_try[combo_idx],
+            usagepenalty=(usagepenalty[obs_idxs]
+                          if usagepenalty is not None else None))
+
+    all_obj_weights = np.atleast_2d(obj_weights)
+    vs, lp_objs = solve_block_lps(build_block=build_block,
+        lp_obj_weights=all_obj_weights@nullspace, num_obs=len(orig_x),
+        num_signcombos=len(signcombos_to_try), chunk_size=chunk_size,
+        report=report)
+    xs = orig_x[None,None,:,:] + vs@nullspace.T
+    #(lp_objs differ from the objectives by all_obj_weights@orig_x)
+    objs = lp_objs + (all_obj_weights@orig_x.T)[:,None,:]
+    return select_best_signcombos(xs=xs, objs=objs, obj_weights=obj_weights)
+
+
+def get_chord(gd, slack):
+    #The interval [lo, hi] of steps t for which g@(x + t*d) <= h holds for
+    # all constraints, given gd = g@d and slack = h - g@x (last axis:
+    # constraints). Constraints parallel to d that x violates make the
+    # interval empty (lo > hi)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = slack/gd
+    hi = np.min(np.where(gd > 0, ratio, np.inf), axis=-1, initial=np.inf)
+    lo = np.max(np.where(gd < 0, ratio, -np.inf), axis=-1, initial=-np.inf)
+    violated_parallel = np.any((gd == 0) & (slack < 0), axis=-1)
+    return np.where(violated_parallel, np.inf, lo), hi
+
+
+def hit_and_run_sample(x0, omp_A, obs_b, upper_resids, lower_resids,
+                       num_converted_variables, signcombos_to_try,
+                       usagepenalty=None, orig_penalty=None,
+                       endmember_available=None, var_scales=None,
+                       num_samples=100, burn_in=100, thin=10, rng=None):
+    """
+        Hit-and-run sampler over each observation's set of solutions that
+        satisfy the constraints of batched_residual_limit_lp (which takes
+        the same arguments), started from the feasible solutions x0
+        (observations X vars). The chains of all observations advance
+        together with vectorized steps, and no LPs are solved: every step
+        draws a direction in the plane of the sum-to-one constraint
+        (scaled by var_scales, observations X vars), finds where the line
+        through the current point meets the feasible set of each converted
+        variable sign combo, and moves to a uniformly drawn point of the
+        union of these chords. The samples are thus (asymptotically)
+        uniform over the union of the sign combos' polytopes.
+        Returns samples with dims of observations X num_samples X vars,
+        taken every thin steps after burn_in steps.
+    """
+    rng = (np.random.RandomState() if rng is None else rng)
+    num_obs, num_vars = x0.shape
+    num_endmembers = num_vars-num_converted_variables
+    signcombos_to_try = np.asarray(signcombos_to_try, dtype=float)
+    var_scales = (np.ones((num_obs, num_vars)) if var_scales is None
+                  else var_scales)
+    available = (np.ones((num_obs, num_endmembers), dtype=bool)
+                 if endmember_available is None else endmember_available)
+    num_available = np.sum(available, axis=1, keepdims=True)
+
+    x = np.array(x0, dtype=float)
+    samples = np.zeros((num_obs, num_samples, num_vars))
+    for step in range(burn_in + num_samples*thin):
+        d = rng.normal(size=(num_obs, num_vars))*var_scales
+        #keep the endmember fractions summing to 1 (and unavailable
+        # endmembers at 0)
+        d_endmem = np.where(available, d[:, :num_endmembers], 0.0)
+        d_endmem = np.where(available, d_endmem - np.sum(d_endmem, axis=1,
+                                        keepdims=True)/num_available, 0.0)
+        d[:, :num_endmembers] = d_endmem
+
+        #constraints shared by all sign combos: residual caps, usage
+        # penalty cap and nonnegative endmember fractions (slack is clipped
+        # at 0 in case of small violations in x0)
+        pred = apply_A(x, omp_A)
+        d_pred = apply_A(d, omp_A)
+        gd = [d_pred, -d_pred, -d[:, :num_endmembers]]
+        slack = [obs_b + upper_resids - pred, pred - (obs_b + lower_resids),
+                 x[:, :num_endmembers]]
+        if (usagepenalty is not None):
+            gd.append(np.sum(usagepenalty*d[:, :num_endmembers],
+                             axis=1, keepdims=True))
+            slack.append(orig_penalty[:,None]
+                         - np.sum(usagepenalty*x[:, :num_endmembers],
+                                  axis=1, keepdims=True))
+        lo, hi = get_chord(gd=np.concatenate(gd, axis=1),
+                           slack=np.maximum(np.concatenate(slack, axis=1), 0))
+
+        #(sign combos X observations) chords of each sign combo's polytope
+        signs = signcombos_to_try[:,None,:]
+        combo_lo, combo_hi = get_chord(
+            gd=-signs*d[None, :, num_endmembers:],
+            slack=signs*x[None, :, num_endmembers:])
+        combo_lo = np.maximum(combo_lo, lo[None,:])
+        combo_hi = np.minimum(combo_hi, hi[None,:])
+        #(empty or, should nothing bound the line, unbounded chords leave
+        # the observation where it is)
+        with np.errstate(invalid="ignore"):
+            lengths = combo_hi - combo_lo
+        lengths = np.where(np.isfinite(lengths) & (lengths > 0), lengths, 0.0)
+        cum_lengths = np.cumsum(lengths, axis=0)
+        u = rng.uniform(size=num_obs)*cum_lengths[-1]
+        combo_idxs = np.minimum(np.sum(cum_lengths <= u[None,:], axis=0),
+                                len(signcombos_to_try)-1)
+        obs_idxs = np.arange(num_obs)
+        t = (combo_lo[combo_idxs, obs_idxs]
+             + u - (cum_lengths - lengths)[combo_idxs, obs_idxs])
+        t = np.where(cum_lengths[-1] > 0, t, 0.0)
+        x = x + t[:,None]*d
+
+        if (step >= burn_in and (step-burn_in) % thin == 0):
+            samples[:, (step-burn_in)//thin] = x
+    return samples
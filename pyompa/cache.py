@@ -0,0 +1,155 @@
+from __future__ import division, print_function
+import hashlib
+import os
+import sqlite3
+import time
+import numpy as np
+from contextlib import contextmanager
+
+
+#Bump when the layout of the stored solutions changes
+CACHE_FORMAT_VERSION = 1
+#Max number of keys per sqlite query (sqlite limits the number of variables)
+QUERY_CHUNK_SIZE = 500
+
+
+def hash_arrays(*arrs):
+    #sha1 digest of the dtypes, shapes and contents of arrays
+    h = hashlib.sha1()
+    for arr in arrs:
+        arr = np.ascontiguousarray(arr)
+        h.update(str((arr.dtype.str, arr.shape)).encode("utf-8"))
+        h.update(arr.tobytes())
+    return h.digest()
+
+
+class SolveCache(object):
+    """
+        On-disk cache of per-observation OMPA solutions, stored in a
+        sqlite database in cache_dir. Each observation's solution is keyed
+        by a hash of a problem-level key (endmember matrix, conversion
+        ratios and weights as encoded in A, constraints and solver settings)
+        together with the observation's own (weighted) parameter values and
+        usage penalties, so re-solving a deployment with new profiles only
+        solves the new rows. Once the stored solutions exceed max_size_mb,
+        the least recently used ones are evicted.
+    """
+    def __init__(self, cache_dir, max_size_mb=1024):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = int(max_size_mb*1024*1024)
+        if (os.path.exists(cache_dir)==False):
+            os.makedirs(cache_dir)
+        self.db_path = os.path.join(cache_dir, "ompa_solve_cache.sqlite")
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS solns ("
+                         +" key BLOB PRIMARY KEY, x BLOB,"
+                         +" resid_sq REAL, nbytes INTEGER,"
+                         +" last_access REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS solns_last_access"
+                         +" ON solns (last_access)")
+
+    @contextmanager
+    def connect(self):
+        #commits on success and always closes the connection
+        conn = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def get_problem_key(A, num_converted_variables, sumtooneconstraint,
+                        convertedvariable_signcombos, solver_settings):
+        #solver_settings is a dict of the settings (engine, max_iter...)
+        # that can change the returned solution
+        return hash_arrays(
+            np.array([CACHE_FORMAT_VERSION, num_converted_variables,
+                      int(sumtooneconstraint)]),
+            np.asarray(A, dtype=float),
+            np.asarray(convertedvariable_signcombos, dtype=float),
+            np.frombuffer(repr(sorted(solver_settings.items())).encode(
+                           "utf-8"), dtype=np.uint8))
+
+    @staticmethod
+    def get_row_keys(problem_key, b, endmember_usagepenalty):
+        b = np.ascontiguousarray(b, dtype=float)
+        endmember_usagepenalty = np.ascontiguousarray(
+                                    endmember_usagepenalty, dtype=float)
+        return [hashlib.sha1(problem_key+b_row.tobytes()
+                             +penalty_row.tobytes()).digest()
+                for (b_row, penalty_row) in zip(b, endmember_usagepenalty)]
+
+    def lookup(self, row_keys, num_vars):
+        #Returns (x, perobs_weighted_resid_sq, found) where found is a
+        # boolean mask of the rows that were in the cache; x and the
+        # residuals are NaN for the other rows
+        x = np.full((len(row_keys), num_vars), np.nan)
+        resid_sq = np.full(len(row_keys), np.nan)
+        found = np.zeros(len(row_keys), dtype=bool)
+        key_to_idxs = {}
+        for idx, key in enumerate(row_keys):
+            key_to_idxs.setdefault(key, []).append(idx)
+        unique_keys = list(key_to_idxs.keys())
+        now = time.time()
+        with self.connect() as conn:
+            for i in range(0, len(unique_keys), QUERY_CHUNK_SIZE):
+                chunk = unique_keys[i:i+QUERY_CHUNK_SIZE]
+                rows = conn.execute(
+                    "SELECT key, x, resid_sq FROM solns WHERE key IN ("
+                    +",".join(["?"]*len(chunk))+")", chunk).fetchall()
+                for (key, x_bytes, row_resid_sq) in rows:
+                    row_x = np.frombuffer(x_bytes, dtype=np.float64)
+                    if (len(row_x) != num_vars):
+                        continue
+                    idxs = key_to_idxs[bytes(key)]
+                    x[idxs] = row_x
+                    resid_sq[idxs] = row_resid_sq
+                    found[idxs] = True
+                conn.executemany(
+                    "UPDATE solns SET last_access=? WHERE key=?",
+                    [(now, key) for (key, _, _) in rows])
+        return x, resid_sq, found
+
+    def store(self, row_keys, x, perobs_weighted_resid_sq):
+        now = time.time()
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        with self.connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO solns"
+                +" (key, x, resid_sq, nbytes, last_access)"
+                +" VALUES (?, ?, ?, ?, ?)",
+                [(key, row_x.tobytes(), float(row_resid_sq),
+                  len(key)+row_x.nbytes+8, now)
+                 for (key, row_x, row_resid_sq)
+                 in zip(row_keys, x, perobs_weighted_resid_sq)])
+        self.evict()
+
+    def get_size_bytes(self):
+        with self.connect() as conn:
+            return conn.execute(
+                "SELECT COALESCE(SUM(nbytes), 0) FROM solns").fetchone()[0]
+
+    def evict(self):
+        #Drop least recently used solutions until under the size cap
+        excess = self.get_size_bytes() - self.max_size_bytes
+        if (excess <= 0):
+            return 0
+        num_evicted = 0
+        with self.connect() as conn:
+            cursor = conn.execute(
+                "SELECT key, nbytes FROM solns ORDER BY last_access ASC")
+            to_evict = []
+            for (key, nbytes) in cursor:
+                if (excess <= 0):
+                    break
+                to_evict.append((key,))
+                excess -= nbytes
+            cursor.close()
+            conn.executemany("DELETE FROM solns WHERE key=?", to_evict)
+            num_evicted = len(to_evict)
+        return num_evicted
+
+    def clear(self):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM solns")
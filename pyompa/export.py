@@ -0,0 +1,191 @@
+from __future__ import division, print_function
+import os
+import numpy as np
+import pandas as pd
+from .report import log_info
+
+
+EXTENSION_TO_FORMAT = {".csv": "csv", ".parquet": "parquet", ".pq": "parquet",
+                       ".feather": "feather", ".arrow": "feather",
+                       ".nc": "netcdf", ".nc4": "netcdf"}
+#Compression used when compression="default"; feather files written with
+# compression=None can be memory-mapped by pyarrow
+DEFAULT_COMPRESSION = {"csv": None, "parquet": "zstd", "feather": "lz4",
+                       "netcdf": 4}
+#Name of the (unlimited) observation dimension in netcdf output
+NETCDF_OBS_DIM = "obs"
+#Chunk length along the observation dimension of netcdf output when
+# chunk_size isn't given (the chunking is fixed when the file is created, so
+# it shouldn't depend on the size of the first chunk written)
+NETCDF_DEFAULT_CHUNK_SIZE = 4096
+
+
+def infer_export_format(output_name, format=None):
+    if (format is None):
+        extension = os.path.splitext(output_name)[1].lower()
+        assert extension in EXTENSION_TO_FORMAT, (
+         "Could not infer the export format from the extension of "
+         +str(output_name)+"; please specify one of "
+         +str(sorted(set(EXTENSION_TO_FORMAT.values()))))
+        format = EXTENSION_TO_FORMAT[extension]
+    assert format in DEFAULT_COMPRESSION, (
+     "Unsupported export format "+str(format)+"; supported formats are "
+     +str(sorted(DEFAULT_COMPRESSION.keys())))
+    return format
+
+
+def import_optional(module_name, format):
+    try:
+        return __import__(module_name, fromlist=["_"])
+    except ImportError:
+        raise ImportError(
+         "Exporting to "+format+" requires the "+module_name.split(".")[0]
+         +" package; install it with pip install pyompa["+format+"]")
+
+
+def get_netcdf_var_name(colname):
+    #"/" is not allowed in netcdf variable names
+    return str(colname).replace("/", "_")
+
+
+class ExportWriter(object):
+    """
+        Writes export data frames (see ExportToCsvMixin.get_export_df) to
+        a single csv, parquet, feather (Arrow IPC) or CF-style netcdf file
+        one chunk at a time, keeping the file open between chunks so that
+        only one chunk needs to be held in memory. Use as a context manager
+        so the file is finalized afterwards. If append is True, the chunks
+        are added to the end of an existing csv or netcdf file; parquet and
+        feather files cannot be reopened for appending.
+    """
+    def __init__(self, output_name, format=None, compression="default",
+                       chunk_size=None, append=False):
+        self.output_name = output_name
+        self.format = infer_export_format(output_name=output_name,
+                                          format=format)
+        self.compression = (DEFAULT_COMPRESSION[self.format]
+                            if compression=="default" else compression)
+        #chunk_size is the parquet row group size / netcdf chunk length
+        # along the observation dimension (defaults to the size of each
+        # written chunk for parquet, and NETCDF_DEFAULT_CHUNK_SIZE for
+        # netcdf)
+        self.chunk_size = chunk_size
+        self.append = append
+        assert (append==False or self.format in ["csv", "netcdf"]), (
+         "Cannot append to an existing "+self.format+" file; write all"
+         +" chunks through a single ExportWriter instead")
+        self.num_rows = 0
+        self._writer = None
+        self._columns = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, result, **export_flags):
+        #result is anything with a get_export_df method (e.g. an OMPASoln)
+        # or an already-assembled data frame; export_flags are the column
+        # selection flags of get_export_df
+        df = (result if isinstance(result, pd.DataFrame)
+              else result.get_export_df(**export_flags))
+        if (self._columns is None):
+            self._columns = list(df.columns)
+            log_info("appending to" if self.append else "writing to",
+                     self.output_name)
+        else:
+            assert list(df.columns)==self._columns, (
+             "Columns of chunk "+str(list(df.columns))+" differ from the"
+             +" columns already written "+str(self._columns))
+        getattr(self, "write_"+self.format)(df)
+        self.num_rows += len(df)
+
+    def write_csv(self, df):
+        append = (self.append or self.num_rows > 0)
+        df.to_csv(self.output_name, index=False,
+                  mode=("a" if append else "w"), header=(not append),
+                  compression=self.compression)
+
+    def write_parquet(self, df):
+        pa = import_optional("pyarrow", "parquet")
+        pq = import_optional("pyarrow.parquet", "parquet")
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if (self._writer is None):
+            self._writer = pq.ParquetWriter(
+                self.output_name, table.schema,
+                compression=(self.compression or "none"))
+        self._writer.write_table(table, row_group_size=self.chunk_size)
+
+    def write_feather(self, df):
+        pa = import_optional("pyarrow", "feather")
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if (self._writer is None):
+            #Feather v2 is the Arrow IPC file format
+            self._writer = pa.ipc.new_file(
+                self.output_name, table.schema,
+                options=pa.ipc.IpcWriteOptions(compression=self.compression))
+        self._writer.write_table(table, max_chunksize=self.chunk_size)
+
+    def write_netcdf(self, df):
+        netCDF4 = import_optional("netCDF4", "netcdf")
+        if (self._writer is None):
+            if (self.append and os.path.exists(self.output_name)):
+                self._writer = netCDF4.Dataset(self.output_name, "a")
+                self.num_rows = len(self._writer.dimensions[NETCDF_OBS_DIM])
+            else:
+                self._writer = netCDF4.Dataset(self.output_name, "w",
+                                               format="NETCDF4")
+                self.create_netcdf_vars(df)
+        start = self.num_rows
+        for colname in df.columns:
+            var = self._writer.variables[get_netcdf_var_name(colname)]
+            values = df[colname].to_numpy()
+            if (np.issubdtype(values.dtype, np.datetime64)):
+                values = ((values - np.datetime64("1970-01-01"))
+                          /np.timedelta64(1, "s"))
+            elif (values.dtype.kind == "b"):
+                values = values.astype(np.int8)
+            elif (values.dtype.kind not in "iuf"):
+                values = values.astype(str).astype(object)
+            var[start:start+len(values)] = values
+
+    def create_netcdf_vars(self, df):
+        ds = self._writer
+        ds.Conventions = "CF-1.8"
+        ds.source = "pyompa"
+        ds.createDimension(NETCDF_OBS_DIM, None)
+        chunksizes = [self.chunk_size or NETCDF_DEFAULT_CHUNK_SIZE]
+        for colname in df.columns:
+            dtype = df[colname].to_numpy().dtype
+            is_datetime = np.issubdtype(dtype, np.datetime64)
+            if (is_datetime or dtype.kind == "f"):
+                nc_dtype = "f8"
+            elif (dtype.kind == "b"):
+                nc_dtype = "i1"
+            elif (dtype.kind in "iu"):
+                nc_dtype = dtype.str[1:]
+            else:
+                nc_dtype = str
+            if (nc_dtype is str): #variable-length strings can't be compressed
+                var = ds.createVariable(get_netcdf_var_name(colname), str,
+                                        (NETCDF_OBS_DIM,))
+            else:
+                var = ds.createVariable(
+                    get_netcdf_var_name(colname), nc_dtype, (NETCDF_OBS_DIM,),
+                    zlib=(self.compression is not None),
+                    complevel=(self.compression or 0), shuffle=True,
+                    chunksizes=chunksizes,
+                    fill_value=(np.nan if nc_dtype=="f8" else None))
+            var.long_name = str(colname)
+            if (is_datetime):
+                var.units = "seconds since 1970-01-01 00:00:00"
+                var.calendar = "standard"
+            elif (str(colname).endswith(("_frac", "_frac_total",
+                                         "_frac_min", "_frac_max"))):
+                var.units = "1"
+
+    def close(self):
+        if (self._writer is not None):
+            self._writer.close()
+            self._writer = None
@@ -0,0 +1,416 @@
+from __future__ import division, print_function
+import numpy as np
+import scipy.linalg
+import itertools
+from .report import log_info
+from .util import apply_A
+
+
+#Number of observations that are pushed through the batched linear algebra
+# at once; bounds the memory used by the stacked KKT matrices
+NATIVE_CHUNK_SIZE = 20000
+
+
+class NativeSolveResult(object):
+    """
+        Lightweight stand-in for a solved cvxpy Problem; exposes the
+        'status' and 'value' attributes that downstream code inspects.
+    """
+    def __init__(self, status, value, num_iters):
+        self.status = status
+        self.value = value
+        self.num_iters = num_iters
+
+
+def prep_signflipped_qp(A, b, num_converted_variables, endmember_usagepenalty,
+                        conversion_sign_constraints):
+    #The per-observation problem is
+    # Minimize (x@A - b)^2 + (x[:num_endmembers]*p)^2
+    # Subject to x[:num_endmembers] >= 0, sum(x[:num_endmembers]) == 1,
+    #            s*x[num_endmembers:] >= 0
+    #Substituting y = d*x, where d is 1 for the endmembers and s for the
+    # converted variables, turns every inequality into y >= 0. Expanding the
+    # square, the objective becomes y@H@y - 2*c@y + const with
+    # H = D(A A^T + diag(p^2, 0))D and c = D A b
+    #A sign constraint of 0 means the converted variable is unconstrained;
+    # the returned 'bounded' mask is False for such variables
+    #A can also be a stack of per-observation matrices (dims of
+    # observations X vars X params)
+    num_endmembers = A.shape[-2]-num_converted_variables
+    if (A.ndim==3):
+        H = np.einsum('nip,njp->nij', A, A)
+        c = np.einsum('np,nip->ni', b, A)
+    else:
+        AAt = A@A.T
+        H = np.tile(AAt[None,:,:], (len(b),1,1))
+        c = b@A.T
+    diag_idxs = np.arange(num_endmembers)
+    H[:, diag_idxs, diag_idxs] += np.square(endmember_usagepenalty)
+    if (num_converted_variables > 0):
+        bounded = np.concatenate([np.ones((len(b), num_endmembers), dtype=bool),
+                                  conversion_sign_constraints != 0], axis=1)
+        d = np.concatenate([np.ones((len(b), num_endmembers)),
+                            np.where(conversion_sign_constraints==0, 1.0,
+                                     conversion_sign_constraints)], axis=1)
+        H = H*d[:,:,None]*d[:,None,:]
+        c = c*d
+    else:
+        bounded = np.ones((len(b), num_endmembers), dtype=bool)
+        d = np.ones((len(b), num_endmembers))
+    return H, c, d, bounded
+
+
+def solve_batched_nonneg_qp(H, c, sumtoone_mask, max_iter, bounded=None,
+                            fixed_zero=None, y0=None, tol=1e-9):
+    """
+        Vectorized primal active-set method for a stack of small QPs:
+            Minimize y@H@y - 2*c@y
+            Subject to y[bounded] >= 0, y[fixed_zero] == 0 and, if
+             sumtoone_mask is not None, sum(y[sumtoone_mask]) == 1
+        (bounded defaults to all variables, fixed_zero to none of them;
+         every row needs a variable in sumtoone_mask that isn't fixed_zero).
+        y0 is an optional feasible starting point (e.g. the solution of a
+        nearby problem); its zero variables form the initial working set.
+        H has dims of observations X vars X vars, c of observations X vars.
+        Every observation keeps its own working set (the variables held
+        at zero); iterations only touch the observations that have not
+        yet converged.
+        Returns the solution y, a boolean 'converged' array and the
+        number of iterations used.
+    """
+    num_obs, num_vars = c.shape
+    if (bounded is None):
+        bounded = np.ones((num_obs, num_vars), dtype=bool)
+    has_eq = sumtoone_mask is not None
+    #Jacobi scaling (y = z*scale) gives H a unit diagonal; the endmember
+    # fractions and converted variables otherwise differ in curvature by
+    # many orders of magnitude, which would make the tolerances meaningless
+    H_diag = np.diagonal(H, axis1=1, axis2=2)
+    scale = 1.0/np.sqrt(np.maximum(H_diag,
+                        1e-12*np.max(H_diag, axis=1)[:,None] + 1e-300))
+    H = H*scale[:,:,None]*scale[:,None,:]
+    c = c*scale
+    eq = ((sumtoone_mask.astype(float)[None,:] if has_eq
+           else np.zeros((1,num_vars)))*scale)
+    #a tiny ridge keeps the reduced KKT systems nonsingular when A is
+    # rank-deficient (e.g. more endmembers than parameters)
+    ridge = 1e-10
+    eye = np.eye(num_vars)
+
+    if (fixed_zero is None):
+        fixed_zero = np.zeros((num_obs, num_vars), dtype=bool)
+
+    #feasible start: uniform fractions, converted variables at 0, with
+    # every variable except the fixed_zero ones in the free set
+    if (y0 is not None):
+        fixed = fixed_zero | (bounded & (y0 <= 0))
+        y = np.where(fixed, 0.0, y0)/scale
+    elif (has_eq):
+        start_mask = sumtoone_mask[None,:] & (fixed_zero==False)
+        y = (start_mask/np.sum(start_mask, axis=1)[:,None])/scale
+        fixed = fixed_zero.copy()
+    else:
+        y = np.zeros((num_obs, num_vars))
+        fixed = fixed_zero.copy()
+    converged = np.zeros(num_obs, dtype=bool)
+
+    num_iters = 0
+    while (num_iters < max_iter and not np.all(converged)):
+        num_iters += 1
+        rows = np.nonzero(~converged)[0]
+        H_r = H[rows]
+        c_r = c[rows]
+        eq_r = eq[rows]
+        y_r = y[rows]
+        free_r = ~fixed[rows]
+        free_f = free_r.astype(float)
+
+        #equality-constrained subproblem on the free variables; fixed
+        # variables get an identity row so that they stay at zero
+        kkt = np.zeros((len(rows), num_vars+1, num_vars+1))
+        kkt[:, :num_vars, :num_vars] = (
+            H_r*free_f[:,:,None]*free_f[:,None,:]
+            + eye[None,:,:]*((1.0-free_f) + ridge*free_f)[:,:,None])
+        kkt[:, :num_vars, num_vars] = eq_r*free_f
+        kkt[:, num_vars, :num_vars] = eq_r*free_f
+        rhs = np.zeros((len(rows), num_vars+1))
+        rhs[:, :num_vars] = c_r*free_f
+        if (has_eq):
+            rhs[:, num_vars] = 1.0
+        else:
+            kkt[:, num_vars, num_vars] = 1.0
+        kkt_soln = np.linalg.solve(kkt, rhs[:,:,None])[:,:,0]
+        y_star = kkt_soln[:, :num_vars]*free_f
+        nu = kkt_soln[:, num_vars]
+
+        step = y_star - y_r
+        moving = np.max(np.abs(step), axis=1) > tol*np.maximum(
+                                        np.max(np.abs(y_r), axis=1), 1.0)
+
+        #rows at the subproblem minimizer: check the multipliers of the
+        # variables held at zero and release the most negative one
+        if (np.any(~moving)):
+            st = np.nonzero(~moving)[0]
+            grad = (np.einsum('rij,rj->ri', H_r[st], y_star[st])
+                    - c_r[st] + nu[st][:,None]*eq_r[st])
+            mu = np.where(fixed[rows[st]] & (fixed_zero[rows[st]]==False),
+                          grad, np.inf)
+            worst = np.argmin(mu, axis=1)
+            worst_mu = mu[np.arange(len(st)), worst]
+            done = worst_mu >= -tol*np.maximum(
+                                  np.max(np.abs(c_r[st]), axis=1), 1.0)
+            y[rows[st]] = np.where(bounded[rows[st]],
+                                   np.maximum(y_star[st], 0.0), y_star[st])
+            converged[rows[st[done]]] = True
+            release = st[~done]
+            fixed[rows[release], worst[~done]] = False
+
+        #rows that moved: step towards the subproblem minimizer until the
+        # first free variable hits its bound
+        if (np.any(moving)):
+            mv = np.nonzero(moving)[0]
+            step_mv = step[mv]
+            y_mv = y_r[mv]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratios = np.where(free_r[mv] & bounded[rows[mv]] & (step_mv < 0),
+                                  y_mv/(-step_mv), np.inf)
+            blocking = np.argmin(ratios, axis=1)
+            alpha = np.minimum(ratios[np.arange(len(mv)), blocking], 1.0)
+            new_y = y_mv + alpha[:,None]*step_mv
+            blocked = alpha < 1.0
+            new_y[np.nonzero(blocked)[0], blocking[blocked]] = 0.0
+            y[rows[mv]] = np.where(bounded[rows[mv]],
+                                   np.maximum(new_y, 0.0), new_y)
+            fixed[rows[mv[blocked]], blocking[blocked]] = True
+
+    return y*scale, converged, num_iters
+
+
+def native_core_solve(A, b, num_converted_variables, endmember_usagepenalty,
+                      conversion_sign_constraints, sumtooneconstraint,
+                      max_iter, chunk_size=NATIVE_CHUNK_SIZE,
+                      fixed_zero=None, x0=None):
+    """
+        NumPy replacement for the cvxpy problem in OMPAProblem.core_solve
+        when there is no smoothness penalty, in which case every
+        observation is an independent QP. A can also have one matrix per
+        observation (dims of observations X vars X params), and fixed_zero
+        (observations X vars) marks variables held at 0, e.g. endmembers
+        that aren't available to an observation. x0 is an optional warm
+        start that satisfies the constraints. Returns the raw x
+        (observations X (end_members+num_converted_variables)) and a
+        NativeSolveResult.
+    """
+    num_vars = A.shape[-2]
+    num_endmembers = num_vars-num_converted_variables
+    sumtoone_mask = (np.arange(num_vars) < num_endmembers
+                     if sumtooneconstraint else None)
+    x = np.zeros((len(b), num_vars))
+    all_converged = True
+    total_iters = 0
+    for i in range(0, len(b), chunk_size):
+        H, c, d, bounded = prep_signflipped_qp(
+            A=(A[i:i+chunk_size] if A.ndim==3 else A), b=b[i:i+chunk_size],
+            num_converted_variables=num_converted_variables,
+            endmember_usagepenalty=endmember_usagepenalty[i:i+chunk_size],
+            conversion_sign_constraints=(
+             conversion_sign_constraints[i:i+chunk_size]
+             if num_converted_variables > 0 else None))
+        y, converged, num_iters = solve_batched_nonneg_qp(
+            H=H, c=c, sumtoone_mask=sumtoone_mask, max_iter=max_iter,
+            bounded=bounded,
+            fixed_zero=(fixed_zero[i:i+chunk_size]
+                        if fixed_zero is not None else None),
+            y0=(x0[i:i+chunk_size]*d if x0 is not None else None))
+        #undo the sign flip
+        x[i:i+chunk_size] = y*d
+        all_converged = all_converged and np.all(converged)
+        total_iters = max(total_iters, num_iters)
+
+    value = (np.sum(np.square(apply_A(x, A) - b))
+             + np.sum(np.square(x[:,:num_endmembers]*endmember_usagepenalty)))
+    return x, NativeSolveResult(
+                status=("optimal" if all_converged else "optimal_inaccurate"),
+                value=value, num_iters=total_iters)
+
+
+def closed_form_screen(A, b, num_converted_variables, endmember_usagepenalty,
+                       conversion_sign_constraints, sumtooneconstraint):
+    """
+        Solves the core problem with only the sum-to-one constraint (i.e.
+        dropping non-negativity and the converted variable signs) for every
+        observation at once. The KKT matrix of the weighted A is factored
+        once and shared by all rows, which is only valid for the rows
+        without a usage penalty.
+        Returns x (observations X (end_members+num_converted_variables))
+        and a boolean array marking the rows where x is unpenalized and
+        already satisfies every constraint, i.e. is the exact optimum.
+    """
+    num_endmembers = len(A)-num_converted_variables
+    num_vars = len(A)
+    AAt = A@A.T
+    #Jacobi scaling, as in solve_batched_nonneg_qp
+    scale = 1.0/np.sqrt(np.maximum(np.diag(AAt),
+                                   1e-12*np.max(np.diag(AAt)) + 1e-300))
+    kkt = np.zeros((num_vars+1, num_vars+1))
+    kkt[:num_vars, :num_vars] = AAt*scale[:,None]*scale[None,:]
+    rhs = np.zeros((len(b), num_vars+1))
+    rhs[:, :num_vars] = (b@A.T)*scale[None,:]
+    if (sumtooneconstraint):
+        eq_row = (np.arange(num_vars) < num_endmembers)*scale
+        kkt[:num_vars, num_vars] = eq_row
+        kkt[num_vars, :num_vars] = eq_row
+        rhs[:, num_vars] = 1.0
+    else:
+        kkt[num_vars, num_vars] = 1.0
+    if (np.linalg.cond(kkt) < 1e12):
+        kkt_soln = scipy.linalg.lu_solve(scipy.linalg.lu_factor(kkt), rhs.T).T
+    else:
+        #rank-deficient A (more endmembers than parameters): any
+        # minimizer will do, so take the minimum-norm one
+        kkt_soln = rhs@np.linalg.pinv(kkt).T
+    x = kkt_soln[:, :num_vars]*scale[None,:]
+
+    accepted = (np.all(endmember_usagepenalty==0, axis=-1)
+                & np.all(x[:, :num_endmembers] >= 0, axis=-1))
+    if (num_converted_variables > 0):
+        accepted = accepted & np.all(
+            conversion_sign_constraints*x[:, num_endmembers:] >= 0, axis=-1)
+    return x, accepted
+
+
+#Above this many variables (endmembers + converted variables), enumerating
+# every support is no longer cheaper than the active-set method
+MAX_ENUMERATION_VARS = 12
+
+
+def get_support_solution_maps(A, num_converted_variables, sumtooneconstraint):
+    #For every support S (set of variables allowed to be nonzero), the
+    # least-squares solution restricted to S with only the sum-to-one
+    # constraint is affine in b: x = b@P_S.T + h_S. Returns the supports as
+    # a boolean matrix (supports X vars) along with the stacked P and h.
+    num_endmembers = len(A)-num_converted_variables
+    num_vars = len(A)
+    supports = np.array(list(itertools.product([False, True],
+                                               repeat=num_vars)))[1:]
+    if (sumtooneconstraint):
+        supports = supports[np.any(supports[:, :num_endmembers], axis=1)]
+    AAt = A@A.T
+    P = np.zeros((len(supports), num_vars, A.shape[1]))
+    h = np.zeros((len(supports), num_vars))
+    for support_idx, support in enumerate(supports):
+        idxs = np.nonzero(support)[0]
+        kkt_size = len(idxs)+(1 if sumtooneconstraint else 0)
+        kkt = np.zeros((kkt_size, kkt_size))
+        kkt[:len(idxs), :len(idxs)] = AAt[np.ix_(idxs, idxs)]
+        if (sumtooneconstraint):
+            eq_row = 1.0*(idxs < num_endmembers)
+            kkt[:len(idxs), len(idxs)] = eq_row
+            kkt[len(idxs), :len(idxs)] = eq_row
+        #pinv also covers the rank-deficient supports; any minimizer on
+        # such a support is as good as another
+        kkt_inv = np.linalg.pinv(kkt)
+        P[support_idx, idxs] = kkt_inv[:len(idxs), :len(idxs)]@A[idxs]
+        if (sumtooneconstraint):
+            h[support_idx, idxs] = kkt_inv[:len(idxs), len(idxs)]
+    return supports, P, h
+
+
+def enumeration_core_solve(A, b, num_converted_variables,
+                           endmember_usagepenalty, conversion_sign_constraints,
+                           sumtooneconstraint, max_iter,
+                           max_chunk_elements=int(2e7)):
+    """
+        Exact solver for small endmember sets: the least-squares solution on
+        every support is precomputed from the shared A, all rows are
+        evaluated against all supports at once, and each row keeps its
+        best feasible candidate. Since the optimum is the restricted
+        least-squares solution on its own support, this gives the exact
+        KKT solution with no iterations.
+        Rows with usage penalties (which change the quadratic per row), or
+        with no feasible candidate due to round-off, are handed to
+        native_core_solve, as is everything if there are more than
+        MAX_ENUMERATION_VARS variables. Same return values as
+        native_core_solve.
+    """
+    num_endmembers = len(A)-num_converted_variables
+    num_vars = len(A)
+    if (num_vars > MAX_ENUMERATION_VARS):
+        log_info("Too many variables ("+str(num_vars)+") to enumerate"
+                 +" supports; falling back to the native engine")
+        return native_core_solve(A=A, b=b,
+            num_converted_variables=num_converted_variables,
+            endmember_usagepenalty=endmember_usagepenalty,
+            conversion_sign_constraints=conversion_sign_constraints,
+            sumtooneconstraint=sumtooneconstraint, max_iter=max_iter)
+
+    supports, P, h = get_support_solution_maps(A=A,
+        num_converted_variables=num_converted_variables,
+        sumtooneconstraint=sumtooneconstraint)
+    #per-row signs of every variable; 0 means unconstrained, and such
+    # variables must be part of the support
+    signs = np.ones((len(b), num_vars))
+    if (num_converted_variables > 0):
+        signs[:, num_endmembers:] = conversion_sign_constraints
+
+    x = np.zeros((len(b), num_vars))
+    found = np.zeros(len(b), dtype=bool)
+    unpenalized = np.all(endmember_usagepenalty==0, axis=-1)
+    #rows sharing a sign pattern share the admissible supports (those that
+    # include every unconstrained variable), and folding the signs into P
+    # and h turns the feasibility check into candidates >= 0
+    sign_patterns, pattern_idxs = np.unique(signs[unpenalized], axis=0,
+                                            return_inverse=True)
+    unpenalized_idxs = np.nonzero(unpenalized)[0]
+    for sign_pattern_idx, sign_pattern in enumerate(sign_patterns):
+        pattern_rows = unpenalized_idxs[
+                        np.ravel(pattern_idxs)==sign_pattern_idx]
+        admissible = np.all(supports | (sign_pattern[None,:] != 0), axis=1)
+        flip = np.where(sign_pattern==0, 1.0, sign_pattern)
+        P_flat = (P[admissible]*flip[None,:,None]).reshape((-1, A.shape[1]))
+        h_flipped = h[admissible]*flip[None,:]
+        checked = (sign_pattern != 0)
+        chunk_size = max(1, max_chunk_elements//(np.sum(admissible)
+                                                 *max(num_vars, A.shape[1])))
+        for i in range(0, len(pattern_rows), chunk_size):
+            chunk_rows = pattern_rows[i:i+chunk_size]
+            b_chunk = b[chunk_rows]
+            #candidates has dims of rows X supports X vars
+            candidates = (b_chunk@P_flat.T).reshape(
+                            (len(b_chunk),)+h_flipped.shape) + h_flipped[None]
+            feasible = np.all(candidates[:,:,checked] >= -1e-9, axis=-1)
+            #only the feasible candidates (typically a handful per row) need
+            # their objective evaluated
+            row_idxs, support_idxs = np.nonzero(feasible)
+            obj = np.full(feasible.shape, np.inf)
+            obj[row_idxs, support_idxs] = np.sum(np.square(
+                (candidates[row_idxs, support_idxs]*flip[None,:])@A
+                - b_chunk[row_idxs]), axis=-1)
+            best = np.argmin(obj, axis=1)
+            x[chunk_rows] = candidates[np.arange(len(b_chunk)), best]*flip
+            found[chunk_rows] = np.isfinite(obj[np.arange(len(b_chunk)), best])
+    x = np.where(signs != 0, signs*np.maximum(signs*x, 0.0), x)
+
+    fallback = (found==False)
+    status = "optimal"
+    num_iters = 0
+    if (np.any(fallback)):
+        fallback_idxs = np.nonzero(fallback)[0]
+        x[fallback_idxs], fallback_result = native_core_solve(
+            A=A, b=b[fallback_idxs],
+            num_converted_variables=num_converted_variables,
+            endmember_usagepenalty=endmember_usagepenalty[fallback_idxs],
+            conversion_sign_constraints=(
+                conversion_sign_constraints[fallback_idxs]
+                if num_converted_variables > 0 else None),
+            sumtooneconstraint=sumtooneconstraint, max_iter=max_iter)
+        status = fallback_result.status
+        num_iters = fallback_result.num_iters
+    log_info("Support enumeration solved",len(b)-np.sum(fallback),"out of",
+             len(b),"observations;",np.sum(fallback),"went to the active-set"
+             +" method")
+
+    value = (np.sum(np.square(x@A - b))
+             + np.sum(np.square(x[:,:num_endmembers]*endmember_usagepenalty)))
+    return x, NativeSolveResult(status=status, value=value,
+                                num_iters=num_iters)
@@ -4,12 +4,27 @@ import numpy as np
 import pandas as pd
 import scipy
 import scipy.spatial
+import scipy.sparse
 import scipy.optimize
 from collections import OrderedDict, defaultdict
 import itertools
+import hashlib
+import copy
+import time
 from .util import (get_endmember_idx_mapping,
                    organize_converted_vars_by_groupname,
-                   collapse_endmembers_by_idxmapping)
+                   collapse_endmembers_by_idxmapping,
+                   GrowableArray, GrowableDataFrame, apply_A,
+                   InfeasibleError)
+from .native_solver import (native_core_solve, enumeration_core_solve,
+                            closed_form_screen)
+from .parallel import parallel_batch_core_solve
+from .report import SolveReport, log_info, log_warning
+from .export import ExportWriter
+from .ambiguity import (batched_residual_limit_lp, batched_nullspace_lp,
+                        hit_and_run_sample, LP_CHUNK_SIZE)
+from .smoothness import (partition_observations, admm_smoothed_solve,
+                         banded_smoothed_solve)
 import sys
 
 
@@ -63,7 +78,7 @@ class ExportToCsvMixin(object):
                     self.endmembername_to_usagepenalty[endmember_name]
             else:
                 nan_vec = np.empty((len(self.obs_df),))
-                nan_vec[:] = np.NaN 
+                nan_vec[:] = np.nan
                 new_endmembername_to_usagepenalty[endmember_name] = nan_vec
 
         return ExportToCsvMixin(
@@ -88,17 +103,18 @@ class ExportToCsvMixin(object):
     # groupname_to_effectiveconversionratios,
     #exporting the usage penalties also uses
     # endmembername_to_usagepenalty
-    def export_to_csv(self, csv_output_name,
-                            orig_cols_to_include=[],
+    def get_export_df(self, orig_cols_to_include=[],
                             export_orig_param_vals=True,
                             export_residuals=True,
                             export_endmember_fracs=True,
                             export_endmember_totals=True,
                             export_converted_var_usage=True,
                             export_conversion_ratios=True,
-                            export_endmember_usage_penalties=False):
-
-        print("writing to",csv_output_name)
+                            export_endmember_usage_penalties=False,
+                            export_fraction_bounds=True):
+        #Returns the data frame of the columns selected by the export flags
+        #export_fraction_bounds only applies to solutions from
+        # quantify_fraction_bounds
 
         toexport_df_dict = OrderedDict()
 
@@ -149,6 +165,14 @@ class ExportToCsvMixin(object):
                      +groupname+"_ratio"] =\
                         effective_conversion_ratios[converted_param]
 
+        if (export_fraction_bounds and getattr(self,
+                "endmember_fraction_lower_bounds", None) is not None):
+            for endmember_idx in range(len(endmember_names)):
+                toexport_df_dict[endmember_names[endmember_idx]+"_frac_min"] =\
+                    self.endmember_fraction_lower_bounds[:,endmember_idx]
+                toexport_df_dict[endmember_names[endmember_idx]+"_frac_max"] =\
+                    self.endmember_fraction_upper_bounds[:,endmember_idx]
+
         if (export_endmember_usage_penalties):
             for endmembername in endmember_names:
                 if (endmembername in\
@@ -158,76 +182,164 @@ class ExportToCsvMixin(object):
                     toexport_df_dict[endmembername+"_penalty"] =\
                         endmember_usagepenalty
         
-        toexport_df = pd.DataFrame(toexport_df_dict)
-        toexport_df.to_csv(csv_output_name, index=False)
+        return pd.DataFrame(toexport_df_dict)
+
+    def export_to_csv(self, csv_output_name,
+                            orig_cols_to_include=[],
+                            export_orig_param_vals=True,
+                            export_residuals=True,
+                            export_endmember_fracs=True,
+                            export_endmember_totals=True,
+                            export_converted_var_usage=True,
+                            export_conversion_ratios=True,
+                            export_endmember_usage_penalties=False,
+                            export_fraction_bounds=True,
+                            append=False):
+        #If append is True, the rows are added to the end of an existing
+        # csv_output_name (without writing the header again)
+        self.export(output_name=csv_output_name, format="csv", append=append,
+            orig_cols_to_include=orig_cols_to_include,
+            export_orig_param_vals=export_orig_param_vals,
+            export_residuals=export_residuals,
+            export_endmember_fracs=export_endmember_fracs,
+            export_endmember_totals=export_endmember_totals,
+            export_converted_var_usage=export_converted_var_usage,
+            export_conversion_ratios=export_conversion_ratios,
+            export_endmember_usage_penalties=export_endmember_usage_penalties,
+            export_fraction_bounds=export_fraction_bounds)
+
+    def export(self, output_name, format=None, compression="default",
+                     chunk_size=None, append=False, **export_flags):
+        #Writes the columns selected by export_flags (see get_export_df) to
+        # a csv, parquet, feather or CF-style netcdf file; the format is
+        # inferred from the extension of output_name if not specified. See
+        # ExportWriter for compression, chunk_size and append. To write
+        # many partial solutions to one parquet/feather file, use
+        # export_solns or an ExportWriter.
+        with ExportWriter(output_name=output_name, format=format,
+                          compression=compression, chunk_size=chunk_size,
+                          append=append) as writer:
+            writer.write(self, **export_flags)
 
     @classmethod
     def merge(cls, exptocsv1, exptocsv2):
-        assert (tuple(exptocsv1.param_names)
-                ==tuple(exptocsv2.param_names)) 
-
-        num_entries_exptocsv1 = exptocsv1.endmember_fractions.shape[0]
-        num_entries_exptocsv2 = exptocsv2.endmember_fractions.shape[0]
-        num_entries = num_entries_exptocsv1 + num_entries_exptocsv2 
-
-        #first get the new raw end-member names and the
-        # reformatted endmember_fractions matrix
-        new_endmember_names = sorted(
-            set(list(exptocsv1.endmember_names)
-                +list(exptocsv2.endmember_names)))
-        new_endmember_fractions =\
-            np.zeros((num_entries, len(new_endmember_names)))
-        for idx,endmember_name in enumerate(new_endmember_names):
-            if (endmember_name in exptocsv1.endmember_names):
-                new_endmember_fractions[0:num_entries_exptocsv1, idx] = (
-                    exptocsv1.endmember_fractions[:,
-                     exptocsv1.endmember_names.index(endmember_name)]) 
-            if (endmember_name in exptocsv2.endmember_names):
-                new_endmember_fractions[num_entries_exptocsv1:
-                 (num_entries_exptocsv1+num_entries_exptocsv2), idx] = (
-                    exptocsv2.endmember_fractions[:,
-                     exptocsv2.endmember_names.index(endmember_name)]) 
-
-        new_param_residuals = np.concatenate([exptocsv1.param_residuals,
-                                exptocsv2.param_residuals], axis=0)
-        new_converted_variables = np.concatenate([
-                                   exptocsv1.converted_variables,
-                                   exptocsv2.converted_variables], axis=0)
-
-        new_obsdf = pd.concat([exptocsv1.obs_df, exptocsv2.obs_df])
+        return cls.merge_many([exptocsv1, exptocsv2])
+
+    @classmethod
+    def merge_many(cls, results, endmember_names=None):
+        #Stitches any number of results (e.g. per-dive or per-bin
+        # solutions) together, in order, in time linear in the total number
+        # of rows: the endmember columns are indexed once, the output arrays
+        # are preallocated and each result's block is filled with a single
+        # fancy-index assignment. The endmembers are the sorted union of
+        # those of the results, unless endmember_names is specified (in
+        # which case endmembers not in it are dropped); endmembers absent
+        # from a result get fractions of 0 and NaN usage penalties.
+        #perobs_weighted_resid_sq and perobs_obj are carried over if every
+        # result has them
+        results = list(results)
+        assert len(results) > 0, "Nothing to merge"
+        param_names = results[0].param_names
+        for result in results[1:]:
+            assert tuple(result.param_names)==tuple(param_names), (
+                "Can't merge results with different params: "
+                +str(result.param_names)+" vs "+str(param_names))
+        if (endmember_names is None):
+            endmember_names = sorted(set(itertools.chain(
+                *[result.endmember_names for result in results])))
+        endmember_names = list(endmember_names)
+        endmembername_to_col = dict(
+            (endmember_name, col)
+            for col, endmember_name in enumerate(endmember_names))
+        num_rows_per_result = np.array(
+            [len(result.endmember_fractions) for result in results])
+        row_ends = np.cumsum(num_rows_per_result)
+        row_starts = row_ends - num_rows_per_result
+        num_rows = int(row_ends[-1])
+
+        def stitch(get_field):
+            #rows of a field of every result, or None if some result
+            # doesn't have it
+            fields = [get_field(result) for result in results]
+            if (any([field is None for field in fields])):
+                return None
+            stitched = np.zeros((num_rows,)+np.shape(fields[0])[1:])
+            for row_start, row_end, field in zip(row_starts, row_ends,
+                                                 fields):
+                stitched[row_start:row_end] = field
+            return stitched
+
+        endmember_fractions = np.zeros((num_rows, len(endmember_names)))
+        endmembername_to_usagepenalty = OrderedDict(
+            (endmember_name, np.full(num_rows, np.nan))
+            for endmember_name in endmember_names)
+        for row_start, row_end, result in zip(row_starts, row_ends, results):
+            result_cols = [result_col for result_col, endmember_name
+                           in enumerate(result.endmember_names)
+                           if endmember_name in endmembername_to_col]
+            cols = [endmembername_to_col[result.endmember_names[result_col]]
+                    for result_col in result_cols]
+            endmember_fractions[row_start:row_end, cols] =\
+                result.endmember_fractions[:, result_cols]
+            for endmember_name, penalty in getattr(result,
+                    "endmembername_to_usagepenalty", {}).items():
+                if (endmember_name in endmembername_to_usagepenalty):
+                    endmembername_to_usagepenalty[endmember_name][
+                        row_start:row_end] = penalty
 
         new_groupname_to_totalconvertedvariable = OrderedDict()
         new_groupname_to_effectiveconversionratios = OrderedDict()
-        for groupname in exptocsv1.groupname_to_totalconvertedvariable:
-            new_groupname_to_totalconvertedvariable[groupname] =\
-                np.concatenate([
-                 exptocsv1.groupname_to_totalconvertedvariable[groupname],
-                 exptocsv2.groupname_to_totalconvertedvariable[groupname]
-                ], axis=0)
+        for groupname in results[0].groupname_to_totalconvertedvariable:
+            new_groupname_to_totalconvertedvariable[groupname] = stitch(
+                lambda x: x.groupname_to_totalconvertedvariable[groupname])
             new_groupname_to_effectiveconversionratios[groupname] =\
                 OrderedDict()
             for param_name in (
-                  exptocsv1.groupname_to_effectiveconversionratios[groupname]):
+                  results[0].groupname_to_effectiveconversionratios[groupname]):
                 new_groupname_to_effectiveconversionratios[
-                  groupname][param_name] = (
-                    np.concatenate([
-                        exptocsv1.groupname_to_effectiveconversionratios[
-                          groupname][param_name],
-                        exptocsv2.groupname_to_effectiveconversionratios[
-                          groupname][param_name],
-                    ], axis=0)) 
+                  groupname][param_name] = stitch(
+                    lambda x: x.groupname_to_effectiveconversionratios[
+                                groupname][param_name])
+
+        optional_fields = OrderedDict()
+        for field_name in ["perobs_weighted_resid_sq", "perobs_obj"]:
+            stitched = stitch(lambda x: getattr(x, field_name, None))
+            if (stitched is not None):
+                optional_fields[field_name] = stitched
 
         return ExportToCsvMixin(
-                param_names=exptocsv1.param_names,
-                endmember_names=new_endmember_names,
-                param_residuals=new_param_residuals,
-                endmember_fractions=new_endmember_fractions,
-                converted_variables=new_converted_variables,
-                obs_df=new_obsdf,
+                param_names=param_names,
+                endmember_names=endmember_names,
+                param_residuals=stitch(lambda x: x.param_residuals),
+                endmember_fractions=endmember_fractions,
+                converted_variables=stitch(lambda x: x.converted_variables),
+                obs_df=pd.concat([result.obs_df for result in results]),
                 groupname_to_totalconvertedvariable=
                     new_groupname_to_totalconvertedvariable,
                 groupname_to_effectiveconversionratios=
-                    new_groupname_to_effectiveconversionratios)
+                    new_groupname_to_effectiveconversionratios,
+                endmembername_to_usagepenalty=endmembername_to_usagepenalty,
+                **optional_fields)
+
+
+def export_solns(solns, output_name, format=None, compression="default",
+                       chunk_size=None, append=False, **export_flags):
+    #Writes a sequence of partial solutions (e.g. from
+    # OMPAProblem.solve_iter) to a single csv, parquet, feather or netcdf
+    # file, writing each one as it arrives so that only one partial solution
+    # is held in memory at a time. export_flags are the column selection
+    # flags of get_export_df. Returns the number of rows written.
+    with ExportWriter(output_name=output_name, format=format,
+                      compression=compression, chunk_size=chunk_size,
+                      append=append) as writer:
+        for soln in solns:
+            writer.write(soln, **export_flags)
+    return writer.num_rows
+
+
+def export_solns_to_csv(solns, csv_output_name, **export_kwargs):
+    return export_solns(solns=solns, output_name=csv_output_name,
+                        format="csv", **export_kwargs)
 
 
 class OMPASoln(ExportToCsvMixin):
@@ -244,6 +356,10 @@ class OMPASoln(ExportToCsvMixin):
         if (endmember_df is not None):
             self.endmember_names=list(
                     endmember_df[endmember_name_column])
+        elif ("endmember_names" in kwargs):
+            #e.g. solutions with per-observation endmember matrices; this
+            # goes through the property setter, unlike the update below
+            self.endmember_names = kwargs.pop("endmember_names")
         self.endmember_df = endmember_df
         self.endmember_name_column = endmember_name_column
         self.ompa_problem = ompa_problem
@@ -265,10 +381,25 @@ class OMPASoln(ExportToCsvMixin):
     def core_quantify_ambiguity_via_residual_limits(self,
         obj_weights, max_resids, retain_original_penalties=True,
         target_endmem_fracs=None, verbose=False,
-        max_iter=100000):
+        max_iter=100000, report=None, engine="cvxpy",
+        lp_chunk_size=LP_CHUNK_SIZE):
         #obj_weights can either be a single vector (e.g. for minimization/
         # maximization), or a matrix (for trying to find a solution
         # that resembels a target soln e.g. one obtained from OCIM
+        #engine is either "cvxpy" (one cvxpy problem per observation and
+        # sign combo) or "highs" (the LPs of lp_chunk_size observations
+        # stacked into one sparse LP per sign combo and solved with HiGHS;
+        # only for a single vector of obj_weights)
+        #Timings and solver statistics are collected in report (by default a
+        # SolveReport that only keeps totals over the per-observation
+        # solves), attached to the returned solution as solve_report
+        report = (SolveReport(keep_solver_calls=False) if report is None
+                  else report)
+        assert engine in ("cvxpy", "highs"), (
+            "engine should be 'cvxpy' or 'highs'; got "+str(engine))
+        assert (engine=="cvxpy" or target_endmem_fracs is None), (
+            "The highs engine only solves LPs; use the cvxpy engine with"
+            +" target_endmem_fracs")
         if (target_endmem_fracs is not None):
             assert len(obj_weights.shape)==2
             assert np.min(obj_weights)==0
@@ -279,6 +410,7 @@ class OMPASoln(ExportToCsvMixin):
             assert target_endmem_fracs.shape[0]==len(self.endmember_fractions)
         endmember_names = self.endmember_names
 
+        setup_start = time.time()
         if (retain_original_penalties):
             endmember_usagepenalty =\
                 self.ompa_problem.prep_endmember_usagepenalty_mat(
@@ -290,8 +422,14 @@ class OMPASoln(ExportToCsvMixin):
         num_converted_variables = len(conversion_ratio_rows)
         num_endmembers = self.endmember_fractions.shape[1]
         #conversion_ratio_rows = 'R'
-        endmem_mat = self.ompa_problem.get_endmem_mat(
-                            self.endmember_df) #'M'
+        #solutions from solve_perobs_endmember_mats have one endmember
+        # matrix per observation (set for each observation below), and some
+        # endmembers may be unavailable to an observation
+        perobs_endmember_mat = getattr(self, "perobs_endmember_mat", None)
+        endmember_available = getattr(self, "endmember_available", None)
+        endmem_mat = (self.ompa_problem.get_endmem_mat(self.endmember_df)
+                      if perobs_endmember_mat is None
+                      else perobs_endmember_mat[0]) #'M'
         if (num_converted_variables):
             #add rows to A for the conversion ratios
             omp_A = np.concatenate([endmem_mat, conversion_ratio_rows], axis=0)
@@ -304,6 +442,63 @@ class OMPASoln(ExportToCsvMixin):
             assert len(obj_weights) == omp_A.shape[0]
         #prepare original b
         omp_b = self.ompa_problem.get_b() 
+        report.add_phase_time("A_assembly", time.time()-setup_start)
+
+        if (engine=="highs"):
+            (new_perobs_endmember_fractions, new_perobs_converted_vars,
+             new_perobs_resid, perobs_obj) = self.batched_residual_limit_lp(
+                obj_weights=obj_weights, max_resids=max_resids,
+                omp_b=omp_b, endmember_usagepenalty=(endmember_usagepenalty
+                    if retain_original_penalties else None),
+                lp_chunk_size=lp_chunk_size, report=report)
+        else:
+            (new_perobs_endmember_fractions, new_perobs_converted_vars,
+             new_perobs_resid, perobs_obj) = self.cvxpy_residual_limit_lps(
+                obj_weights=obj_weights, max_resids=max_resids,
+                omp_A=omp_A, omp_b=omp_b,
+                endmember_usagepenalty=(endmember_usagepenalty
+                    if retain_original_penalties else None),
+                target_endmem_fracs=target_endmem_fracs, verbose=verbose,
+                max_iter=max_iter, report=report)
+
+        postprocessing_start = time.time()
+        if (new_perobs_converted_vars is not None):
+            new_perobs_converted_vars = np.array(new_perobs_converted_vars)
+        new_perobs_endmember_fractions =\
+            np.array(new_perobs_endmember_fractions)
+        perobs_obj = np.array(perobs_obj)
+        new_perobs_resid = np.array(new_perobs_resid)
+
+        new_ompasoln = self.build_ambiguity_soln(
+            endmember_fractions=new_perobs_endmember_fractions,
+            converted_variables=new_perobs_converted_vars,
+            param_residuals=new_perobs_resid, perobs_obj=perobs_obj,
+            retain_original_penalties=retain_original_penalties,
+            report=report)
+        report.add_phase_time("postprocessing",
+                              time.time()-postprocessing_start)
+        report.finish()
+
+        return new_ompasoln 
+
+    def cvxpy_residual_limit_lps(self, obj_weights, max_resids, omp_A, omp_b,
+                                       endmember_usagepenalty,
+                                       target_endmem_fracs, verbose,
+                                       max_iter, report):
+        #The "cvxpy" engine of core_quantify_ambiguity_via_residual_limits:
+        # one cvxpy problem per observation and sign combo. The usage
+        # penalties are retained if endmember_usagepenalty is not None.
+        # Returns the per-observation endmember fractions, converted
+        # variables, residuals and objective values
+        retain_original_penalties = endmember_usagepenalty is not None
+        endmember_names = self.endmember_names
+        conversion_ratio_rows =\
+            self.ompa_problem.get_conversion_ratio_rows_of_A()
+        num_converted_variables = len(conversion_ratio_rows)
+        num_endmembers = self.endmember_fractions.shape[1]
+        perobs_endmember_mat = getattr(self, "perobs_endmember_mat", None)
+        endmember_available = getattr(self, "endmember_available", None)
+        endmem_mat = omp_A[:num_endmembers]
 
         #For each observation, we can solve a convex objective
         new_perobs_endmember_fractions = []
@@ -315,7 +510,8 @@ class OMPASoln(ExportToCsvMixin):
         perobs_obj = []
         for obs_idx in range(len(self.endmember_fractions)):
             if (verbose):
-                print("On obs",obs_idx,"out of",len(self.endmember_fractions))
+                log_info("On obs",obs_idx,"out of",
+                         len(self.endmember_fractions))
                 sys.stdout.flush()
             obs_orig_endmem_fracs = self.endmember_fractions[obs_idx] 
             assert num_endmembers==len(endmember_names)
@@ -324,6 +520,11 @@ class OMPASoln(ExportToCsvMixin):
             if (retain_original_penalties):
                 obs_usagepenalty = endmember_usagepenalty[obs_idx]
             obs_b = omp_b[obs_idx]
+            if (perobs_endmember_mat is not None):
+                endmem_mat = perobs_endmember_mat[obs_idx]
+                omp_A = (np.concatenate([endmem_mat, conversion_ratio_rows],
+                                        axis=0)
+                         if num_converted_variables else endmem_mat)
 
             obs_orig_pred = obs_orig_endmem_fracs@endmem_mat
             if (num_converted_variables > 0):
@@ -386,14 +587,22 @@ class OMPASoln(ExportToCsvMixin):
                                var <= 0) for var,converted_var_sign in
                              zip(x[num_endmembers:], converted_vars_signs)
                              ] if num_converted_variables > 0 else [])
+                           +([x[np.nonzero(
+                               endmember_available[obs_idx]==False)[0]] == 0]
+                             if (endmember_available is not None and
+                                 np.all(endmember_available[obs_idx])==False)
+                             else [])
                          )
 
                 prob = cp.Problem(obj, constraints)
+                solve_start = time.time()
                 try:
                     if (target_endmem_fracs is None):
                         prob.solve(verbose=False)
                     else:
                         prob.solve(verbose=False, max_iter=max_iter)
+                    report.record_solver_call(prob=prob, engine="cvxpy",
+                        num_obs=1, wall_time=time.time()-solve_start)
                     if (prob.value < np.inf):
                         new_endmem_fracs = x.value[:num_endmembers]
                         new_converted_vars = x.value[num_endmembers:] 
@@ -416,7 +625,8 @@ class OMPASoln(ExportToCsvMixin):
                 objs.append(obj)
             new_endmem_fracs, new_converted_vars = solns[np.argmin(objs)]
             if (new_endmem_fracs is None):
-                print("Warning: solver didn't find a soln, using original")
+                log_warning("Warning: solver didn't find a soln,"
+                            +" using original")
                 new_endmem_fracs = obs_orig_endmem_fracs
                 new_converted_vars = obs_orig_converted_vars
             assert new_endmem_fracs is not None
@@ -440,186 +650,490 @@ class OMPASoln(ExportToCsvMixin):
             new_perobs_converted_vars.append(new_converted_vars)
             perobs_obj.append(obj) 
 
-        new_perobs_converted_vars = np.array(new_perobs_converted_vars)
-        new_perobs_endmember_fractions =\
-            np.array(new_perobs_endmember_fractions)
-        perobs_obj = np.array(perobs_obj)
-        new_perobs_resid = np.array(new_perobs_resid)
+        return (new_perobs_endmember_fractions, new_perobs_converted_vars,
+                new_perobs_resid, perobs_obj)
 
+    def build_ambiguity_soln(self, endmember_fractions, converted_variables,
+                                   param_residuals, perobs_obj,
+                                   retain_original_penalties, report):
         #create a dummy OMPASoln object to store the end-member fractions,
         # converted variable amounts and residuals
         (new_groupname_to_totalconvertedvariable, 
          new_groupname_to_effectiveconversionratios) = (
            organize_converted_vars_by_groupname(
-               converted_variables=new_perobs_converted_vars,
+               converted_variables=converted_variables,
                convertedparam_groups=self.ompa_problem.convertedparam_groups)) 
 
-        new_ompasoln = OMPASoln(
+        return OMPASoln(
              endmember_df=self.endmember_df,
              endmember_name_column=self.endmember_name_column,
              ompa_problem=None,
-             endmember_fractions=new_perobs_endmember_fractions,
-             converted_variables=new_perobs_converted_vars,
-             param_residuals=new_perobs_resid,
+             endmember_fractions=endmember_fractions,
+             converted_variables=converted_variables,
+             param_residuals=param_residuals,
              groupname_to_effectiveconversionratios=
                new_groupname_to_effectiveconversionratios,
              groupname_to_totalconvertedvariable=
                new_groupname_to_totalconvertedvariable,
-             #nullspace_A=None,
              endmember_names=self.endmember_names,
              obs_df=self.obs_df,
              param_names=self.param_names,
              endmembername_to_usagepenalty=\
                 (self.endmembername_to_usagepenalty if
                  retain_original_penalties else {}),
-             perobs_obj=perobs_obj)
+             perobs_obj=perobs_obj,
+             solve_report=report)
+
+    def prep_residual_limit_lp(self, max_resids, omp_b,
+                                     endmember_usagepenalty):
+        #Shared setup of the "highs" engine of
+        # core_quantify_ambiguity_via_residual_limits and of
+        # quantify_fraction_bounds. Returns omp_A (per-observation if this
+        # solution has per-observation endmember matrices), the original
+        # solution as one array and the constraint arguments of
+        # ambiguity.batched_residual_limit_lp
+        conversion_ratio_rows =\
+            self.ompa_problem.get_conversion_ratio_rows_of_A()
+        num_converted_variables = len(conversion_ratio_rows)
+        perobs_endmember_mat = getattr(self, "perobs_endmember_mat", None)
+        if (perobs_endmember_mat is None):
+            endmem_mat = self.ompa_problem.get_endmem_mat(self.endmember_df)
+        else:
+            endmem_mat = perobs_endmember_mat
+        if (num_converted_variables == 0):
+            conversion_ratio_rows = np.zeros((0, endmem_mat.shape[-1]))
+        if (perobs_endmember_mat is not None):
+            conversion_ratio_rows = np.broadcast_to(conversion_ratio_rows,
+                (len(endmem_mat),)+conversion_ratio_rows.shape)
+        omp_A = np.concatenate([endmem_mat, conversion_ratio_rows],
+                               axis=-2)
+        orig_converted_vars = (self.converted_variables
+            if num_converted_variables > 0
+            else np.zeros((len(self.endmember_fractions), 0)))
+        orig_vars_soln = np.concatenate([self.endmember_fractions,
+                                         orig_converted_vars], axis=1)
+        orig_resid = apply_A(orig_vars_soln, omp_A) - omp_b
+        lp_kwargs = OrderedDict([
+            ("omp_A", omp_A), ("obs_b", omp_b),
+            ("upper_resids", np.maximum(max_resids, orig_resid)),
+            ("lower_resids", np.minimum(-max_resids, orig_resid)),
+            ("num_converted_variables", num_converted_variables),
+            ("signcombos_to_try", np.array(
+              self.ompa_problem.get_convertedvariable_signcombos_to_try())),
+            ("usagepenalty", endmember_usagepenalty),
+            ("orig_penalty", (np.sum(self.endmember_fractions
+                                     *endmember_usagepenalty, axis=1)
+                      if endmember_usagepenalty is not None else None)),
+            ("endmember_available",
+             getattr(self, "endmember_available", None))])
+        return omp_A, orig_vars_soln, lp_kwargs
+
+    def batched_residual_limit_lp(self, obj_weights, max_resids, omp_b,
+                                  endmember_usagepenalty, lp_chunk_size,
+                                  report):
+        #The "highs" engine of core_quantify_ambiguity_via_residual_limits;
+        # returns the new endmember fractions, converted variables,
+        # residuals and objective values
+        omp_A, orig_vars_soln, lp_kwargs = self.prep_residual_limit_lp(
+            max_resids=max_resids, omp_b=omp_b,
+            endmember_usagepenalty=endmember_usagepenalty)
+        num_converted_variables = lp_kwargs["num_converted_variables"]
+        signcombos_to_try = lp_kwargs["signcombos_to_try"]
+
+        new_vars_soln, best_signcombo_idxs, found = batched_residual_limit_lp(
+            obj_weights=obj_weights, chunk_size=lp_chunk_size, report=report,
+            **lp_kwargs)
+        return self.finish_lp_soln(new_vars_soln=new_vars_soln,
+            best_signcombo_idxs=best_signcombo_idxs, found=found,
+            orig_vars_soln=orig_vars_soln, omp_A=omp_A, omp_b=omp_b,
+            obj_weights=obj_weights,
+            num_converted_variables=num_converted_variables,
+            signcombos_to_try=signcombos_to_try)
+
+    def finish_lp_soln(self, new_vars_soln, best_signcombo_idxs, found,
+                             orig_vars_soln, omp_A, omp_b, obj_weights,
+                             num_converted_variables, signcombos_to_try):
+        #Falls back to the original solution where no LP was solved and
+        # fixes numerical issues; returns the new endmember fractions,
+        # converted variables, residuals and objective values
+        if (np.all(found)==False):
+            log_warning("Warning: solver didn't find a soln for",
+                        np.sum(found==False), "observations, using original")
+            new_vars_soln[found==False] = orig_vars_soln[found==False]
 
-        return new_ompasoln 
+        num_endmembers = self.endmember_fractions.shape[1]
+        new_endmem_fracs = new_vars_soln[:, :num_endmembers]
+        assert np.max(np.abs(np.sum(new_endmem_fracs, axis=1) - 1)) < 1e-5
+        #fix any numerical issues with soln
+        new_endmem_fracs = np.maximum(new_endmem_fracs, 0)
+        new_endmem_fracs = (new_endmem_fracs/
+                            np.sum(new_endmem_fracs, axis=1)[:,None])
+        best_sign_combos = signcombos_to_try[best_signcombo_idxs]
+        new_converted_vars = best_sign_combos*np.maximum(
+            best_sign_combos*new_vars_soln[:, num_endmembers:], 0.0)
+        new_vars_soln = np.concatenate([new_endmem_fracs,
+                                        new_converted_vars], axis=1)
+        return (new_endmem_fracs,
+                (new_converted_vars if num_converted_variables > 0 else None),
+                apply_A(new_vars_soln, omp_A) - omp_b,
+                new_vars_soln@obj_weights)
+
+    def quantify_fraction_bounds(self, max_resids,
+                                 retain_original_penalties=True,
+                                 lp_chunk_size=LP_CHUNK_SIZE, report=None):
+        """
+            Finds the smallest and largest value of every endmember
+            fraction and converted variable over the solutions that satisfy
+            the constraints of core_quantify_ambiguity_via_residual_limits
+            (residuals within max_resids or the original residual, and, if
+            retain_original_penalties, a usage penalty no larger than the
+            original one). The constraints of each chunk of observations
+            are built once and all of the minimizations and maximizations
+            are solved against them with HiGHS.
+            Returns a copy of this solution with the added attributes
+            endmember_fraction_lower_bounds,
+            endmember_fraction_upper_bounds (observations X endmembers),
+            converted_variable_lower_bounds and
+            converted_variable_upper_bounds (observations X converted
+            variables, or None if there are no converted variables).
+        """
+        report = (SolveReport(keep_solver_calls=False) if report is None
+                  else report)
+        setup_start = time.time()
+        endmember_usagepenalty = (
+            self.ompa_problem.prep_endmember_usagepenalty_mat(
+                self.endmember_names) if retain_original_penalties else None)
+        omp_A, orig_vars_soln, lp_kwargs = self.prep_residual_limit_lp(
+            max_resids=max_resids, omp_b=self.ompa_problem.get_b(),
+            endmember_usagepenalty=endmember_usagepenalty)
+        report.add_phase_time("A_assembly", time.time()-setup_start)
+
+        #minimize, then maximize, each variable
+        num_vars = omp_A.shape[-2]
+        obj_weights = np.concatenate([np.eye(num_vars), -np.eye(num_vars)],
+                                     axis=0)
+        x, best_signcombo_idxs, found = batched_residual_limit_lp(
+            obj_weights=obj_weights, chunk_size=lp_chunk_size, report=report,
+            **lp_kwargs)
+
+        postprocessing_start = time.time()
+        var_idxs = np.arange(num_vars)
+        #(observations X vars)
+        lower_bounds = x[var_idxs, :, var_idxs].T
+        upper_bounds = x[num_vars+var_idxs, :, var_idxs].T
+        lower_found = found[var_idxs].T
+        upper_found = found[num_vars+var_idxs].T
+        if (np.all(lower_found) == False or np.all(upper_found) == False):
+            log_warning("Warning: solver didn't find some bounds for",
+                np.sum(np.any((lower_found==False)|(upper_found==False),
+                              axis=1)),
+                "observations, using original")
+            lower_bounds = np.where(lower_found, lower_bounds, orig_vars_soln)
+            upper_bounds = np.where(upper_found, upper_bounds, orig_vars_soln)
+        #fix any numerical issues with the bounds
+        num_endmembers = self.endmember_fractions.shape[1]
+        lower_bounds[:, :num_endmembers] = np.clip(
+            lower_bounds[:, :num_endmembers], 0, 1)
+        upper_bounds[:, :num_endmembers] = np.clip(
+            upper_bounds[:, :num_endmembers], 0, 1)
+        num_converted_variables = lp_kwargs["num_converted_variables"]
+
+        bounds_soln = OMPASoln(
+             endmember_df=self.endmember_df,
+             endmember_name_column=self.endmember_name_column,
+             ompa_problem=None,
+             endmember_fractions=self.endmember_fractions,
+             converted_variables=self.converted_variables,
+             param_residuals=self.param_residuals,
+             groupname_to_effectiveconversionratios=
+               self.groupname_to_effectiveconversionratios,
+             groupname_to_totalconvertedvariable=
+               self.groupname_to_totalconvertedvariable,
+             endmember_names=self.endmember_names,
+             obs_df=self.obs_df,
+             param_names=self.param_names,
+             endmembername_to_usagepenalty=self.endmembername_to_usagepenalty,
+             endmember_fraction_lower_bounds=lower_bounds[:, :num_endmembers],
+             endmember_fraction_upper_bounds=upper_bounds[:, :num_endmembers],
+             converted_variable_lower_bounds=(
+                lower_bounds[:, num_endmembers:]
+                if num_converted_variables > 0 else None),
+             converted_variable_upper_bounds=(
+                upper_bounds[:, num_endmembers:]
+                if num_converted_variables > 0 else None),
+             solve_report=report)
+        report.add_phase_time("postprocessing",
+                              time.time()-postprocessing_start)
+        report.finish()
+        return bounds_soln
+
+    def core_quantify_ambiguity_via_nullspace(self, obj_weights,
+        retain_original_penalties=True, formulation="auto",
+        lp_chunk_size=LP_CHUNK_SIZE, report=None):
+        """
+            Minimizes obj_weights@x over the solutions x that
+            reproduce each observation's original predictions exactly,
+            i.e. x = s + N(A)@v for the original solution s and the
+            nullspace N(A) of the endmember and conversion ratio matrix
+            with the mass conservation constraint, while keeping the
+            endmember fractions nonnegative, the converted variables within
+            a sign combo and, if retain_original_penalties, the usage
+            penalty no larger than the original one.
+            The nullspace is computed once and shared by all observations,
+            so with formulation="nullspace" each LP only has as many
+            variables as the nullspace has dimensions; with
+            "residual_limits" the LPs of the residual limits method are
+            solved with the residuals pinned to the original ones.
+            formulation="auto" picks the one with the smaller constraint
+            blocks (always "residual_limits" for solutions with
+            per-observation endmember matrices, which don't share a
+            nullspace). Returns an OMPASoln with perobs_obj.
+        """
+        report = (SolveReport(keep_solver_calls=False) if report is None
+                  else report)
+        assert formulation in ("auto", "nullspace", "residual_limits"), (
+            "formulation should be 'auto', 'nullspace' or 'residual_limits';"
+            +" got "+str(formulation))
+        setup_start = time.time()
+        endmember_usagepenalty = (
+            self.ompa_problem.prep_endmember_usagepenalty_mat(
+                self.endmember_names) if retain_original_penalties else None)
+        omp_b = self.ompa_problem.get_b()
+        omp_A, orig_vars_soln, lp_kwargs = self.prep_residual_limit_lp(
+            max_resids=0, omp_b=omp_b,
+            endmember_usagepenalty=endmember_usagepenalty)
+        orig_resid = apply_A(orig_vars_soln, omp_A) - omp_b
+        lp_kwargs["upper_resids"] = orig_resid
+        lp_kwargs["lower_resids"] = orig_resid
+        num_converted_variables = lp_kwargs["num_converted_variables"]
+        num_endmembers = self.endmember_fractions.shape[1]
+        num_vars, num_params = omp_A.shape[-2:]
+        assert len(np.shape(obj_weights))==1
+        assert len(obj_weights) == num_vars
+
+        nullspace = (self.ompa_problem.get_nullspace(
+                        M=omp_A[:num_endmembers], R=omp_A[num_endmembers:])
+                     if omp_A.ndim==2 else None)
+        if (formulation=="auto"):
+            #compare the sizes of each observation's constraint block
+            formulation = ("nullspace" if (nullspace is not None and
+                nullspace.shape[1]*(num_vars+1) <= num_vars*(2*num_params+2))
+                else "residual_limits")
+        assert (formulation=="residual_limits" or nullspace is not None), (
+            "Solutions with per-observation endmember matrices don't share"
+            +" a nullspace; use formulation='residual_limits'")
+        report.add_phase_time("A_assembly", time.time()-setup_start)
+
+        if (nullspace is not None and nullspace.shape[1]==0):
+            log_info("The nullspace is empty, so the original solution is"
+                     +" the only one")
+            new_endmem_fracs = self.endmember_fractions
+            new_converted_vars = self.converted_variables
+            new_resid = self.param_residuals
+            perobs_obj = orig_vars_soln@obj_weights
+        else:
+            log_info("Solving the", formulation, "formulation"
+                     +(" (nullspace dims: "+str(nullspace.shape[1])+")"
+                       if nullspace is not None else ""))
+            if (formulation=="nullspace"):
+                new_vars_soln, best_signcombo_idxs, found =\
+                    batched_nullspace_lp(obj_weights=obj_weights,
+                        nullspace=nullspace, orig_x=orig_vars_soln,
+                        num_converted_variables=num_converted_variables,
+                        signcombos_to_try=lp_kwargs["signcombos_to_try"],
+                        usagepenalty=endmember_usagepenalty,
+                        chunk_size=lp_chunk_size, report=report)
+            else:
+                new_vars_soln, best_signcombo_idxs, found =\
+                    batched_residual_limit_lp(obj_weights=obj_weights,
+                        chunk_size=lp_chunk_size, report=report, **lp_kwargs)
+            postprocessing_start = time.time()
+            (new_endmem_fracs, new_converted_vars,
+             new_resid, perobs_obj) = self.finish_lp_soln(
+                new_vars_soln=new_vars_soln,
+                best_signcombo_idxs=best_signcombo_idxs, found=found,
+                orig_vars_soln=orig_vars_soln, omp_A=omp_A, omp_b=omp_b,
+                obj_weights=obj_weights,
+                num_converted_variables=num_converted_variables,
+                signcombos_to_try=lp_kwargs["signcombos_to_try"])
+            report.add_phase_time("postprocessing",
+                                  time.time()-postprocessing_start)
+
+        new_ompasoln = self.build_ambiguity_soln(
+            endmember_fractions=new_endmem_fracs,
+            converted_variables=new_converted_vars,
+            param_residuals=new_resid, perobs_obj=perobs_obj,
+            retain_original_penalties=retain_original_penalties,
+            report=report)
+        report.finish()
+        return new_ompasoln
+
+    def sample_feasible_solutions(self, max_resids, num_samples=100,
+                                  burn_in=100, thin=10, quantiles=None,
+                                  retain_original_penalties=True, seed=None,
+                                  report=None):
+        """
+            Draws num_samples solutions per observation, (asymptotically)
+            uniformly from the set of solutions that satisfy the
+            constraints of core_quantify_ambiguity_via_residual_limits
+            (residual caps, usage penalty cap, sum-to-one, nonnegative
+            fractions and converted variable signs), with a hit-and-run
+            sampler that advances the chains of all observations together
+            (see ambiguity.hit_and_run_sample). The chains start from this
+            solution; burn_in steps are discarded and a sample is kept
+            every thin steps. Converted variables move in steps scaled so
+            that their effect on the predictions is comparable to that of
+            the endmember fractions.
+            Returns an array with dims of observations X num_samples X
+            vars, or, if quantiles (a list of quantiles between 0 and 1)
+            are given, the quantiles of the samples with dims of quantiles
+            X observations X vars. The vars are the endmember fractions
+            (in the order of endmember_names) and then the converted
+            variables.
+        """
+        report = (SolveReport(keep_solver_calls=False) if report is None
+                  else report)
+        setup_start = time.time()
+        endmember_usagepenalty = (
+            self.ompa_problem.prep_endmember_usagepenalty_mat(
+                self.endmember_names) if retain_original_penalties else None)
+        omp_A, orig_vars_soln, lp_kwargs = self.prep_residual_limit_lp(
+            max_resids=max_resids, omp_b=self.ompa_problem.get_b(),
+            endmember_usagepenalty=endmember_usagepenalty)
+        num_endmembers = self.endmember_fractions.shape[1]
+        #a unit change in a converted variable moves the predictions by its
+        # conversion ratio row; scale it to the spread of the endmembers
+        endmember_spread = np.linalg.norm(
+            np.std(omp_A[..., :num_endmembers, :], axis=-2), axis=-1)
+        converted_var_scales = (np.asarray(endmember_spread)[...,None]/
+            np.linalg.norm(omp_A[..., num_endmembers:, :], axis=-1))
+        var_scales = np.concatenate([
+            np.ones((len(orig_vars_soln), num_endmembers)),
+            np.broadcast_to(converted_var_scales,
+                (len(orig_vars_soln), converted_var_scales.shape[-1]))],
+            axis=1)
+        report.add_phase_time("A_assembly", time.time()-setup_start)
+
+        with report.phase("sampling"):
+            samples = hit_and_run_sample(x0=orig_vars_soln,
+                var_scales=var_scales, num_samples=num_samples,
+                burn_in=burn_in, thin=thin,
+                rng=np.random.RandomState(seed), **lp_kwargs)
+        if (quantiles is not None):
+            samples = np.quantile(samples, quantiles, axis=1)
+        report.finish()
+        return samples
+
+    def append_observations(self, new_obs_df, **solve_kwargs):
+        """
+            Incremental mode for growing data sets (e.g. a glider
+            deployment that gains rows at every surfacing): solves only
+            new_obs_df, with the same problem settings and endmembers, and
+            appends the new rows and their solutions to this solution (and
+            its ompa_problem) in place. The arrays are over-allocated as
+            they grow, so each update costs time proportional to the number
+            of new rows. After the first update, obs_df is indexed by
+            position. solve_kwargs are passed on to OMPAProblem.solve.
+            Returns the solution for the new rows alone.
+        """
+        new_soln = self.ompa_problem.get_problem_for_new_obs(
+            new_obs_df).solve(endmember_df=self.endmember_df,
+                endmember_name_column=self.endmember_name_column,
+                **solve_kwargs)
+        self.extend(new_soln)
+        return new_soln
+
+    def extend(self, new_soln):
+        #Appends the rows of new_soln (a solution of the same problem for
+        # other observations) in place
+        if (hasattr(self, "growable_buffers")==False):
+            self.growable_buffers = {}
+        #sizes of the buffers before this call, to roll back to on failure
+        old_sizes = {}
+
+        def grow(key, current, new):
+            if (key not in self.growable_buffers):
+                self.growable_buffers[key] = (
+                    GrowableDataFrame(current)
+                    if isinstance(current, pd.DataFrame)
+                    else GrowableArray(current))
+            old_sizes[key] = self.growable_buffers[key].size
+            self.growable_buffers[key].append(new)
+            return self.growable_buffers[key].view()
+
+        if ("obs_df" not in self.growable_buffers):
+            self.growable_buffers["obs_df"] = GrowableDataFrame(self.obs_df)
+        #drop the references to the old view of obs_df, so that pandas can
+        # write the new rows into the buffer without copying it
+        self.obs_df = None
+        if (self.ompa_problem is not None):
+            self.ompa_problem.obs_df = None
+        #All the buffers are grown before any other attribute is set, so
+        # that a failed append leaves the solution unchanged
+        try:
+            obs_df = grow("obs_df", None, new_soln.obs_df)
+            attr_to_view = OrderedDict()
+            for attr in ["endmember_fractions", "converted_variables",
+                         "param_residuals", "perobs_weighted_resid_sq"]:
+                if (getattr(self, attr, None) is not None):
+                    attr_to_view[attr] = grow(attr, getattr(self, attr),
+                                              getattr(new_soln, attr))
+            groupname_to_totalconvertedvariable = OrderedDict()
+            groupname_to_effectiveconversionratios = OrderedDict()
+            for groupname in self.groupname_to_totalconvertedvariable:
+                groupname_to_totalconvertedvariable[groupname] = grow(
+                    ("totalconvertedvariable", groupname),
+                    self.groupname_to_totalconvertedvariable[groupname],
+                    new_soln.groupname_to_totalconvertedvariable[groupname])
+                ratios = self.groupname_to_effectiveconversionratios[
+                          groupname]
+                groupname_to_effectiveconversionratios[groupname] =\
+                    OrderedDict(
+                     (param_name, grow(
+                       ("effectiveconversionratio", groupname, param_name),
+                       ratios[param_name],
+                       new_soln.groupname_to_effectiveconversionratios[
+                        groupname][param_name]))
+                     for param_name in ratios)
+            endmembername_to_usagepenalty = OrderedDict(
+                (endmembername, grow(
+                  ("usagepenalty", endmembername),
+                  self.endmembername_to_usagepenalty[endmembername],
+                  new_soln.endmembername_to_usagepenalty[endmembername]))
+                for endmembername in self.endmembername_to_usagepenalty)
+        except Exception:
+            for key, size in old_sizes.items():
+                self.growable_buffers[key].size = size
+            obs_df = self.growable_buffers["obs_df"].view()
+            self.obs_df = obs_df
+            if (self.ompa_problem is not None):
+                self.ompa_problem.obs_df = obs_df
+            raise
 
-    #def core_quantify_ambiguity_via_nullspace(self, obj_weights, verbose=False):
-    #    #obj_weights should be an array of weights that define the objective
-    #    # of the linear program, in the form "o @ (s + N(A) @ v)" (where
-    #    # o is the objective, s is the solution, N(A) is the null space of A)
-
-    #    #For each soln s (length "num_endmem + num_conv_ratios"), the
-    #    # relevant linear programming constraints are
-    #    #For rows pertaining to end member fractions:
-    #    # "s + N(A) @ v >= 0" for endmember usgae
-    #    # "s + N(A) @ v >= 0" OR "s + N(A) v <= 0" for oxygen usage 
-    #    # (the 'or' means our solution space will basically contain two
-    #    #  polytopes that may be disconnected (if there are multiple
-    #    #  remin ratios; one polytope for positive and one for
-    #    #  negative oxygen usage)
-    #    #If there are any points with nonzero endmember usage constraints,
-    #    # we can further add the constraint that P @ (N(A) @ v) = 0
-
-    #    #Notes on how to determine the full feasible set (time complexity
-    #    # seems to increase exponentially:)
-    #    #If we are in |v| dimensional space, then the intersection of
-    #    # |v| nonredundant equality constraints will define the corners. 
-    #    #The available equality constraints are:
-    #    # num_endmem constraints of the form endmem == 0
-    #    # num_endmem constraints of the form endmem == 1
-    #    # num_convratio constraints of the form endmem == 0
-    #    # optionally one more constraint if there are nonzero usage penalties
-    #    #Full solution:
-    #    #From the (2*num_endmem + num_convratio + 1?) equations, we have
-    #    # to check all (2*num_endmem + num_convratio + 1?)-choose-|v| subsets
-    #    #Then for each subset, we need to solve the equation, and check
-    #    # whether the solution satisfies the remaining constraints.
-    #    #If the solution has negative O usage (has to be neg for all
-    #    # conv ratios), we store the point in the negative O usage polytope;
-    #    # otherwise, we store the point in the positive O usage polytope
-    #    #We would then return the two polytopes
-   
-    #    #In practice, however, we are probably interested in quantifying the
-    #    # limits of something (e.g. max and min values of an end member, or
-    #    # max/min amounts of a tracer that could be explained by mixing),
-    #    # in which case it is not necessary to solve for the full convex
-    #    # polytope; the problem can just be solved as a linear program
-
-    #    endmember_names = self.endmember_names
-    #    endmember_usagepenalty =\
-    #        self.ompa_problem.prep_endmember_usagepenalty_mat(endmember_names)
-
-    #    #For each observation, we can solve the linear program
-    #    new_perobs_endmember_fractions = []
-    #    new_perobs_converted_vars = []
-    #    perobs_obj = []
-    #    for obs_idx in range(len(self.endmember_fractions)):
-    #        endmem_fracs = self.endmember_fractions[obs_idx] 
-    #        assert len(endmem_fracs)==len(endmember_names)
-    #        converted_vars = self.converted_variables[obs_idx] 
-    #        usagepenalty = endmember_usagepenalty[obs_idx]
-
-    #        assert len(usagepenalty) == len(endmem_fracs)
-    #        #assert ((len(endmem_fracs) + len(converted_vars))
-    #        #        == self.nullspace_A.shape[0])
-    #        #assert len(obj_weights) == self.nullspace_A.shape[0]
-
-    #        def compute_soln(converted_vars_signs):
-
-    #            c = (obj_weights @ self.nullspace_A)
-
-    #            A_ub = np.concatenate([
-    #               -(self.nullspace_A[:len(endmem_fracs)]),
-    #               -(converted_vars_signs[:,None]
-    #                 *self.nullspace_A[len(endmem_fracs):]),
-    #               usagepenalty[None,:]@self.nullspace_A[:len(endmem_fracs)]
-    #              ], axis=0)
-    #            b_ub = np.array(
-    #                    (list(endmem_fracs)
-    #                     +list(converted_vars*converted_vars_signs)
-    #                     +[np.sum(endmem_fracs*usagepenalty)]
-    #                    )) 
-
-    #            #print("condition number", np.linalg.cond(A_ub))
-
-    #            #A_eq constraint should be redundant with nullspace,
-    #            # but putting it in to be safe.
-    #            A_eq = (usagepenalty[None,:] @
-    #                    self.nullspace_A[:len(endmem_fracs)])
-    #            b_eq = 0
-
-    #            res = scipy.optimize.linprog(c=c, A_ub=A_ub, b_ub=b_ub,
-    #                                         A_eq=A_eq, b_eq=b_eq,
-    #                                         bounds=(-1e7,1e7),
-    #                                         options={'autoscale':True,
-    #                                                  'lstsq':True}
-    #                                        ) 
-
-    #            if (res.success == False):
-    #                fun = np.inf
-    #            else:
-    #                fun = res.fun
-
-    #            v = res.x
-
-    #            endmem_frac_deltas = self.nullspace_A[:len(endmem_fracs)] @ v
-    #            new_endmem_fracs = (endmem_fracs + endmem_frac_deltas)
-    #            new_converted_vars = (converted_vars
-    #              + self.nullspace_A[len(endmem_fracs):] @ v)
-
-    #            assert np.abs(np.sum(new_endmem_fracs) - 1) < 1e-7,\
-    #                   (np.abs(np.sum(new_endmem_fracs) - 1),
-    #                    new_endmem_fracs,
-    #                    np.sum(new_endmem_fracs), v)
-
-    #            return ((new_endmem_fracs, new_converted_vars),
-    #                    fun) #soln and optimal value
-
-    #        if (self.nullspace_A.shape[1] > 0):
-    #            signcombos_to_try =\
-    #                self.ompa_problem.get_convertedvariable_signcombos_to_try()
-    #            solns = []
-    #            objs = []
-    #            for signcombo in signcombos_to_try:
-    #                soln, obj = compute_soln(signcombo)
-    #                solns.append(soln)
-    #                objs.append(obj)
-    #            new_endmem_fracs, new_converted_vars = solns[np.argmin(objs)]
-    #            assert new_endmem_fracs is not None
-    #            #fix any numerical issues with soln
-    #            new_endmem_fracs = np.maximum(new_endmem_fracs, 0)
-    #            new_endmem_fracs = new_endmem_fracs/(np.sum(new_endmem_fracs))
-
-    #            best_sign_combo = signcombos_to_try[np.argmin(objs)]
-    #            new_converted_vars = best_sign_combo*np.maximum(
-    #                                 (best_sign_combo*new_converted_vars), 0.0)
-    #        else:
-    #            new_endmem_fracs = endmem_fracs
-    #            new_converted_vars = converted_vars
-
-    #        obj = obj_weights@np.concatenate(
-    #               [new_endmem_fracs, new_converted_vars], axis=0) 
-
-    #        new_perobs_endmember_fractions.append(new_endmem_fracs)
-    #        new_perobs_converted_vars.append(new_converted_vars)
-    #        perobs_obj.append(obj) 
-
-    #    return (np.array(new_perobs_endmember_fractions),
-    #            np.array(new_perobs_converted_vars),
-    #            np.array(perobs_obj))
+        self.obs_df = obs_df
+        if (self.ompa_problem is not None):
+            self.ompa_problem.obs_df = obs_df
+        for attr, view in attr_to_view.items():
+            setattr(self, attr, view)
+        for groupname, view in groupname_to_totalconvertedvariable.items():
+            self.groupname_to_totalconvertedvariable[groupname] = view
+            self.groupname_to_effectiveconversionratios[groupname].update(
+                groupname_to_effectiveconversionratios[groupname])
+        #(shared with ompa_problem)
+        self.endmembername_to_usagepenalty.update(
+            endmembername_to_usagepenalty)
+
+        if (hasattr(self, "resid_wsumsq")):
+            self.resid_wsumsq += new_soln.resid_wsumsq
+        if (new_soln.status=="infeasible"):
+            self.status = "infeasible"
+
+    def refine_endmembers(self, **kwargs):
+        #kwargs are passed on to OMPAProblem.refine_endmembers
+        return self.ompa_problem.refine_endmembers(
+            endmember_df=self.endmember_df,
+            endmember_name_column=self.endmember_name_column,
+            init_soln=self, **kwargs)
 
     def iteratively_refine_ompa_soln(self, num_iterations):
         init_endmember_df = self.ompa_problem.construct_ideal_endmembers(
@@ -664,6 +1178,68 @@ class ConvertedParamGroup(object):
         return conversion_ratios_dict
 
 
+#Max number of compiled cvxpy problems kept per OMPAProblem; each distinct
+# batch shape (e.g. the shorter final batch) or A matrix takes one slot
+CORE_PROBLEM_CACHE_SIZE = 8
+#Relative strength of the ridge that keeps the endmember update well posed
+# (e.g. for endmembers that no observation uses); it pulls towards the
+# current endmember matrix, so it never increases the objective
+ENDMEMBER_RIDGE = 1e-8
+
+
+class ParametrizedCoreProblem(object):
+    """
+        DPP-compliant cvxpy version of the problem in OMPAProblem.core_solve
+        (without smoothness) for a fixed batch shape and A matrix. b, the
+        usage penalties and the converted variable sign constraints are
+        cp.Parameters, so after the first solve cvxpy reuses the cached
+        canonicalization and only repopulates the parameter values.
+    """
+    def __init__(self, A, num_obs, num_converted_variables,
+                       sumtooneconstraint):
+        num_endmembers = len(A)-num_converted_variables
+        self.num_converted_variables = num_converted_variables
+        self.x = cp.Variable(shape=(num_obs, len(A)))
+        self.b = cp.Parameter(shape=(num_obs, A.shape[1]))
+        self.endmember_usagepenalty = cp.Parameter(
+                                        shape=(num_obs, num_endmembers))
+        obj = cp.Minimize(cp.sum_squares(self.x@A - self.b) +
+                cp.sum_squares(cp.atoms.affine.binary_operators.multiply(
+                            self.x[:,:num_endmembers],
+                            self.endmember_usagepenalty)))
+        constraints = [self.x[:,:num_endmembers] >= 0]
+        if (sumtooneconstraint):
+            constraints.append(cp.sum(self.x[:,:num_endmembers],axis=1)==1)
+        if (num_converted_variables > 0):
+            self.conversion_sign_constraints = cp.Parameter(
+                    shape=(num_obs, num_converted_variables))
+            constraints.append(
+              cp.atoms.affine.binary_operators.multiply(
+                  self.conversion_sign_constraints,
+                  self.x[:,num_endmembers:]) >= 0)
+        else:
+            self.conversion_sign_constraints = None
+        self.prob = cp.Problem(obj, constraints)
+        assert self.prob.is_dpp()
+
+    @staticmethod
+    def get_cache_key(A, num_obs, num_converted_variables,
+                      sumtooneconstraint):
+        A = np.ascontiguousarray(A, dtype=float)
+        return (num_obs, A.shape, num_converted_variables, sumtooneconstraint,
+                hashlib.sha1(A.tobytes()).hexdigest())
+
+    def solve(self, b, endmember_usagepenalty, conversion_sign_constraints,
+                    max_iter, verbose=False):
+        self.b.value = b
+        self.endmember_usagepenalty.value = endmember_usagepenalty
+        if (self.num_converted_variables > 0):
+            self.conversion_sign_constraints.value =\
+                conversion_sign_constraints
+        self.prob.solve(verbose=verbose, max_iter=max_iter)
+        return self.x.value, self.prob
+
+
 class OMPAProblem(object):
     """
         Core class for conducting OMPA analysis using cvxpy
@@ -675,7 +1251,12 @@ class OMPAProblem(object):
                        endmembername_to_usagepenaltyfunc={},
                        smoothness_lambda=None,
                        sumtooneconstraint=True,
-                       standardize_by_watertypes=False):
+                       standardize_by_watertypes=False,
+                       smoothness_time_column=None):
+        #If smoothness_time_column is specified (e.g. the sample time or
+        # along-track distance of glider data), smoothness is applied between
+        # consecutive observations ordered by that column, rather than
+        # between nearest neighbours in space
         self.obs_df = obs_df
         self.param_names = param_names
         self.convertedparam_groups = convertedparam_groups
@@ -692,11 +1273,19 @@ class OMPAProblem(object):
         self.param_weightings = param_weightings
 
         self.smoothness_lambda = smoothness_lambda
+        self.smoothness_time_column = smoothness_time_column
+        if (smoothness_time_column is not None):
+            assert smoothness_time_column in obs_df, (
+                smoothness_time_column+" not in observations data frame;"
+                +" columns are "+str(list(obs_df.columns)))
         self.endmembername_to_usagepenaltyfunc =\
           endmembername_to_usagepenaltyfunc
         self.process_params()
         self.prep_endmember_usagepenalties() 
         self.sumtooneconstraint = sumtooneconstraint #apply hard contraint
+        self.core_problem_cache = OrderedDict()
+        #timings and solver statistics; replaced at the start of every solve
+        self.solve_report = SolveReport()
 
     def process_params(self):
 
@@ -713,20 +1302,20 @@ class OMPAProblem(object):
 
         with_drop_na = self.obs_df.dropna(subset=self.param_names)
         if (len(with_drop_na) < len(self.obs_df)):
-            print("Dropping "+str(len(self.obs_df)-len(with_drop_na))
-                  +" rows that have NA values in the observations")
+            log_info("Dropping "+str(len(self.obs_df)-len(with_drop_na))
+                     +" rows that have NA values in the observations")
             self.obs_df = with_drop_na
 
         if (max(self.param_weightings.values()) > 100):
-            print("Warning: having very large param weights can lead to"
-                  +" instability in the optimizer! Consider scaling down"
-                  +" your weights")
+            log_warning("Warning: having very large param weights can lead to"
+                        +" instability in the optimizer! Consider scaling down"
+                        +" your weights")
 
     def prep_endmember_usagepenalties(self):
         self.endmembername_to_usagepenalty = OrderedDict()
         for endmembername, penalty_func in\
          self.endmembername_to_usagepenaltyfunc.items():
-            print("Adding penalty for",endmembername)
+            log_info("Adding penalty for",endmembername)
             penalty = penalty_func(self.obs_df)
             self.endmembername_to_usagepenalty[endmembername] = penalty
 
@@ -749,8 +1338,8 @@ class OMPAProblem(object):
                           +": "+endmembernameprefix+" and "
                           +prefix_mapping[endmembername])
                         prefix_mapping[endmembername] = endmembernameprefix
-                        print("Found match between "+endmembername
-                              +" and prefix "+endmembernameprefix)
+                        log_info("Found match between "+endmembername
+                                 +" and prefix "+endmembernameprefix)
 
         for endmemberidx,endmembername in enumerate(endmember_names):
             if endmembername in self.endmembername_to_usagepenalty:
@@ -770,8 +1359,8 @@ class OMPAProblem(object):
         #print a warning if specified a usage penalty that was not used
         for endmembername in unmatched_penaltyendmembernames:
             if endmembername not in endmember_names:
-                print("---WARNING!---")
-                print("You specified a usage penalty for "
+                log_info("---WARNING!---")
+                log_info("You specified a usage penalty for "
                  +endmembername+" but that endmember did not appear "
                  +"in the endmember data frame used here; endmembers are "
                  +str(endmember_names))
@@ -817,6 +1406,102 @@ class OMPAProblem(object):
         cartprod = list(itertools.product(*to_take_cartprod_of))
         return [np.array(list(itertools.chain(*x))) for x in cartprod] 
 
+    def get_relaxed_convertedvariable_signs(self):
+        #sign constraints where '0' (no constraint) is used for every group
+        # that is not always positive
+        return np.array(list(itertools.chain(*[
+            [(1 if convertedparam_group.always_positive else 0)
+             for x in convertedparam_group.conversion_ratios]
+            for convertedparam_group in self.convertedparam_groups])))
+
+    def get_consistent_convertedvariable_signs(self, converted_variables,
+                                               tol=1e-6):
+        #For each observation, find the sign combo (if any) that the
+        # converted variables already satisfy, i.e. where all the variables
+        # in each group share a sign (up to a relative tolerance).
+        #Returns the sign combos and a boolean array that is False for the
+        # observations with mixed signs within a group.
+        signcombos = np.ones(converted_variables.shape)
+        is_consistent = np.ones(len(converted_variables), dtype=bool)
+        thresh = tol*np.maximum(
+                    np.max(np.abs(converted_variables), axis=-1), 1.0)
+        convar_idx = 0
+        for convertedparam_group in self.convertedparam_groups:
+            num_ratios = len(convertedparam_group.conversion_ratios)
+            convar_vals = converted_variables[:,
+                            convar_idx:convar_idx+num_ratios]
+            if (convertedparam_group.always_positive==False):
+                nonneg = np.all(convar_vals >= -thresh[:,None], axis=-1)
+                nonpos = np.all(convar_vals <= thresh[:,None], axis=-1)
+                signcombos[:, convar_idx:convar_idx+num_ratios] =\
+                    np.where(nonneg, 1, -1)[:,None]
+                is_consistent = is_consistent & (nonneg | nonpos)
+            convar_idx += num_ratios
+        return signcombos, is_consistent
+
+    def get_parametrized_core_problem(self, A, num_obs,
+                                            num_converted_variables):
+        #Compiled problems are reused across batches, sign combos and
+        # repeated solve calls; least recently used ones are evicted
+        key = ParametrizedCoreProblem.get_cache_key(
+                A=A, num_obs=num_obs,
+                num_converted_variables=num_converted_variables,
+                sumtooneconstraint=self.sumtooneconstraint)
+        if key in self.core_problem_cache:
+            self.core_problem_cache.move_to_end(key)
+            return self.core_problem_cache[key]
+        core_problem = ParametrizedCoreProblem(
+            A=A, num_obs=num_obs,
+            num_converted_variables=num_converted_variables,
+            sumtooneconstraint=self.sumtooneconstraint)
+        self.core_problem_cache[key] = core_problem
+        while (len(self.core_problem_cache) > CORE_PROBLEM_CACHE_SIZE):
+            self.core_problem_cache.popitem(last=False)
+        return core_problem
+
+    def get_worker_copy(self, keep_obs=False):
+        #shallow copy for shipping to worker processes; drops the
+        # observation-sized attributes (unless keep_obs is True, for a
+        # worker that calls solve), penalty functions and compiled cvxpy
+        # problems, which core_solve doesn't need
+        worker_copy = copy.copy(self)
+        if (keep_obs==False):
+            worker_copy.obs_df = None
+            worker_copy.endmembername_to_usagepenalty = OrderedDict()
+            worker_copy.endmember_usagepenalty = None
+        #the penalty functions are closures, which can't be pickled
+        worker_copy.endmembername_to_usagepenaltyfunc = {}
+        worker_copy.core_problem_cache = OrderedDict()
+        worker_copy.solve_report = SolveReport()
+        return worker_copy
+
+    def get_problem_for_obs_subset(self, row_idxs):
+        #Copy of this problem restricted to the observations at positions
+        # row_idxs of obs_df, reusing the usage penalties already computed
+        # for them (so the penalty functions aren't needed)
+        subset_problem = copy.copy(self)
+        subset_problem.obs_df = self.obs_df.iloc[row_idxs]
+        subset_problem.endmembername_to_usagepenalty = OrderedDict([
+            (endmembername, np.asarray(penalty)[row_idxs])
+            for endmembername, penalty
+            in self.endmembername_to_usagepenalty.items()])
+        subset_problem.endmember_usagepenalty = None
+        subset_problem.solve_report = SolveReport()
+        return subset_problem
+
+    def get_problem_for_new_obs(self, new_obs_df):
+        #Copy of this problem (sharing the compiled problem cache) for the
+        # observations in new_obs_df, e.g. rows appended to a deployment
+        assert self.smoothness_lambda is None, (
+            "Solving new observations separately is not supported with"
+            +" smoothness_lambda, since the smoothness penalty couples the"
+            +" observations")
+        new_problem = copy.copy(self)
+        new_problem.obs_df = new_obs_df
+        new_problem.process_params()
+        new_problem.prep_endmember_usagepenalties()
+        return new_problem
+
     def get_endmem_mat(self, endmember_df):
         return np.array(endmember_df[self.param_names])
 
@@ -839,9 +1524,21 @@ class OMPAProblem(object):
             assert np.allclose(mat.dot(ns), 0)
         return ns
 
-    def solve(self, endmember_df, endmember_name_column, batch_size=None,
-                    max_iter=100000, verbose=False):
-
+    def get_A_settings_key(self):
+        #everything besides the endmember df that goes into prep_A
+        return (tuple(self.param_names),
+                tuple(self.get_param_weighting()),
+                tuple(map(tuple, self.get_conversion_ratio_rows_of_A())),
+                self.standardize_by_watertypes)
+
+    def prep_A(self, endmember_df, endmember_name_column):
+        #Returns an OrderedDict with the endmember names, the weighted (and,
+        # if standardize_by_watertypes, standardized) A, the original A used
+        # to compute residuals in the original parameter space, the
+        # conversion ratio rows and the standardization statistics and
+        # weighting that also have to be applied to b. It only depends on
+        # endmember_df and get_A_settings_key(), so it can be precomputed
+        # and passed to solve as prepped_A
         for param_name in self.param_names:
             assert param_name in endmember_df,\
                 (param_name+" not specified in endmember_df where columns are "
@@ -853,14 +1550,9 @@ class OMPAProblem(object):
             +"with _subtype). The endmember names are: "+str(endmember_names))
         endmember_idx_mapping = get_endmember_idx_mapping(
             endmember_names=endmember_names)
-        print("Endmember-idx mapping is\n",endmember_idx_mapping)
+        log_info("Endmember-idx mapping is\n",endmember_idx_mapping)
 
         weighting = self.get_param_weighting() 
-        smoothness_lambda = self.smoothness_lambda
-
-        endmember_usagepenalty =\
-            self.prep_endmember_usagepenalty_mat(endmember_names)
-        self.endmember_usagepenalty = endmember_usagepenalty
 
         #Prepare A
         conversion_ratio_rows = self.get_conversion_ratio_rows_of_A()
@@ -872,6 +1564,8 @@ class OMPAProblem(object):
         else:
             A = endmem_mat
 
+        param_mean = None
+        param_std = None
         if (self.standardize_by_watertypes):
             param_mean = np.mean(endmem_mat, axis=0) 
             #if std is inf, set to 1
@@ -880,96 +1574,465 @@ class OMPAProblem(object):
             param_std[mass_idxs] = 1.0
             #Assume that the entry with std of 0 is also the one that has
             # mass in it
-            print("I'm assuming that the index encoding mass is:",
-                  mass_idxs)
+            log_info("I'm assuming that the index encoding mass is:",
+                     mass_idxs)
             if (len(mass_idxs) > 1):
                 raise RuntimeError("Multiple indices in source water type"
                 +" matrix have 0 std...I need to be told which one"
                 +" is 'mass' "+str(endmem_mat))
             param_mean[mass_idxs] = 0.0
-            print("Std used for normalization:",param_std)
-            print("Mean used for normalization:",param_mean)
+            log_info("Std used for normalization:",param_std)
+            log_info("Mean used for normalization:",param_mean)
 
         ##compute the nullspace of A - will be useful for disentangling
         ## ambiguity in the solution
         #nullspace_A = self.get_nullspace(M=endmem_mat,
         #                                 R=conversion_ratio_rows)
 
-        #prepare b
-        b = self.get_b()
-        if (batch_size is None):
-            batch_size = len(b)
-        
         #Rescale by param weighting
-        print("params to use:", self.param_names)        
-        print("param weighting:", weighting)
+        log_info("params to use:", self.param_names)        
+        log_info("param weighting:", weighting)
         if (self.standardize_by_watertypes):
             weighting = weighting/param_std
-            print("effective weighting:", weighting)
+            log_info("effective weighting:", weighting)
         orig_A = A.copy()
-        orig_b = b
         if (self.standardize_by_watertypes):
             A[:len(endmem_mat)] = A[:len(endmem_mat)] - param_mean[None,:]
-            b = b-param_mean[None,:]
         A = A*weighting[None,:]
-        b = b*weighting[None,:]
 
-        print("Matrix A:")
+        log_info("Matrix A:")
+
+        return OrderedDict([
+            ("endmember_names", endmember_names), ("A", A),
+            ("orig_A", orig_A),
+            ("conversion_ratio_rows", conversion_ratio_rows),
+            ("param_mean", param_mean), ("param_std", param_std),
+            ("weighting", weighting)])
+
+    def prep_A_and_b(self, endmember_df, endmember_name_column,
+                           prepped_A=None):
+        #Returns the endmember names, the weighted (and, if
+        # standardize_by_watertypes, standardized) A and b, and the original
+        # A and b used to compute residuals in the original parameter space.
+        #prepped_A is the (precomputed) output of prep_A for endmember_df
+        if (prepped_A is None):
+            prepped_A = self.prep_A(endmember_df=endmember_df,
+                                    endmember_name_column=endmember_name_column)
 
-        if (smoothness_lambda is not None):
-            pairs_matrix = make_pairs_matrix(
-              obs_df=self.obs_df,
-              depth_metric="depth",
-              depth_scale=1.0,
-              nneighb=4)
+        #prepare b
+        b = self.get_b()
+        orig_b = b
+        if (self.standardize_by_watertypes):
+            b = b-prepped_A["param_mean"][None,:]
+        b = b*prepped_A["weighting"][None,:]
+
+        return (prepped_A["endmember_names"], prepped_A["A"].copy(), b,
+                prepped_A["orig_A"], orig_b)
+
+    def solve(self, endmember_df, endmember_name_column, batch_size=None,
+                    max_iter=100000, verbose=False, engine="cvxpy",
+                    n_jobs=None, executor=None, screen=False,
+                    smoothness_partition_size=None, admm_max_iter=200,
+                    report=None, report_json=None, cache=None,
+                    prepped_A=None):
+        #engine is either "cvxpy" (one cvxpy problem per batch), "native"
+        # (a vectorized NumPy active-set solver) or "enumerate" (exact
+        # support enumeration for small endmember sets, which falls back to
+        # "native" when there are too many variables). The last two can't
+        # solve the smoothness-regularized problem itself, but can provide
+        # the starting point for the partitioned solve below.
+        #Batches are spread over a process pool if n_jobs > 1 or if a
+        # concurrent.futures executor is supplied (batch_size then defaults
+        # to splitting the observations evenly over the n_jobs workers, and
+        # must be given with an executor)
+        #If screen is True, observations whose closed-form (equality
+        # constrained least squares) solution already satisfies every
+        # constraint are accepted without going to the engine
+        #With smoothness, setting smoothness_partition_size splits the
+        # observations into spatial partitions of about that size, with
+        # overlapping halos, that are reconciled by consensus ADMM (at most
+        # admm_max_iter iterations) instead of solving one big problem
+        #Timings per phase, solver statistics and peak memory are collected
+        # in report (a new SolveReport if not specified), which is attached
+        # to the solution as solve_report and written to the report_json
+        # file if specified
+        #cache is an optional SolveCache; observations already in it are
+        # not re-solved (not supported with smoothness)
+        #prepped_A is an optional precomputed output of prep_A for
+        # endmember_df (e.g. shared between the problems of a thermocline
+        # array)
+        assert engine in ("cvxpy", "native", "enumerate"), (
+            "engine should be 'cvxpy', 'native' or 'enumerate'; got "
+            +str(engine))
+        if (engine!="cvxpy"):
+            assert (self.smoothness_lambda is None
+                    or smoothness_partition_size is not None
+                    or self.smoothness_time_column is not None), (
+                "The "+engine+" engine does not support smoothness_lambda"
+                +" unless smoothness_partition_size or"
+                +" smoothness_time_column is set")
+        assert cache is None or self.smoothness_lambda is None, (
+            "Caching is not supported with smoothness_lambda, since the"
+            +" smoothness penalty couples the observations")
+
+        report = SolveReport() if report is None else report
+        self.solve_report = report
+
+        with report.phase("A_assembly"):
+            (endmember_names, A, b, orig_A, orig_b) = self.prep_A_and_b(
+                endmember_df=endmember_df,
+                endmember_name_column=endmember_name_column,
+                prepped_A=prepped_A)
+        if (batch_size is None):
+            assert executor is None, (
+                "Specify batch_size when supplying an executor, otherwise"
+                +" all the observations go to a single worker")
+            #split the rows evenly over the workers, so that every worker
+            # gets a batch
+            batch_size = max(int(np.ceil(len(b)/(n_jobs
+                               if (n_jobs is not None and n_jobs > 1)
+                               else 1))), 1)
+        smoothness_lambda = self.smoothness_lambda
+
+        with report.phase("penalty_prep"):
+            endmember_usagepenalty =\
+                self.prep_endmember_usagepenalty_mat(endmember_names)
+        self.endmember_usagepenalty = endmember_usagepenalty
+        #number of observation solves handled by each path (summed over the
+        # sign combos tried)
+        self.rows_per_solve_path = OrderedDict(
+            ([("closed_form", 0)] if screen else [])+[(engine, 0)])
+
+        if (smoothness_lambda is not None
+            and self.smoothness_time_column is None):
+            with report.phase("pairs_matrix"):
+                pairs_matrix = make_pairs_matrix(
+                  obs_df=self.obs_df,
+                  depth_metric="depth",
+                  depth_scale=1.0,
+                  nneighb=4)
         else:
             pairs_matrix = None
 
+        #Without smoothness, the unsmoothed solution is already the final
+        # one; it is also the starting point of the partitioned and
+        # along-track smoothed solves. The monolithic smoothed solve only
+        # needs the sign combos chosen for the converted variables.
+        if (cache is not None):
+            best_sign_combos = None
+            (x, endmember_fractions, converted_variables,
+             perobs_weighted_resid_sq, status) = self.cached_solve_rows(
+                cache=cache, A=A, b=b,
+                endmember_usagepenalty=endmember_usagepenalty,
+                batch_size=batch_size, max_iter=max_iter, verbose=verbose,
+                engine=engine, n_jobs=n_jobs, executor=executor,
+                screen=screen)
+        elif (self.num_converted_variables > 0
+              or smoothness_lambda is None
+              or smoothness_partition_size is not None
+              or self.smoothness_time_column is not None):
+            (best_sign_combos,
+             (x, endmember_fractions, converted_variables,
+              perobs_weighted_resid_sq, status)) = self.solve_rows(
+                A=A, b=b, endmember_usagepenalty=endmember_usagepenalty,
+                batch_size=batch_size, max_iter=max_iter, verbose=verbose,
+                engine=engine, n_jobs=n_jobs, executor=executor,
+                screen=screen)
+        else:
+            best_sign_combos = None
+
+        smoothed_objective = None
+        if (smoothness_lambda is not None
+            and self.smoothness_time_column is not None):
+            with report.phase("smoothed_solve"):
+                ((x, endmember_fractions, converted_variables,
+                  perobs_weighted_resid_sq, status), smoothed_objective) =\
+                    self.along_track_smoothed_solve(
+                        A=A, b=b, init_x=x,
+                        endmember_usagepenalty=endmember_usagepenalty,
+                        conversion_sign_constraints=best_sign_combos,
+                        smoothness_lambda=smoothness_lambda)
+        elif (smoothness_lambda is not None
+              and smoothness_partition_size is not None):
+            with report.phase("smoothed_solve"):
+                ((x, endmember_fractions, converted_variables,
+                  perobs_weighted_resid_sq, status), smoothed_objective) =\
+                    self.partitioned_smoothed_solve(
+                        A=A, b=b, init_x=x, pairs_matrix=pairs_matrix,
+                        endmember_usagepenalty=endmember_usagepenalty,
+                        conversion_sign_constraints=best_sign_combos,
+                        smoothness_lambda=smoothness_lambda,
+                        partition_size=smoothness_partition_size,
+                        max_iter=max_iter, admm_max_iter=admm_max_iter,
+                        n_jobs=n_jobs)
+        elif (smoothness_lambda is not None):
+            #the smoothness penalty couples the observations, so they are
+            # solved together in one problem
+            (x, endmember_fractions,
+             converted_variables,
+             perobs_weighted_resid_sq, prob) = self.core_solve(
+                A=A, b=b,
+                num_converted_variables=self.num_converted_variables,
+                pairs_matrix=pairs_matrix,
+                endmember_usagepenalty=endmember_usagepenalty,
+                conversion_sign_constraints=best_sign_combos,
+                smoothness_lambda=smoothness_lambda,
+                max_iter=max_iter, verbose=verbose)
+            status = prob.status
+            smoothed_objective = prob.value
+        log_info("Observation solves per path:",
+                 dict(self.rows_per_solve_path))
+
+        if (endmember_fractions is not None):
+            log_info("objective:", np.sum(perobs_weighted_resid_sq))
+
+        with report.phase("postprocessing"):
+            ompa_soln = self.build_soln(endmember_df=endmember_df,
+                  endmember_name_column=endmember_name_column,
+                  endmember_names=endmember_names, x=x,
+                  endmember_fractions=endmember_fractions,
+                  converted_variables=converted_variables,
+                  perobs_weighted_resid_sq=perobs_weighted_resid_sq,
+                  status=status, orig_A=orig_A, orig_b=orig_b,
+                  rows_per_solve_path=self.rows_per_solve_path,
+                  smoothed_objective=smoothed_objective,
+                  solve_report=report)
+        report.finish()
+        log_info(report)
+        if (report_json is not None):
+            report.to_json(report_json)
+        return ompa_soln
+
+    def solve_perobs_endmember_mats(self, endmember_names,
+            perobs_endmember_mat, endmember_available=None, max_iter=100000,
+            report=None, report_json=None):
+        #Solves every observation with its own endmember matrix
+        # (perobs_endmember_mat has dims of observations X endmembers X
+        # params, e.g. interpolated from endmember tables along a
+        # stratification coordinate), all together in one pass of the
+        # native engine. endmember_available (observations X endmembers,
+        # boolean) marks the endmembers each observation may use; the
+        # fractions of the others are held at 0. The per-observation
+        # matrices are attached to the solution as perobs_endmember_mat
+        # (and endmember_available), which the ambiguity analysis uses.
+        assert self.smoothness_lambda is None, (
+            "Per-observation endmember matrices are not supported with"
+            +" smoothness_lambda")
+        assert self.standardize_by_watertypes==False, (
+            "Per-observation endmember matrices are not supported with"
+            +" standardize_by_watertypes")
+        num_obs = len(self.obs_df)
+        assert perobs_endmember_mat.shape==(num_obs, len(endmember_names),
+                                            len(self.param_names)), (
+            "perobs_endmember_mat should have dims of observations X"
+            +" endmembers X params, i.e. "+str((num_obs, len(endmember_names),
+                                                 len(self.param_names)))
+            +"; got "+str(perobs_endmember_mat.shape))
+        if (endmember_available is None):
+            endmember_available = np.ones((num_obs, len(endmember_names)),
+                                          dtype=bool)
+        if (self.sumtooneconstraint):
+            assert np.all(np.any(endmember_available, axis=1)), (
+                "Some observations have no available endmembers: rows "
+                +str(np.nonzero(np.any(endmember_available, axis=1)==False)[0]))
+
+        report = SolveReport() if report is None else report
+        self.solve_report = report
+
+        with report.phase("A_assembly"):
+            conversion_ratio_rows = self.get_conversion_ratio_rows_of_A()
+            #unavailable endmembers are held at 0, so their (possibly NaN)
+            # properties don't matter
+            endmem_mats = np.where(endmember_available[:,:,None],
+                                   perobs_endmember_mat, 0.0)
+            if (len(conversion_ratio_rows) > 0):
+                orig_A = np.concatenate([endmem_mats,
+                    np.tile(conversion_ratio_rows[None,:,:], (num_obs,1,1))],
+                    axis=1)
+            else:
+                orig_A = endmem_mats
+            weighting = self.get_param_weighting()
+            A = orig_A*weighting[None,None,:]
+            orig_b = self.get_b()
+            b = orig_b*weighting[None,:]
+            fixed_zero = np.concatenate([endmember_available==False,
+                np.zeros((num_obs, self.num_converted_variables), dtype=bool)],
+                axis=1)
+        with report.phase("penalty_prep"):
+            endmember_usagepenalty =\
+                self.prep_endmember_usagepenalty_mat(endmember_names)
+        self.endmember_usagepenalty = endmember_usagepenalty
+        self.rows_per_solve_path = OrderedDict([("native", 0)])
+
+        def native_solve(row_idxs, conversion_sign_constraints):
+            solve_start = time.time()
+            x, prob = native_core_solve(A=A[row_idxs], b=b[row_idxs],
+                num_converted_variables=self.num_converted_variables,
+                endmember_usagepenalty=endmember_usagepenalty[row_idxs],
+                conversion_sign_constraints=conversion_sign_constraints,
+                sumtooneconstraint=self.sumtooneconstraint,
+                max_iter=max_iter, fixed_zero=fixed_zero[row_idxs])
+            report.record_solver_call(prob=prob, engine="native",
+                num_obs=len(row_idxs), wall_time=time.time()-solve_start)
+            self.rows_per_solve_path["native"] += len(row_idxs)
+            return x, prob.status
+
+        #As in select_convertedvariable_signs_and_solve, solve with relaxed
+        # sign constraints first and only try every sign combo on the
+        # observations where some group has converted variables of mixed
+        # sign
+        all_idxs = np.arange(num_obs)
         if (self.num_converted_variables > 0):
-            signcombos_to_try = self.get_convertedvariable_signcombos_to_try()
-            perobs_weighted_resid_sq_for_signcombo = []
-            for signcombo in signcombos_to_try:
-                print("Trying convertedvariable sign constraint:",signcombo)
-                _, _, _, perobs_weighted_resid_sq_positiveconversionsign,_ =\
-                  self.batch_core_solve(
-                    A=A, b=b,
-                    num_converted_variables=self.num_converted_variables,
-                    pairs_matrix=None,
-                    endmember_usagepenalty=endmember_usagepenalty,
-                    conversion_sign_constraints=np.tile(
-                        signcombo[None,:], (len(b),1)),
-                    smoothness_lambda=None,
-                    batch_size=batch_size,
-                    max_iter=max_iter,
-                    verbose=verbose)
-                perobs_weighted_resid_sq_for_signcombo.append(
-                    perobs_weighted_resid_sq_positiveconversionsign)
-            #determine which conversion sign is best for each example
-            perobs_weighted_resid_sq_for_signcombo =\
-                np.array(perobs_weighted_resid_sq_for_signcombo) 
-            best_sign_combos = np.array([signcombos_to_try[bestidx]
-               for bestidx in np.argmin(perobs_weighted_resid_sq_for_signcombo,
-                                        axis=0)])
+            relaxed_signs = np.tile(
+                self.get_relaxed_convertedvariable_signs()[None,:],
+                (num_obs,1))
+            x, status = native_solve(all_idxs, relaxed_signs)
+            best_sign_combos, is_consistent =\
+                self.get_consistent_convertedvariable_signs(
+                    x[:, -self.num_converted_variables:])
+            ambiguous_idxs = np.nonzero(is_consistent==False)[0]
+            log_info(len(ambiguous_idxs),"out of",num_obs,"observations have"
+                     +" converted variables of mixed sign; trying sign combos"
+                     +" on those")
+            if (len(ambiguous_idxs) > 0):
+                signcombos_to_try =\
+                    self.get_convertedvariable_signcombos_to_try()
+                best_obj = np.full(len(ambiguous_idxs), np.inf)
+                for signcombo in signcombos_to_try:
+                    signcombo_signs = np.tile(signcombo[None,:],
+                                              (len(ambiguous_idxs),1))
+                    signcombo_x, signcombo_status = native_solve(
+                                    ambiguous_idxs, signcombo_signs)
+                    if (signcombo_status=="optimal_inaccurate"):
+                        status = signcombo_status
+                    (_, signcombo_endmember_fractions, _,
+                     signcombo_perobs_weighted_resid_sq, _) =\
+                        self.enforce_soln_constraints(A=A[ambiguous_idxs],
+                            b=b[ambiguous_idxs], x=signcombo_x,
+                            conversion_sign_constraints=signcombo_signs,
+                            status=signcombo_status)
+                    signcombo_obj = (signcombo_perobs_weighted_resid_sq
+                        + np.sum(np.square(signcombo_endmember_fractions
+                             *endmember_usagepenalty[ambiguous_idxs]),
+                             axis=-1))
+                    chosen = signcombo_obj < best_obj
+                    best_obj[chosen] = signcombo_obj[chosen]
+                    x[ambiguous_idxs[chosen]] = signcombo_x[chosen]
+                    best_sign_combos[ambiguous_idxs[chosen]] = signcombo
         else:
+            x, status = native_solve(all_idxs, None)
             best_sign_combos = None
-        
-        (x, endmember_fractions,
-         converted_variables,
-         perobs_weighted_resid_sq, status) = self.batch_core_solve(
-            A=A, b=b,
-            num_converted_variables=self.num_converted_variables,
-            pairs_matrix=pairs_matrix,
-            endmember_usagepenalty=endmember_usagepenalty,
-            conversion_sign_constraints=best_sign_combos,
-            smoothness_lambda=smoothness_lambda,
-            batch_size=batch_size,
-            max_iter=max_iter, verbose=verbose)
-        
+        log_info("Observation solves per path:",
+                 dict(self.rows_per_solve_path))
+
+        (x, endmember_fractions, converted_variables,
+         perobs_weighted_resid_sq, status) = self.enforce_soln_constraints(
+            A=A, b=b, x=x, conversion_sign_constraints=best_sign_combos,
+            status=status)
+        log_info("objective:", np.sum(perobs_weighted_resid_sq))
+
+        with report.phase("postprocessing"):
+            ompa_soln = self.build_soln(endmember_df=None,
+                  endmember_name_column=None,
+                  endmember_names=list(endmember_names), x=x,
+                  endmember_fractions=endmember_fractions,
+                  converted_variables=converted_variables,
+                  perobs_weighted_resid_sq=perobs_weighted_resid_sq,
+                  status=status, orig_A=orig_A, orig_b=orig_b,
+                  rows_per_solve_path=self.rows_per_solve_path,
+                  perobs_endmember_mat=endmem_mats,
+                  endmember_available=endmember_available,
+                  solve_report=report)
+        report.finish()
+        log_info(report)
+        if (report_json is not None):
+            report.to_json(report_json)
+        return ompa_soln
+
+    def solve_rows(self, A, b, endmember_usagepenalty, batch_size, max_iter,
+                         verbose, engine="cvxpy", n_jobs=None, executor=None,
+                         screen=False):
+        #Solves the problem without smoothness for every row of b, choosing
+        # the signs of the converted variables if there are any. Returns
+        # the chosen sign combos (None without converted variables) and
+        # the usual batch_core_solve output tuple
+        if (self.num_converted_variables > 0):
+            return self.select_convertedvariable_signs_and_solve(
+                A=A, b=b, endmember_usagepenalty=endmember_usagepenalty,
+                batch_size=batch_size, max_iter=max_iter, verbose=verbose,
+                engine=engine, n_jobs=n_jobs, executor=executor,
+                screen=screen)
+        else:
+            return (None, self.batch_core_solve(
+                A=A, b=b,
+                num_converted_variables=self.num_converted_variables,
+                pairs_matrix=None,
+                endmember_usagepenalty=endmember_usagepenalty,
+                conversion_sign_constraints=None,
+                smoothness_lambda=None,
+                batch_size=batch_size,
+                max_iter=max_iter, verbose=verbose, engine=engine,
+                n_jobs=n_jobs, executor=executor, screen=screen))
+
+    def cached_solve_rows(self, cache, A, b, endmember_usagepenalty,
+                                batch_size, max_iter, verbose,
+                                engine="cvxpy", n_jobs=None, executor=None,
+                                screen=False):
+        #Like solve_rows (without the sign combos), but rows found in cache
+        # (a SolveCache) are not re-solved, and newly solved rows are added
+        # to it
+        report = self.solve_report
+        with report.phase("cache_lookup"):
+            problem_key = cache.get_problem_key(A=A,
+                num_converted_variables=self.num_converted_variables,
+                sumtooneconstraint=self.sumtooneconstraint,
+                convertedvariable_signcombos=(
+                    self.get_convertedvariable_signcombos_to_try()
+                    if self.num_converted_variables > 0 else []),
+                solver_settings={"engine": engine, "max_iter": max_iter})
+            row_keys = cache.get_row_keys(problem_key=problem_key, b=b,
+                endmember_usagepenalty=endmember_usagepenalty)
+            x, perobs_weighted_resid_sq, found = cache.lookup(
+                row_keys=row_keys, num_vars=len(A))
+        to_solve_idxs = np.nonzero(found==False)[0]
+        log_info("Found",np.sum(found),"out of",len(b),"observations in the"
+                 +" cache; solving",len(to_solve_idxs))
+        self.rows_per_solve_path["cache"] = int(np.sum(found))
+
+        status = "cached"
+        if (len(to_solve_idxs) > 0):
+            (_, (new_x, _, _, new_perobs_weighted_resid_sq, status)) =\
+                self.solve_rows(A=A, b=b[to_solve_idxs],
+                    endmember_usagepenalty=
+                        endmember_usagepenalty[to_solve_idxs],
+                    batch_size=batch_size, max_iter=max_iter,
+                    verbose=verbose, engine=engine, n_jobs=n_jobs,
+                    executor=executor, screen=screen)
+            x[to_solve_idxs] = new_x
+            perobs_weighted_resid_sq[to_solve_idxs] =\
+                new_perobs_weighted_resid_sq
+            if (status != "infeasible"):
+                with report.phase("cache_store"):
+                    cache.store(row_keys=[row_keys[i] for i in to_solve_idxs],
+                        x=new_x,
+                        perobs_weighted_resid_sq=new_perobs_weighted_resid_sq)
+
+        num_endmembers = len(A)-self.num_converted_variables
+        return (x, x[:,:num_endmembers],
+                (x[:,num_endmembers:] if self.num_converted_variables > 0
+                 else None),
+                perobs_weighted_resid_sq, status)
+
+    def build_soln(self, endmember_df, endmember_name_column,
+                         endmember_names, x, endmember_fractions,
+                         converted_variables, perobs_weighted_resid_sq,
+                         status, orig_A, orig_b, **kwargs):
+        #kwargs are passed on to OMPASoln (e.g. the obs_df of a partial
+        # solution from solve_iter)
         if (endmember_fractions is not None):
-            print("objective:", np.sum(perobs_weighted_resid_sq))
             #get the reconstructed parameters and residuals in the original
             # parameter space
-            param_reconstruction = x@orig_A
+            param_reconstruction = apply_A(x, orig_A)
             param_residuals =  param_reconstruction - orig_b
         else:
             param_residuals = None
@@ -995,16 +2058,270 @@ class OMPAProblem(object):
                     groupname_to_effectiveconversionratios,
                   #effective_param_weighting=weighting
                   #nullspace_A=nullspace_A
-                )
+                  **kwargs)
+
+    def solve_iter(self, endmember_df, endmember_name_column, batch_size,
+                         max_iter=100000, verbose=False, engine="cvxpy",
+                         screen=False, report=None, obs_dfs=None):
+        """
+            Streaming version of solve (without smoothness): yields one
+            partial OMPASoln per batch of batch_size observations, in order.
+            Each partial solution covers only its own rows (its obs_df is
+            the corresponding slice of the observations, and obs_start and
+            obs_end give the row range), so results can be written out
+            with export_solns_to_csv as they arrive instead of being held
+            in memory until the end. b and the usage penalties are only
+            assembled for the current batch. To avoid holding the
+            observations themselves in memory, pass an iterable of obs_df
+            chunks as obs_dfs (e.g. pd.read_csv(..., chunksize=...)); each
+            chunk is then one batch and batch_size is ignored. report
+            accumulates over the whole stream; every partial solution
+            carries it as solve_report.
+        """
+        assert self.smoothness_lambda is None, (
+            "solve_iter does not support smoothness_lambda, since the"
+            +" smoothness penalty couples the batches")
+        assert engine in ("cvxpy", "native", "enumerate"), (
+            "engine should be 'cvxpy', 'native' or 'enumerate'; got "
+            +str(engine))
+        report = SolveReport() if report is None else report
+        self.solve_report = report
+        with report.phase("A_assembly"):
+            prepped_A = self.prep_A(endmember_df=endmember_df,
+                                    endmember_name_column=endmember_name_column)
+        if (obs_dfs is None):
+            num_obs = len(self.obs_df)
+            batch_problems = (
+                self.get_problem_for_obs_subset(np.arange(start,
+                                min(start+batch_size, num_obs)))
+                for start in range(0, num_obs, batch_size))
+        else:
+            num_obs = None
+            batch_problems = (self.get_problem_for_new_obs(obs_df)
+                              for obs_df in obs_dfs)
+
+        start = 0
+        for batch_problem in batch_problems:
+            with report.phase("A_assembly"):
+                (endmember_names, A, b, orig_A, orig_b) =\
+                    batch_problem.prep_A_and_b(endmember_df=endmember_df,
+                        endmember_name_column=endmember_name_column,
+                        prepped_A=prepped_A)
+            with report.phase("penalty_prep"):
+                endmember_usagepenalty =\
+                    batch_problem.prep_endmember_usagepenalty_mat(
+                        endmember_names)
+            end = start+len(b)
+            log_info("On example",start,"to",end,
+                     *(["out of",num_obs] if num_obs is not None else []))
+            sys.stdout.flush()
+            self.rows_per_solve_path = OrderedDict(
+                ([("closed_form", 0)] if screen else [])+[(engine, 0)])
+            if (self.num_converted_variables > 0):
+                (_, (x, endmember_fractions, converted_variables,
+                     perobs_weighted_resid_sq, status)) =\
+                    self.select_convertedvariable_signs_and_solve(
+                        A=A, b=b, endmember_usagepenalty=endmember_usagepenalty,
+                        batch_size=len(b), max_iter=max_iter,
+                        verbose=verbose, engine=engine, screen=screen)
+            else:
+                (x, endmember_fractions, converted_variables,
+                 perobs_weighted_resid_sq, status) = self.batch_core_solve(
+                    A=A, b=b,
+                    num_converted_variables=self.num_converted_variables,
+                    pairs_matrix=None,
+                    endmember_usagepenalty=endmember_usagepenalty,
+                    conversion_sign_constraints=None,
+                    smoothness_lambda=None, batch_size=len(b),
+                    max_iter=max_iter, verbose=verbose, engine=engine,
+                    screen=screen)
+            with report.phase("postprocessing"):
+                partial_soln = self.build_soln(endmember_df=endmember_df,
+                    endmember_name_column=endmember_name_column,
+                    endmember_names=endmember_names, x=x,
+                    endmember_fractions=endmember_fractions,
+                    converted_variables=converted_variables,
+                    perobs_weighted_resid_sq=perobs_weighted_resid_sq,
+                    status=status, orig_A=orig_A, orig_b=orig_b,
+                    rows_per_solve_path=self.rows_per_solve_path,
+                    solve_report=report, obs_start=start, obs_end=end,
+                    obs_df=batch_problem.obs_df,
+                    endmembername_to_usagepenalty=
+                        batch_problem.endmembername_to_usagepenalty)
+            report.finish()
+            start = end
+            yield partial_soln
+
+    def partitioned_smoothed_solve(self, A, b, init_x, pairs_matrix,
+            endmember_usagepenalty, conversion_sign_constraints,
+            smoothness_lambda, partition_size, max_iter, admm_max_iter=200,
+            n_jobs=None):
+        #Returns the usual batch_core_solve output tuple along with the
+        # smoothness-regularized objective that was reached
+        partitions = partition_observations(
+            coors=get_smoothness_coordinates(obs_df=self.obs_df,
+                      depth_metric="depth", depth_scale=1.0),
+            partition_size=partition_size)
+        z, status, smoothed_objective = admm_smoothed_solve(
+            A=A, b=b, num_converted_variables=self.num_converted_variables,
+            endmember_usagepenalty=endmember_usagepenalty,
+            conversion_sign_constraints=conversion_sign_constraints,
+            pairs_matrix=pairs_matrix, smoothness_lambda=smoothness_lambda,
+            partitions=partitions, init_x=init_x,
+            sumtooneconstraint=self.sumtooneconstraint, max_iter=max_iter,
+            admm_max_iter=admm_max_iter, n_jobs=n_jobs)
+        log_info("status:", status)
+        log_info("smoothed objective reached:", smoothed_objective)
+        return (self.enforce_soln_constraints(A=A, b=b, x=z,
+                    conversion_sign_constraints=conversion_sign_constraints,
+                    status=status), smoothed_objective)
+
+    def along_track_smoothed_solve(self, A, b, init_x,
+            endmember_usagepenalty, conversion_sign_constraints,
+            smoothness_lambda):
+        #Same outputs as partitioned_smoothed_solve, with the smoothness
+        # penalty between consecutive observations along smoothness_time_column
+        order = np.argsort(self.obs_df[self.smoothness_time_column].values,
+                           kind="stable")
+        z, status, smoothed_objective = banded_smoothed_solve(
+            A=A, b=b, num_converted_variables=self.num_converted_variables,
+            endmember_usagepenalty=endmember_usagepenalty,
+            conversion_sign_constraints=conversion_sign_constraints,
+            order=order, smoothness_lambda=smoothness_lambda, init_x=init_x,
+            sumtooneconstraint=self.sumtooneconstraint)
+        log_info("status:", status)
+        log_info("smoothed objective reached:", smoothed_objective)
+        return (self.enforce_soln_constraints(A=A, b=b, x=z,
+                    conversion_sign_constraints=conversion_sign_constraints,
+                    status=status), smoothed_objective)
+
+    def enforce_soln_constraints(self, A, b, x,
+            conversion_sign_constraints, status):
+        #clips x to the constraints (non-negative fractions that sum to
+        # one, converted variables with the given signs) and recomputes the
+        # residuals; A can have one matrix per observation. Returns the
+        # usual batch_core_solve output tuple
+        num_endmembers = A.shape[-2]-self.num_converted_variables
+        endmember_fractions = np.maximum(x[:,:num_endmembers], 0)
+        if (self.sumtooneconstraint):
+            endmember_fractions = (endmember_fractions/
+                np.sum(endmember_fractions,axis=-1)[:,None])
+        if (self.num_converted_variables > 0):
+            converted_variables = np.where(conversion_sign_constraints==0,
+                x[:,num_endmembers:],
+                conversion_sign_constraints*np.maximum(
+                 (conversion_sign_constraints*x[:,num_endmembers:]), 0.0))
+            fixed_x = np.concatenate(
+                       [endmember_fractions, converted_variables], axis=-1)
+        else:
+            converted_variables = None
+            fixed_x = endmember_fractions
+        perobs_weighted_resid_sq = np.sum(np.square(apply_A(fixed_x, A) - b),
+                                          axis=-1)
+        return (fixed_x, endmember_fractions, converted_variables,
+                perobs_weighted_resid_sq, status)
+
+    def select_convertedvariable_signs_and_solve(self, A, b,
+            endmember_usagepenalty, batch_size, max_iter, verbose,
+            engine="cvxpy", n_jobs=None, executor=None, screen=False):
+        #Rather than solving every observation once per sign combo, first
+        # solve with the converted variables of the non-always-positive
+        # groups left unconstrained in sign. The relaxed optimum is a lower
+        # bound for every sign combo, so wherever it already satisfies one
+        # of them it is the answer. Only the observations where some group
+        # has converted variables of mixed sign are re-solved under each
+        # sign combo, and the best of those solutions (by objective,
+        # including the usage penalty) is kept.
+        #Returns the chosen sign combos and the usual batch_core_solve
+        # output tuple.
+        solve_kwargs = dict(A=A,
+            num_converted_variables=self.num_converted_variables,
+            pairs_matrix=None, smoothness_lambda=None, batch_size=batch_size,
+            max_iter=max_iter, verbose=verbose, engine=engine,
+            n_jobs=n_jobs, executor=executor, screen=screen)
+
+        relaxed_signs = self.get_relaxed_convertedvariable_signs()
+        log_info("Trying relaxed convertedvariable sign constraint:",
+                 relaxed_signs)
+        (_, endmember_fractions, converted_variables, _, status) =\
+            self.batch_core_solve(b=b,
+                endmember_usagepenalty=endmember_usagepenalty,
+                conversion_sign_constraints=np.tile(
+                    relaxed_signs[None,:], (len(b),1)),
+                **solve_kwargs)
+        best_sign_combos, is_consistent =\
+            self.get_consistent_convertedvariable_signs(converted_variables)
+
+        ambiguous_idxs = np.nonzero(is_consistent==False)[0]
+        log_info(len(ambiguous_idxs),"out of",len(b),"observations have"
+                 +" converted variables of mixed sign; trying sign combos"
+                 +" on those")
+        if (len(ambiguous_idxs) > 0):
+            signcombos_to_try = self.get_convertedvariable_signcombos_to_try()
+            ambiguous_usagepenalty = endmember_usagepenalty[ambiguous_idxs]
+            perobs_obj_for_signcombo = []
+            solns_for_signcombo = []
+            for signcombo in signcombos_to_try:
+                log_info("Trying convertedvariable sign constraint:",signcombo)
+                (_, signcombo_endmember_fractions,
+                 signcombo_converted_variables,
+                 signcombo_perobs_weighted_resid_sq, signcombo_status) =\
+                  self.batch_core_solve(b=b[ambiguous_idxs],
+                    endmember_usagepenalty=ambiguous_usagepenalty,
+                    conversion_sign_constraints=np.tile(
+                        signcombo[None,:], (len(ambiguous_idxs),1)),
+                    **solve_kwargs)
+                if (signcombo_status=="infeasible"):
+                    status = "infeasible"
+                perobs_obj_for_signcombo.append(
+                    signcombo_perobs_weighted_resid_sq
+                    + np.sum(np.square(signcombo_endmember_fractions
+                                       *ambiguous_usagepenalty), axis=-1))
+                solns_for_signcombo.append((signcombo_endmember_fractions,
+                                            signcombo_converted_variables))
+            #determine which conversion sign is best for each example
+            bestidxs = np.argmin(np.array(perobs_obj_for_signcombo), axis=0)
+            for signcombo_idx, (signcombo_endmember_fractions,
+                                signcombo_converted_variables) in enumerate(
+                                 solns_for_signcombo):
+                chosen = bestidxs==signcombo_idx
+                endmember_fractions[ambiguous_idxs[chosen]] =\
+                    signcombo_endmember_fractions[chosen]
+                converted_variables[ambiguous_idxs[chosen]] =\
+                    signcombo_converted_variables[chosen]
+                best_sign_combos[ambiguous_idxs[chosen]] =\
+                    signcombos_to_try[signcombo_idx]
+
+        #snap numerical noise onto the chosen signs
+        converted_variables = best_sign_combos*np.maximum(
+                                (best_sign_combos*converted_variables), 0.0)
+        fixed_x = np.concatenate([endmember_fractions, converted_variables],
+                                 axis=-1)
+        perobs_weighted_resid_sq = np.sum(np.square((fixed_x@A) - b), axis=-1)
+        return best_sign_combos, (fixed_x, endmember_fractions,
+                                  converted_variables,
+                                  perobs_weighted_resid_sq, status)
 
     def batch_core_solve(self, A, b, num_converted_variables,
                    pairs_matrix, endmember_usagepenalty,
                    conversion_sign_constraints, smoothness_lambda,
-                   batch_size, max_iter, verbose=False):
+                   batch_size, max_iter, verbose=False, engine="cvxpy",
+                   n_jobs=None, executor=None, screen=False):
         assert smoothness_lambda==0 or smoothness_lambda is None,(
             "Batch solving doesn't work for yet for nonzero/non-null"
             "smoothness lambda")
 
+        if (screen):
+            return self.screened_batch_core_solve(
+                A=A, b=b, num_converted_variables=num_converted_variables,
+                endmember_usagepenalty=endmember_usagepenalty,
+                conversion_sign_constraints=conversion_sign_constraints,
+                batch_size=batch_size, max_iter=max_iter, verbose=verbose,
+                engine=engine, n_jobs=n_jobs, executor=executor)
+        if (hasattr(self, "rows_per_solve_path")):
+            self.rows_per_solve_path[engine] =\
+                self.rows_per_solve_path.get(engine, 0) + len(b)
+
         fixed_x = []
         endmember_fractions = []
         if (num_converted_variables > 0):
@@ -1015,26 +2332,39 @@ class OMPAProblem(object):
 
         status = "not_infeasible"
 
-        for i in range(0, len(b), batch_size):
-            print("On example",i,"to",i+batch_size,"out of",len(b))
+        if ((n_jobs is not None and n_jobs > 1) or executor is not None):
+            log_info("Dispatching",len(range(0, len(b), batch_size)),
+                     "batches of size",batch_size,"to worker processes")
             sys.stdout.flush()
-            (fixed_x_batch, endmember_fractions_batch,
+            #solver calls in the worker processes are not itemized; only the
+            # overall wall time is recorded
+            with self.solve_report.phase("parallel_solver"):
+                batch_results = parallel_batch_core_solve(
+                    ompa_problem=self, A=A, b=b,
+                    num_converted_variables=num_converted_variables,
+                    endmember_usagepenalty=endmember_usagepenalty,
+                    conversion_sign_constraints=conversion_sign_constraints,
+                    batch_size=batch_size, max_iter=max_iter,
+                    verbose=verbose, engine=engine, n_jobs=n_jobs,
+                    executor=executor)
+        else:
+            batch_results = self.iter_serial_batch_results(
+                A=A, b=b, num_converted_variables=num_converted_variables,
+                endmember_usagepenalty=endmember_usagepenalty,
+                conversion_sign_constraints=conversion_sign_constraints,
+                batch_size=batch_size, max_iter=max_iter, verbose=verbose,
+                engine=engine)
+
+        for (fixed_x_batch, endmember_fractions_batch,
              converted_variables_batch,
-             perobs_weighted_resid_sq_batch, prob) = self.core_solve(
-                A=A, b=b[i:i+batch_size],
-                num_converted_variables=num_converted_variables,
-                pairs_matrix=None,
-                endmember_usagepenalty=endmember_usagepenalty[i:i+batch_size],
-                conversion_sign_constraints=
-                 conversion_sign_constraints[i:i+batch_size],
-                smoothness_lambda=None, max_iter=max_iter, verbose=verbose)
+             perobs_weighted_resid_sq_batch, batch_status) in batch_results:
             fixed_x.append(fixed_x_batch)
             endmember_fractions.append(endmember_fractions_batch)            
             if (num_converted_variables > 0):
                 converted_variables.append(converted_variables_batch)
             perobs_weighted_resid_sq.append(perobs_weighted_resid_sq_batch)
             
-            if prob.status=="infeasible":
+            if batch_status=="infeasible":
                 status = "infeasible"
 
         fixed_x = np.concatenate(fixed_x, axis=0)
@@ -1047,10 +2377,78 @@ class OMPAProblem(object):
         return (fixed_x, endmember_fractions, converted_variables,
                 perobs_weighted_resid_sq, status)
 
+    def screened_batch_core_solve(self, A, b, num_converted_variables,
+                   endmember_usagepenalty, conversion_sign_constraints,
+                   batch_size, max_iter, verbose=False, engine="cvxpy",
+                   n_jobs=None, executor=None):
+        #Accept the closed-form solution wherever it is already feasible and
+        # only send the remaining observations to the engine
+        with self.solve_report.phase("screening"):
+            screened_x, accepted = closed_form_screen(
+                A=A, b=b, num_converted_variables=num_converted_variables,
+                endmember_usagepenalty=endmember_usagepenalty,
+                conversion_sign_constraints=conversion_sign_constraints,
+                sumtooneconstraint=self.sumtooneconstraint)
+        to_solve_idxs = np.nonzero(accepted==False)[0]
+        log_info("Closed-form screening accepted",np.sum(accepted),"out of",
+                 len(b),"observations; sending",len(to_solve_idxs),
+                 "to",engine)
+        if (hasattr(self, "rows_per_solve_path")):
+            self.rows_per_solve_path["closed_form"] =\
+                self.rows_per_solve_path.get("closed_form", 0)\
+                + int(np.sum(accepted))
+
+        num_endmembers = len(A)-num_converted_variables
+        fixed_x = screened_x
+        status = "not_infeasible"
+        if (len(to_solve_idxs) > 0):
+            (fixed_x_to_solve, _, _, _, status) = self.batch_core_solve(
+                A=A, b=b[to_solve_idxs],
+                num_converted_variables=num_converted_variables,
+                pairs_matrix=None,
+                endmember_usagepenalty=endmember_usagepenalty[to_solve_idxs],
+                conversion_sign_constraints=(
+                 conversion_sign_constraints[to_solve_idxs]
+                 if conversion_sign_constraints is not None else None),
+                smoothness_lambda=None, batch_size=batch_size,
+                max_iter=max_iter, verbose=verbose, engine=engine,
+                n_jobs=n_jobs, executor=executor)
+            fixed_x[to_solve_idxs] = fixed_x_to_solve
+        endmember_fractions = fixed_x[:, :num_endmembers]
+        converted_variables = (fixed_x[:, num_endmembers:]
+                               if num_converted_variables > 0 else None)
+        perobs_weighted_resid_sq = np.sum(np.square((fixed_x@A) - b), axis=-1)
+        return (fixed_x, endmember_fractions, converted_variables,
+                perobs_weighted_resid_sq, status)
+
+    def iter_serial_batch_results(self, A, b, num_converted_variables,
+                                  endmember_usagepenalty,
+                                  conversion_sign_constraints, batch_size,
+                                  max_iter, verbose, engine):
+        for i in range(0, len(b), batch_size):
+            log_info("On example",i,"to",i+batch_size,"out of",len(b))
+            sys.stdout.flush()
+            (fixed_x_batch, endmember_fractions_batch,
+             converted_variables_batch,
+             perobs_weighted_resid_sq_batch, prob) = self.core_solve(
+                A=A, b=b[i:i+batch_size],
+                num_converted_variables=num_converted_variables,
+                pairs_matrix=None,
+                endmember_usagepenalty=endmember_usagepenalty[i:i+batch_size],
+                conversion_sign_constraints=(
+                 conversion_sign_constraints[i:i+batch_size]
+                 if conversion_sign_constraints is not None else None),
+                smoothness_lambda=None, max_iter=max_iter, verbose=verbose,
+                engine=engine)
+            yield (fixed_x_batch, endmember_fractions_batch,
+                   converted_variables_batch,
+                   perobs_weighted_resid_sq_batch, prob.status)
+
     def core_solve(self, A, b, num_converted_variables,
                    pairs_matrix, endmember_usagepenalty,
                    conversion_sign_constraints, smoothness_lambda,
-                   max_iter, verbose=False):
+                   max_iter, verbose=False, engine="cvxpy", x0=None):
+        #x0 is an optional feasible warm start (native engine only)
   
         #We are going to solve the following problem:
         #P is the penalty matrix. It has dimensions of
@@ -1064,45 +2462,70 @@ class OMPAProblem(object):
         # b has dimensions of observations X parameters 
         
         num_endmembers = len(A)-num_converted_variables
-        x = cp.Variable(shape=(len(b), len(A)))
-        obj = (cp.sum_squares(x@A - b) +
-                cp.sum_squares(cp.atoms.affine.binary_operators.multiply(
-                            x[:,:num_endmembers],
-                            endmember_usagepenalty) ))
-        if (smoothness_lambda is not None):
-            #leave out O2 deficit column from the smoothness penality as it's
-            # on a bit of a different scale.
+        solve_start = time.time()
+        assert x0 is None or engine=="native", (
+            "Warm starts are only supported by the native engine")
+        if (engine in ("native", "enumerate")):
+            assert smoothness_lambda is None
+            #every row is an independent QP; solve them all at once
+            x_value, prob = (native_core_solve if engine=="native"
+                             else enumeration_core_solve)(
+                A=A, b=b, num_converted_variables=num_converted_variables,
+                endmember_usagepenalty=endmember_usagepenalty,
+                conversion_sign_constraints=conversion_sign_constraints,
+                sumtooneconstraint=self.sumtooneconstraint,
+                max_iter=max_iter, **({} if x0 is None else {"x0": x0}))
+        elif (smoothness_lambda is None):
+            #reuse a compiled problem for this batch shape and A
+            x_value, prob = self.get_parametrized_core_problem(
+                A=A, num_obs=len(b),
+                num_converted_variables=num_converted_variables).solve(
+                    b=b, endmember_usagepenalty=endmember_usagepenalty,
+                    conversion_sign_constraints=conversion_sign_constraints,
+                    max_iter=max_iter, verbose=verbose)
+        else:
+            x = cp.Variable(shape=(len(b), len(A)))
+            obj = (cp.sum_squares(x@A - b) +
+                    cp.sum_squares(cp.atoms.affine.binary_operators.multiply(
+                                x[:,:num_endmembers],
+                                endmember_usagepenalty) ))
+            #leave out O2 deficit column from the smoothness penality as
+            # it's on a bit of a different scale.
             obj += smoothness_lambda*cp.sum_squares(
                     pairs_matrix@x[:,:num_endmembers])
-        obj = cp.Minimize(obj)
-        
-        #leave out the last column as it's the conversion ratio
-        constraints = [x[:,:num_endmembers] >= 0]
-        if (self.sumtooneconstraint):
-            constraints.append(cp.sum(x[:,:num_endmembers],axis=1)==1)
+            obj = cp.Minimize(obj)
 
-        if (len(self.convertedparam_groups) > 0):
-            constraints.append(
-              cp.atoms.affine.binary_operators.multiply(
-                  conversion_sign_constraints,
-                  x[:,num_endmembers:]) >= 0)
+            #leave out the last column as it's the conversion ratio
+            constraints = [x[:,:num_endmembers] >= 0]
+            if (self.sumtooneconstraint):
+                constraints.append(cp.sum(x[:,:num_endmembers],axis=1)==1)
 
-        prob = cp.Problem(obj, constraints)
-        prob.solve(verbose=verbose, max_iter=max_iter)
-        #settign verbose=True will generate more print statements and
-        # slow down the analysis
-        
-        print("status:", prob.status)
-        print("optimal value", prob.value)
+            if (len(self.convertedparam_groups) > 0):
+                constraints.append(
+                  cp.atoms.affine.binary_operators.multiply(
+                      conversion_sign_constraints,
+                      x[:,num_endmembers:]) >= 0)
+
+            prob = cp.Problem(obj, constraints)
+            prob.solve(verbose=verbose, max_iter=max_iter)
+            #settign verbose=True will generate more print statements and
+            # slow down the analysis
+            x_value = x.value
+        self.solve_report.record_solver_call(prob=prob, engine=engine,
+            num_obs=len(b), wall_time=time.time()-solve_start)
+
+        log_info("status:", prob.status)
+        log_info("optimal value", prob.value)
+        postprocessing_start = time.time()
 
         if (prob.status=="infeasible"):
-            raise RuntimeError("Optimization failed - "
-                               +"try lowering the parameter weights?")
+            raise InfeasibleError("Optimization failed - "
+                                  +"try lowering the parameter weights?")
         else:
             #weighted sum of squared of the residuals
-            original_resid_wsumsq = np.sum(np.square((x.value@A) - b))
+            original_resid_wsumsq = np.sum(np.square((x_value@A) - b))
 
-            endmember_fractions = x.value[:,:num_endmembers]
+            endmember_fractions = x_value[:,:num_endmembers]
             ##enforce the constraints (nonnegativity, sum to 1) on
             ## endmember_fractions
             endmember_fractions = np.maximum(endmember_fractions, 0) 
@@ -1111,9 +2534,13 @@ class OMPAProblem(object):
                     np.sum(endmember_fractions,axis=-1)[:,None])
 
             if (len(self.convertedparam_groups) > 0):
-                converted_variables = conversion_sign_constraints*np.maximum(
-                                         (conversion_sign_constraints
-                                          *x.value[:, num_endmembers:]), 0.0)
+                #a sign constraint of 0 leaves the variable unconstrained
+                converted_variables = np.where(
+                    conversion_sign_constraints==0,
+                    x_value[:, num_endmembers:],
+                    conversion_sign_constraints*np.maximum(
+                        (conversion_sign_constraints
+                         *x_value[:, num_endmembers:]), 0.0))
                 #fixed_x is x that is forced to satisfy the constraints
                 fixed_x = np.concatenate(
                            [endmember_fractions, converted_variables], axis=-1)
@@ -1122,98 +2549,309 @@ class OMPAProblem(object):
                 fixed_x = endmember_fractions
 
             afterfixing_resid_wsumsq = np.sum(np.square(fixed_x@A - b))
-            print("Original weighted sum squares:",original_resid_wsumsq)
-            print("Post fix weighted sum squared:",afterfixing_resid_wsumsq)
+            log_info("Original weighted sum squares:",original_resid_wsumsq)
+            log_info("Post fix weighted sum squared:",afterfixing_resid_wsumsq)
 
             perobs_weighted_resid_sq =\
                 np.sum(np.square((fixed_x@A) - b), axis=-1)
+        self.solve_report.add_phase_time("postprocessing",
+                                         time.time()-postprocessing_start)
         
         return (fixed_x, endmember_fractions, converted_variables,
                 perobs_weighted_resid_sq, prob)
 
+    def get_ideal_endmember_mat(self, endmember_fractions,
+                                      converted_variables, endmem_mat,
+                                      param_offset=None,
+                                      ridge=ENDMEMBER_RIDGE):
+        #Closed-form least-squares update of the endmember matrix M for
+        # fixed endmember fractions F and converted variables C, i.e. the
+        # minimizer of |F@(M-offset) - (b-offset-C@R)|^2 (plus a small ridge
+        # towards endmem_mat). The weighted objective decouples over the
+        # parameters, so the parameter weights drop out and all the
+        # parameters share one (num_endmembers X num_endmembers) system.
+        #param_offset is the standardization mean (see prep_A); it cancels
+        # when the fractions sum to one.
+        num_endmembers = endmember_fractions.shape[1]
+        offset = (np.zeros(len(self.param_names)) if param_offset is None
+                  else param_offset)
+        target = self.get_b() - offset[None,:]
+        if (converted_variables is not None):
+            target = target - (converted_variables
+                               @self.get_conversion_ratio_rows_of_A())
+        FtF = endmember_fractions.T@endmember_fractions
+        lam = ridge*max(np.trace(FtF)/num_endmembers, 1e-300)
+        return scipy.linalg.solve(
+            FtF + lam*np.eye(num_endmembers),
+            endmember_fractions.T@target
+             + lam*(endmem_mat - offset[None,:]),
+            assume_a="pos") + offset[None,:]
+
+    def get_endmember_df_for_mat(self, endmember_df, endmem_mat):
+        #copy of endmember_df with the parameter columns set to endmem_mat
+        new_endmember_df = endmember_df.copy()
+        for param_idx, param_name in enumerate(self.param_names):
+            new_endmember_df[param_name] = endmem_mat[:, param_idx]
+        return new_endmember_df
+
     def construct_ideal_endmembers(self, ompa_soln):
 
-        print("Constructing ideal end members")
+        log_info("Constructing ideal end members")
 
         b = self.get_b() # dims of num_obs X params
 
-        if (ompa_soln.oxygen_deficits is not None):
-            #self.oxygen_deficits has dims of num_obs X num_converted_variables
+        if (ompa_soln.converted_variables is not None):
+            #converted_variables has dims of num_obs X num_converted_variables
             #conversion_ratio_rows has dims of num_converted_variables X params
-            _, conversion_ratio_rows = self.get_conversion_ratio_rows_of_A()
-            deltas_due_to_oxygen_deficits = ( #<- num_obs X params
-             ompa_soln.oxygen_deficits@conversion_ratio_rows) 
-            b = b - deltas_due_to_oxygen_deficits
+            conversion_ratio_rows = self.get_conversion_ratio_rows_of_A()
+            b = b - ompa_soln.converted_variables@conversion_ratio_rows
 
         #Do a sanity check to make sure that, with the existing end member
         # matrix, we end up recapitulating the residuals
         #existing_endmemmat has dims of num_endmembers X params
         existing_endmemmat = self.get_endmem_mat(ompa_soln.endmember_df)
-        #self.endmember_fractions has dims of num_obs X num_endmembers
-        #Note: b and existing_endmemmat haven't been scaled by weighting yet,
-        # so there is no need
-        # to un-scale it here. Also note deltas_due_to_oxygen_deficits has
-        # already been subtracted
-        old_param_residuals = (b
-          - ompa_soln.endmember_fractions@existing_endmemmat)
+        #Note: b and existing_endmemmat haven't been scaled by weighting, so
+        # the residuals are in the original parameter space
+        old_param_residuals = (
+            ompa_soln.endmember_fractions@existing_endmemmat - b)
         np.testing.assert_almost_equal(old_param_residuals,
                                        ompa_soln.param_residuals, decimal=5)
 
-        #Now solve for a better end-member mat
-        weighting = self.get_param_weighting()
-        new_endmemmat_var =  cp.Variable(shape=existing_endmemmat.shape)  
-        
         #keeping the endmember_fractions, what are the best end members?
-        obj = cp.Minimize(
-            cp.sum_squares(ompa_soln.endmember_fractions@new_endmemmat_var
-                           - b*weighting[None,:]))
-        constraints = [] #no constraints for now
-        prob = cp.Problem(obj, constraints)
-        prob.solve(verbose=False, max_iter=max_iter)
-        
-        print("status:", prob.status)
-        print("optimal value", prob.value)
+        new_endmemmat = self.get_ideal_endmember_mat(
+            endmember_fractions=ompa_soln.endmember_fractions,
+            converted_variables=ompa_soln.converted_variables,
+            endmem_mat=existing_endmemmat)
 
-        if (prob.status=="infeasible"):
-            raise RuntimeError("Something went wrong "
-                               +"- the optimization failed")
-        else:
-            new_endmemmat = new_endmemmat_var.value/weighting[None,:]
-            #Sanity check that the residuals got better
-            new_param_residuals = (b
-                - ompa_soln.endmember_fractions@new_endmemmat)
-            new_param_resid_wsumsq =\
-                np.sum(np.square(new_param_residuals*weighting[None,:]))
-            old_param_resid_wsumsq =\
-                np.sum(np.square(old_param_residuals*weighting[None,:]))
-            print("Old weighted residuals sumsquared:",old_param_resid_wsumsq)
-            print("New weighted residuals sumsquared:",new_param_resid_wsumsq)
-            assert new_param_resid_wsumsq <= old_param_resid_wsumsq
-
-            #make a endmember data frame
-            new_endmemmat_df = pd.DataFrame(OrderedDict(
-             [(ompa_soln.endmember_name_column,
-               list(ompa_soln.endmember_df[ompa_soln.endmember_name_column]))]
-             +[(paramname, values) for paramname,values in
-             zip(self.conserved_params_to_use+self.converted_params_to_use,
-                 new_endmemmat.T) ])) 
-            return new_endmemmat_df
+        #Sanity check that the residuals got better
+        weighting = self.get_param_weighting()
+        new_param_residuals = (
+            ompa_soln.endmember_fractions@new_endmemmat - b)
+        new_param_resid_wsumsq =\
+            np.sum(np.square(new_param_residuals*weighting[None,:]))
+        old_param_resid_wsumsq =\
+            np.sum(np.square(old_param_residuals*weighting[None,:]))
+        log_info("Old weighted residuals sumsquared:",
+                 old_param_resid_wsumsq)
+        log_info("New weighted residuals sumsquared:",
+                 new_param_resid_wsumsq)
+        assert new_param_resid_wsumsq <= old_param_resid_wsumsq*(1+1e-9)
+
+        return self.get_endmember_df_for_mat(
+            endmember_df=ompa_soln.endmember_df, endmem_mat=new_endmemmat)
 
     def iteratively_refine_ompa_solns(self, init_endmember_df,
-            endmember_name_column, num_iterations):
+            endmember_name_column, num_iterations, **solve_kwargs):
+        #Re-solves from scratch on every iteration and returns every
+        # intermediate solution; see refine_endmembers for the faster
+        # warm-started version that only keeps the final solution
         assert num_iterations >= 1,\
             "num_iterations must be >= 1; is "+str(num_iterations)
-        print("On iteration 1")
+        log_info("On iteration 1")
         ompa_solns = [self.solve(endmember_df=init_endmember_df,
-                                 endmember_name_column=endmember_name_column)]
+                                 endmember_name_column=endmember_name_column,
+                                 **solve_kwargs)]
         for i in range(1,num_iterations):
-            print("On iteration "+str(i+1))
+            log_info("On iteration "+str(i+1))
             new_endmember_df =\
                 self.construct_ideal_endmembers(ompa_soln=ompa_solns[-1]) 
             ompa_solns.append(self.solve(endmember_df=new_endmember_df,
-                                  endmember_name_column=endmember_name_column))
+                                  endmember_name_column=endmember_name_column,
+                                  **solve_kwargs))
         return ompa_solns 
 
+    def refine_endmembers(self, endmember_df, endmember_name_column,
+                                max_iterations=100, rtol=1e-6,
+                                init_soln=None, keep_history=False,
+                                max_iter=100000, report=None,
+                                **solve_kwargs):
+        #Alternating least-squares refinement of the endmember parameters:
+        # each iteration does the closed-form endmember update of
+        # get_ideal_endmember_mat followed by a fraction update with the
+        # native engine, warm-started from the previous fractions. Stops
+        # once an iteration lowers the objective (weighted residuals plus
+        # usage penalties) by less than rtol relative to its value, or after
+        # max_iterations.
+        #Neither step can increase the objective, because:
+        # - the parameter weighting (and standardization) is fixed to that
+        #   of the starting endmembers, and
+        # - each observation starts from the sign combo of the converted
+        #   variables chosen in the starting solution, and a group's sign is
+        #   only flipped (for the observations where its variables sit at
+        #   0) if that lowers the observation's objective.
+        #init_soln is the starting solution for endmember_df (solved with
+        # solve_kwargs if not given). Only the current endmember matrix and
+        # fractions are kept between iterations. The per-iteration
+        # objectives are attached to the returned OMPASoln as
+        # refinement_objectives; if keep_history is True, so are the
+        # endmember data frames of every iteration (refinement_endmember_dfs).
+        assert self.smoothness_lambda is None, (
+            "refine_endmembers does not support smoothness_lambda")
+        assert max_iterations >= 1,\
+            "max_iterations must be >= 1; is "+str(max_iterations)
+        report = SolveReport() if report is None else report
+
+        if (init_soln is None):
+            log_info("Solving with the starting endmembers")
+            init_soln = self.solve(endmember_df=endmember_df,
+                                   endmember_name_column=endmember_name_column,
+                                   max_iter=max_iter, **solve_kwargs)
+        self.solve_report = report
+
+        with report.phase("A_assembly"):
+            prepped_A = self.prep_A(endmember_df=endmember_df,
+                                    endmember_name_column=endmember_name_column)
+            (endmember_names, _, b, _, orig_b) = self.prep_A_and_b(
+                endmember_df=endmember_df,
+                endmember_name_column=endmember_name_column,
+                prepped_A=prepped_A)
+        assert list(init_soln.endmember_names)==list(endmember_names), (
+            "init_soln was solved with endmembers "
+            +str(list(init_soln.endmember_names))+" but endmember_df has "
+            +str(endmember_names))
+        conversion_ratio_rows = prepped_A["conversion_ratio_rows"]
+        weighting = prepped_A["weighting"]
+        param_mean = prepped_A["param_mean"]
+        with report.phase("penalty_prep"):
+            endmember_usagepenalty =\
+                self.prep_endmember_usagepenalty_mat(endmember_names)
+        self.endmember_usagepenalty = endmember_usagepenalty
+
+        converted_variables = init_soln.converted_variables
+        if (self.num_converted_variables > 0):
+            conversion_sign_constraints =\
+                self.get_consistent_convertedvariable_signs(
+                    converted_variables)[0]
+            x = np.concatenate([init_soln.endmember_fractions,
+                                converted_variables], axis=-1)
+        else:
+            conversion_sign_constraints = None
+            x = init_soln.endmember_fractions
+
+        def get_A(endmem_mat):
+            #A for endmem_mat with the starting weighting/standardization
+            A = (np.concatenate([endmem_mat, conversion_ratio_rows], axis=0)
+                 if len(conversion_ratio_rows) > 0 else endmem_mat.copy())
+            if (param_mean is not None):
+                A[:len(endmem_mat)] = (A[:len(endmem_mat)]
+                                       - param_mean[None,:])
+            return A*weighting[None,:]
+
+        def get_perobs_objective(A, x, row_idxs=slice(None)):
+            return (np.sum(np.square(apply_A(x, A) - b[row_idxs]), axis=-1)
+                    + np.sum(np.square(x[:,:len(endmember_names)]
+                                  *endmember_usagepenalty[row_idxs]), axis=-1))
+
+        def flip_signs(A, x, conversion_sign_constraints):
+            #For each group that isn't always positive, try the other sign
+            # for the observations where the group's variables are all 0
+            # (the current solution is feasible for both signs there, so it
+            # serves as the warm start) and keep it where it is better
+            perobs_objective = get_perobs_objective(A=A, x=x)
+            convar_idx = len(endmember_names)
+            for convertedparam_group in self.convertedparam_groups:
+                cols = slice(convar_idx,
+                    convar_idx+len(convertedparam_group.conversion_ratios))
+                convar_idx = cols.stop
+                if (convertedparam_group.always_positive):
+                    continue
+                signcol_idxs = slice(cols.start-len(endmember_names),
+                                     cols.stop-len(endmember_names))
+                row_idxs = np.nonzero(np.all(x[:,cols]==0, axis=-1))[0]
+                if (len(row_idxs)==0):
+                    continue
+                trial_signs = conversion_sign_constraints[row_idxs].copy()
+                trial_signs[:,signcol_idxs] *= -1
+                trial_x = self.core_solve(
+                    A=A, b=b[row_idxs],
+                    num_converted_variables=self.num_converted_variables,
+                    pairs_matrix=None,
+                    endmember_usagepenalty=endmember_usagepenalty[row_idxs],
+                    conversion_sign_constraints=trial_signs,
+                    smoothness_lambda=None, max_iter=max_iter,
+                    engine="native", x0=x[row_idxs])[0]
+                trial_objective = get_perobs_objective(A=A, x=trial_x,
+                                                       row_idxs=row_idxs)
+                better = trial_objective < perobs_objective[row_idxs]
+                x[row_idxs[better]] = trial_x[better]
+                conversion_sign_constraints[row_idxs[better]] =\
+                    trial_signs[better]
+                perobs_objective[row_idxs[better]] = trial_objective[better]
+                log_info("Flipped the "+convertedparam_group.groupname
+                         +" sign for "+str(np.sum(better))+" of "
+                         +str(len(row_idxs))+" candidate observations")
+            return x
+
+        endmem_mat = self.get_endmem_mat(endmember_df)
+        objectives = [np.sum(get_perobs_objective(A=get_A(endmem_mat), x=x))]
+        endmember_dfs = [endmember_df] if keep_history else None
+        converged = False
+        status = init_soln.status
+        log_info("Starting objective:", objectives[0])
+        for iteration in range(max_iterations):
+            with report.phase("endmember_update"):
+                endmem_mat = self.get_ideal_endmember_mat(
+                    endmember_fractions=x[:,:len(endmember_names)],
+                    converted_variables=converted_variables,
+                    endmem_mat=endmem_mat, param_offset=param_mean)
+                A = get_A(endmem_mat)
+            with report.phase("fraction_update"):
+                (x, _, converted_variables,
+                 perobs_weighted_resid_sq, prob) = self.core_solve(
+                    A=A, b=b,
+                    num_converted_variables=self.num_converted_variables,
+                    pairs_matrix=None,
+                    endmember_usagepenalty=endmember_usagepenalty,
+                    conversion_sign_constraints=conversion_sign_constraints,
+                    smoothness_lambda=None, max_iter=max_iter,
+                    engine="native", x0=x)
+                if (self.num_converted_variables > 0):
+                    x = flip_signs(A=A, x=x, conversion_sign_constraints=
+                                             conversion_sign_constraints)
+                    converted_variables = x[:,len(endmember_names):]
+                    perobs_weighted_resid_sq = np.sum(
+                        np.square(apply_A(x, A) - b), axis=-1)
+            if (prob.status!="optimal"):
+                status = prob.status
+            objectives.append(np.sum(get_perobs_objective(A=A, x=x)))
+            if (keep_history):
+                endmember_dfs.append(self.get_endmember_df_for_mat(
+                    endmember_df=endmember_df, endmem_mat=endmem_mat))
+            log_info("Refinement iteration "+str(iteration+1)
+                     +" objective:", objectives[-1])
+            if ((objectives[-2]-objectives[-1])
+                 <= rtol*max(objectives[-2], 1e-300)):
+                converged = True
+                break
+        if (converged==False):
+            log_warning("Endmember refinement did not reach rtol="
+                        +str(rtol)+" within "+str(max_iterations)
+                        +" iterations")
+
+        with report.phase("postprocessing"):
+            ompa_soln = self.build_soln(
+                endmember_df=self.get_endmember_df_for_mat(
+                    endmember_df=endmember_df, endmem_mat=endmem_mat),
+                endmember_name_column=endmember_name_column,
+                endmember_names=endmember_names, x=x,
+                endmember_fractions=x[:,:len(endmember_names)],
+                converted_variables=converted_variables,
+                perobs_weighted_resid_sq=perobs_weighted_resid_sq,
+                status=status,
+                orig_A=(np.concatenate([endmem_mat, conversion_ratio_rows],
+                                       axis=0)
+                        if len(conversion_ratio_rows) > 0 else endmem_mat),
+                orig_b=orig_b,
+                rows_per_solve_path=OrderedDict(
+                    [("native", len(b)*(len(objectives)-1))]),
+                solve_report=report,
+                refinement_objectives=objectives,
+                refinement_converged=converged,
+                refinement_endmember_dfs=endmember_dfs)
+        report.finish()
+        log_info(report)
+        return ompa_soln
+
 
 def spherical_to_surface_cartesian(lat, lon):
     r = 6.371*(1E3) #earth radius
@@ -1225,65 +2863,55 @@ def spherical_to_surface_cartesian(lat, lon):
 
 
 def add_surface_cartesian_coordinates_to_df(df):
-    latitudes = df["latitude"]
-    longitudes = df["longitude"]
-    xs,ys = list(zip(*[spherical_to_surface_cartesian(*x)
-                       for x in zip(latitudes, longitudes)]))
+    xs,ys = spherical_to_surface_cartesian(
+                lat=np.array(df["latitude"]), lon=np.array(df["longitude"]))
     df["x"] = xs
     df["y"] = ys
     #plt.scatter(xs, ys)
     #plt.show()
 
 
-def compute_pairwise_distances_depthmetric(df, depth_metric, depth_scale):
-    xs = df["x"]
-    ys = df["y"]
-    
-    depth_metric = np.array(df[depth_metric])
-    depth_diffs = np.abs(depth_metric[:,None] -
-                         depth_metric[None,:])*depth_scale
-
-    #plt.hist(depth_diffs.ravel(), bins=20)
-    #plt.show()
-
-    coors = np.array([xs, ys]).transpose((1,0))
-    euclidean_distances = scipy.spatial.distance.squareform(
-        scipy.spatial.distance.pdist(coors))
-    #plt.hist(euclidean_distances.ravel(), bins=100)
-    #plt.show()
-
-    weighted_distances = np.sqrt(np.square(euclidean_distances)
-                                 + np.square(depth_diffs))
-    #plt.hist(weighted_distances.ravel(), bins=20)
-    #plt.show()
-    return weighted_distances
+def get_smoothness_coordinates(obs_df, depth_metric, depth_scale):
+    #(x, y, depth_metric*depth_scale) coordinates used to find neighbours
+    obs_df = pd.DataFrame(obs_df)
+    add_surface_cartesian_coordinates_to_df(obs_df)
+    return np.stack([np.array(obs_df["x"]), np.array(obs_df["y"]),
+                     np.array(obs_df[depth_metric])*depth_scale], axis=1)
 
 
 def make_pairs_matrix(obs_df, depth_metric, depth_scale, nneighb):
-    obs_df = pd.DataFrame(obs_df)
-    add_surface_cartesian_coordinates_to_df(obs_df)
-    pairwise_distances = compute_pairwise_distances_depthmetric(
-        obs_df, depth_metric=depth_metric, depth_scale=depth_scale)
-    #plt.hist(pairwise_distances.ravel(), bins=20)
-    #plt.show()
-    nneighb_thresh = np.sort(pairwise_distances, axis=-1)[:,nneighb]
-    masked_pairwise_distances =\
-      (pairwise_distances*(pairwise_distances <= nneighb_thresh[:,None])
-                         *(pairwise_distances > 0))
-    pairs_to_consider_indices = np.nonzero(masked_pairwise_distances)
-    print("Constrained pairs:",len(pairs_to_consider_indices[0]))
-    pairs_distances = pairwise_distances[
-        pairs_to_consider_indices[0],
-        pairs_to_consider_indices[1]]
-    #plt.hist(pairs_distances.ravel(), bins=20)
-    #plt.show()
-    pairs_matrix = np.zeros((len(pairs_to_consider_indices[0]),
-                              len(obs_df)))
-    pairs_matrix[np.arange(len(pairs_distances)),
-                  pairs_to_consider_indices[0]] = 1.0/nneighb#(
-                      #1/pairs_distances)
-    pairs_matrix[np.arange(len(pairs_distances)),
-                  pairs_to_consider_indices[1]] = -1.0/nneighb#(
-                      #1/pairs_distances)
+    #Pairs every observation with its nneighb nearest neighbours in
+    # (x, y, depth_metric*depth_scale) space, found with a KD-tree so that
+    # no N x N distance matrix is needed. As before, neighbours tied with
+    # the nneighb-th nearest one (common on gridded profiles) are all kept.
+    # Returns a sparse (pairs X observations) matrix with 1/nneighb and
+    # -1/nneighb in the columns of the two members of each pair.
+    coors = get_smoothness_coordinates(obs_df=obs_df,
+                depth_metric=depth_metric, depth_scale=depth_scale)
+    tree = scipy.spatial.cKDTree(coors)
+    #query one extra neighbour because each point finds itself
+    num_query = min(nneighb+1, len(coors))
+    nneighb_thresh = tree.query(coors, k=num_query)[0].reshape(
+                                    (len(coors), num_query))[:,-1]
+    #every point within the distance of the nneighb-th neighbour (with a
+    # little slack so rounding doesn't drop the neighbour itself)
+    neighbour_lists = tree.query_ball_point(
+        coors, r=nneighb_thresh*(1+1e-12), return_sorted=True)
+    pairs_first = np.repeat(np.arange(len(coors)),
+                            [len(x) for x in neighbour_lists])
+    pairs_second = np.array(list(itertools.chain(*neighbour_lists)),
+                            dtype=int)
+    #leave out self-matches and exact duplicates, as before
+    to_keep = np.any(coors[pairs_first] != coors[pairs_second], axis=-1)
+    pairs_first = pairs_first[to_keep]
+    pairs_second = pairs_second[to_keep]
+    num_pairs = len(pairs_first)
+    log_info("Constrained pairs:",num_pairs)
+    pairs_matrix = scipy.sparse.csr_matrix(
+        (np.concatenate([np.full(num_pairs, 1.0/nneighb),
+                         np.full(num_pairs, -1.0/nneighb)]),
+         (np.concatenate([np.arange(num_pairs), np.arange(num_pairs)]),
+          np.concatenate([pairs_first, pairs_second]))),
+        shape=(num_pairs, len(coors)))
     return pairs_matrix
     
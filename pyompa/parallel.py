@@ -0,0 +1,136 @@
+from __future__ import division, print_function
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from cvxpy.error import SolverError
+from .util import InfeasibleError
+
+
+class SharedArrays(object):
+    """
+        Copies a set of numpy arrays into shared memory blocks once, so
+        that worker processes can attach to them by name instead of
+        receiving pickled copies with every task. Use as a context manager
+        so the blocks are unlinked afterwards.
+    """
+    def __init__(self, name_to_array):
+        self.shms = []
+        self.specs = OrderedDict()
+        for name, arr in name_to_array.items():
+            if (arr is None):
+                self.specs[name] = None
+                continue
+            arr = np.ascontiguousarray(arr)
+            shm = shared_memory.SharedMemory(create=True,
+                                             size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            self.shms.append(shm)
+            self.specs[name] = (shm.name, arr.shape, arr.dtype.str)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+
+
+def attach_shared_arrays(specs):
+    #returns the opened shared memory blocks (which must stay referenced
+    # while the arrays are in use) and the arrays themselves
+    shms = []
+    name_to_array = OrderedDict()
+    for name, spec in specs.items():
+        if (spec is None):
+            name_to_array[name] = None
+            continue
+        shm_name, shape, dtype = spec
+        shm = shared_memory.SharedMemory(name=shm_name)
+        shms.append(shm)
+        name_to_array[name] = np.ndarray(shape, dtype=np.dtype(dtype),
+                                         buffer=shm.buf)
+    return shms, name_to_array
+
+
+def solve_batch_from_shared_arrays(ompa_problem, specs, start, end,
+                                   num_converted_variables, max_iter,
+                                   verbose, engine):
+    #Runs in a worker process: slices this batch out of the shared arrays
+    # and calls core_solve on it
+    shms, arrs = attach_shared_arrays(specs)
+    try:
+        (fixed_x, endmember_fractions, converted_variables,
+         perobs_weighted_resid_sq, prob) = ompa_problem.core_solve(
+            A=np.array(arrs["A"]), b=np.array(arrs["b"][start:end]),
+            num_converted_variables=num_converted_variables,
+            pairs_matrix=None,
+            endmember_usagepenalty=np.array(
+                arrs["endmember_usagepenalty"][start:end]),
+            conversion_sign_constraints=(
+                np.array(arrs["conversion_sign_constraints"][start:end])
+                if arrs["conversion_sign_constraints"] is not None else None),
+            smoothness_lambda=None, max_iter=max_iter, verbose=verbose,
+            engine=engine)
+    finally:
+        del arrs
+        for shm in shms:
+            shm.close()
+    return (fixed_x, endmember_fractions, converted_variables,
+            perobs_weighted_resid_sq, prob.status)
+
+
+def parallel_batch_core_solve(ompa_problem, A, b, num_converted_variables,
+                              endmember_usagepenalty,
+                              conversion_sign_constraints, batch_size,
+                              max_iter, verbose, engine, n_jobs=None,
+                              executor=None):
+    """
+        Dispatches the batches of OMPAProblem.batch_core_solve to a pool of
+        worker processes. Either n_jobs (the number of processes in a pool
+        created here) or an existing concurrent.futures executor can be
+        supplied. Returns the per-batch results in row order, as a list of
+        (fixed_x, endmember_fractions, converted_variables,
+         perobs_weighted_resid_sq, status) tuples.
+    """
+    batch_starts = list(range(0, len(b), batch_size))
+    #the worker copy leaves out observation-sized attributes, which are
+    # not needed by core_solve
+    worker_problem = ompa_problem.get_worker_copy()
+    with SharedArrays(OrderedDict([
+            ("A", A), ("b", b),
+            ("endmember_usagepenalty", endmember_usagepenalty),
+            ("conversion_sign_constraints", conversion_sign_constraints)
+         ])) as shared_arrays:
+        own_executor = executor is None
+        if (own_executor):
+            executor = ProcessPoolExecutor(max_workers=n_jobs)
+        try:
+            futures = [executor.submit(solve_batch_from_shared_arrays,
+                          ompa_problem=worker_problem,
+                          specs=shared_arrays.specs,
+                          start=start, end=min(start+batch_size, len(b)),
+                          num_converted_variables=num_converted_variables,
+                          max_iter=max_iter, verbose=verbose, engine=engine)
+                       for start in batch_starts]
+            results = []
+            for start, future in zip(batch_starts, futures):
+                try:
+                    results.append(future.result())
+                except (InfeasibleError, SolverError):
+                    #passed on as is, so callers can tell them apart from
+                    # other failures
+                    for other_future in futures:
+                        other_future.cancel()
+                    raise
+                except Exception as e:
+                    for other_future in futures:
+                        other_future.cancel()
+                    raise RuntimeError("Solving observations "+str(start)
+                        +" to "+str(min(start+batch_size, len(b)))
+                        +" failed: "+repr(e)) from e
+        finally:
+            if (own_executor):
+                executor.shutdown()
+    return results
@@ -6,6 +6,7 @@ from .endmemberpenaltyfunc import EndMemExpPenaltyFunc
 from .util import assert_in, assert_compatible_keys, assert_has_keys
 from collections import OrderedDict
 import json
+from .report import log_info
 
 
 PARSE_DF_ALLOWED_KEYS = ["csv_file", "na_values"]
@@ -83,8 +84,8 @@ def parse_params(config):
 
 
 def run_ompa_given_config(config):
-    print("Received Config:")
-    print(json.dumps(config, indent=4))
+    log_info("Received Config:")
+    log_info(json.dumps(config, indent=4))
     assert_compatible_keys(the_dict=config,
           allowed=["observations", "params", "endmembers",
                    "endmember_penalties", "export"],
@@ -122,7 +123,12 @@ def run_ompa_given_config(config):
               endmember_name_column=endmember_name_column) 
 
     if "export" in config:
-        ompa_soln.export_to_csv(**config["export"])
+        #csv_output_name exports to csv as before; output_name exports to
+        # the format given by "format" or the file extension
+        if "output_name" in config["export"]:
+            ompa_soln.export(**config["export"])
+        else:
+            ompa_soln.export_to_csv(**config["export"])
 
     return ompa_soln
 
@@ -0,0 +1,193 @@
+from __future__ import division, print_function
+import json
+import logging
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError: #not available on Windows
+    resource = None
+
+
+class StdoutHandler(logging.StreamHandler):
+    #Writes to whatever sys.stdout currently is, the way print does. It
+    # only does so while the application hasn't configured logging (the
+    # root logger has no handlers); after that, the messages propagate to
+    # the application's handlers instead.
+    def __init__(self):
+        logging.StreamHandler.__init__(self, stream=sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+    def emit(self, record):
+        if (logger.propagate and len(logging.getLogger().handlers) > 0):
+            return
+        logging.StreamHandler.emit(self, record)
+
+
+#All progress messages go through this logger; by default they are printed
+# to stdout as before, and once logging is configured (e.g. with
+# logging.basicConfig) they go to the root handlers. Silence them with
+# logging.getLogger("pyompa").setLevel(logging.WARNING)
+logger = logging.getLogger("pyompa")
+if (len(logger.handlers)==0):
+    _handler = StdoutHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    #don't override a level the application already set
+    if (logger.level==logging.NOTSET):
+        logger.setLevel(logging.INFO)
+
+
+def log_info(*args):
+    #print-style (space-separated arguments) message at INFO level
+    logger.info(" ".join([str(x) for x in args]))
+
+
+def log_warning(*args):
+    logger.warning(" ".join([str(x) for x in args]))
+
+
+def get_peak_memory_mb(children=False):
+    #Peak resident set size of this process over its lifetime so far, or
+    # None if unavailable. With children=True, the peak of the largest
+    # terminated child process instead (e.g. the workers of a closed pool)
+    if (resource is None):
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN if children
+                                else resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return maxrss/(1024.0*1024.0 if sys.platform=="darwin" else 1024.0)
+
+
+class SolveReport(object):
+    """
+        Collects the wall time spent in each phase of a solve (penalty
+        prep, A assembly, canonicalization, solver, postprocessing, ...),
+        per-call solver statistics (engine, number of observations, status,
+        iterations) and the process peak memory. Subclass and override
+        on_phase_end/on_solver_call to forward these to other
+        instrumentation as they happen. With keep_solver_calls=False only
+        the totals over solver calls are kept (for per-observation loops).
+    """
+    def __init__(self, keep_solver_calls=True):
+        self.keep_solver_calls = keep_solver_calls
+        self.phase_times = OrderedDict()
+        self.phase_counts = OrderedDict()
+        self.solver_calls = []
+        self.num_solver_calls = 0
+        self.solver_iterations = 0
+        self.solver_statuses = OrderedDict()
+        self.total_time = None
+        #ru_maxrss only ever grows over the lifetime of the process, so the
+        # peak at the start is kept to tell whether this solve raised it
+        self.start_process_peak_memory_mb = get_peak_memory_mb()
+        self.process_peak_memory_mb = None
+        self.children_peak_memory_mb = None
+        self._start_time = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase_time(name, time.time()-start)
+
+    def add_phase_time(self, name, wall_time):
+        self.phase_times[name] = self.phase_times.get(name, 0.0)+wall_time
+        self.phase_counts[name] = self.phase_counts.get(name, 0)+1
+        self.on_phase_end(name=name, wall_time=wall_time)
+
+    def record_solver_call(self, prob, engine, num_obs, wall_time):
+        #prob is a solved cvxpy Problem or a NativeSolveResult; the
+        # canonicalization (compilation) time that cvxpy reports is split
+        # off from the rest of wall_time
+        compilation_time = getattr(prob, "compilation_time", None) or 0.0
+        solver_stats = getattr(prob, "solver_stats", None)
+        num_iters = (solver_stats.num_iters if solver_stats is not None
+                     else getattr(prob, "num_iters", None))
+        self.add_phase_time("canonicalization", compilation_time)
+        self.add_phase_time("solver", wall_time-compilation_time)
+        call = OrderedDict([
+            ("engine", engine), ("num_obs", num_obs),
+            ("status", prob.status), ("num_iters", num_iters),
+            ("canonicalization_time", compilation_time),
+            ("wall_time", wall_time)])
+        self.num_solver_calls += 1
+        self.solver_iterations += (num_iters or 0)
+        self.solver_statuses[prob.status] =\
+            self.solver_statuses.get(prob.status, 0)+1
+        if (self.keep_solver_calls):
+            self.solver_calls.append(call)
+        self.on_solver_call(call=call)
+
+    def on_phase_end(self, name, wall_time):
+        pass
+
+    def on_solver_call(self, call):
+        pass
+
+    def finish(self):
+        self.total_time = time.time()-self._start_time
+        self.process_peak_memory_mb = get_peak_memory_mb()
+        self.children_peak_memory_mb = get_peak_memory_mb(children=True)
+
+    @property
+    def raised_process_peak_memory(self):
+        #whether the process peak memory grew during this solve (None if
+        # unknown)
+        if (self.process_peak_memory_mb is None):
+            return None
+        return (self.process_peak_memory_mb
+                > self.start_process_peak_memory_mb)
+
+    def to_dict(self):
+        return OrderedDict([
+            ("total_time", self.total_time),
+            ("start_process_peak_memory_mb",
+             self.start_process_peak_memory_mb),
+            ("process_peak_memory_mb", self.process_peak_memory_mb),
+            ("raised_process_peak_memory", self.raised_process_peak_memory),
+            ("children_peak_memory_mb", self.children_peak_memory_mb),
+            ("phase_times", self.phase_times),
+            ("phase_counts", self.phase_counts),
+            ("num_solver_calls", self.num_solver_calls),
+            ("solver_iterations", self.solver_iterations),
+            ("solver_statuses", self.solver_statuses),
+            ("solver_calls", self.solver_calls)])
+
+    def to_json(self, json_output_name=None):
+        #Returns the report as a JSON string, also writing it to
+        # json_output_name if specified
+        json_str = json.dumps(self.to_dict(), indent=2, default=str)
+        if (json_output_name is not None):
+            with open(json_output_name, "w") as f:
+                f.write(json_str)
+        return json_str
+
+    def __str__(self):
+        lines = ["Total time: "+str(self.total_time),
+                 "Process peak memory (MB): "
+                 +str(self.process_peak_memory_mb)
+                 +(" (raised by this solve)"
+                   if self.raised_process_peak_memory else
+                   " (already reached before this solve)"
+                   if self.raised_process_peak_memory is not None else ""),
+                 "Child process peak memory (MB): "
+                 +str(self.children_peak_memory_mb)]
+        for name, wall_time in self.phase_times.items():
+            lines.append("  "+name+": "+("%.4f" % wall_time)+"s over "
+                         +str(self.phase_counts[name])+" call(s)")
+        lines.append("Solver calls: "+str(self.num_solver_calls)
+                     +" ("+str(self.solver_iterations)+" iterations; statuses "
+                     +str(dict(self.solver_statuses))+")")
+        return "\n".join(lines)
@@ -0,0 +1,445 @@
+from __future__ import division, print_function
+import cvxpy as cp
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from .report import log_info
+from .util import InfeasibleError
+
+
+def partition_observations(coors, partition_size):
+    """
+        Recursive coordinate bisection: splits the observations at the
+        median of the coordinate with the largest spread until every
+        partition has at most partition_size observations. Returns a list
+        of index arrays.
+    """
+    partitions = []
+    to_split = [np.arange(len(coors))]
+    while (len(to_split) > 0):
+        idxs = to_split.pop()
+        if (len(idxs) <= partition_size):
+            partitions.append(idxs)
+            continue
+        sub_coors = coors[idxs]
+        axis = np.argmax(np.max(sub_coors, axis=0)-np.min(sub_coors, axis=0))
+        order = np.argsort(sub_coors[:,axis], kind="stable")
+        half = len(idxs)//2
+        to_split.append(idxs[order[half:]])
+        to_split.append(idxs[order[:half]])
+    return partitions
+
+
+def get_pair_members(pairs_matrix):
+    #Recovers the two observations in each row of a pairs matrix (as made
+    # by make_pairs_matrix: positive entry for the first member, negative
+    # entry for the second)
+    coo = pairs_matrix.tocoo()
+    pairs_first = np.zeros(pairs_matrix.shape[0], dtype=int)
+    pairs_second = np.zeros(pairs_matrix.shape[0], dtype=int)
+    pairs_first[coo.row[coo.data > 0]] = coo.col[coo.data > 0]
+    pairs_second[coo.row[coo.data < 0]] = coo.col[coo.data < 0]
+    return pairs_first, pairs_second
+
+
+def get_partitions_with_halos(partitions, pairs_matrix):
+    """
+        Each pair is owned by the partition containing its first member.
+        A partition's local observations are its own ("core") observations
+        followed by the halo: the other members of its pairs that lie in
+        other partitions. Returns, per partition, the local observation
+        indices, the number of core observations and the pairs matrix
+        restricted to the owned pairs and local observations.
+    """
+    pairs_first, pairs_second = get_pair_members(pairs_matrix)
+    owner = np.zeros(pairs_matrix.shape[1], dtype=int)
+    for partition_idx, core_idxs in enumerate(partitions):
+        owner[core_idxs] = partition_idx
+    pair_owner = owner[pairs_first]
+    pairs_matrix = pairs_matrix.tocsr()
+
+    partitions_with_halos = []
+    for partition_idx, core_idxs in enumerate(partitions):
+        owned_pairs = np.nonzero(pair_owner==partition_idx)[0]
+        halo_idxs = np.setdiff1d(pairs_second[owned_pairs], core_idxs)
+        local_idxs = np.concatenate([core_idxs, halo_idxs])
+        local_pairs_matrix = pairs_matrix[owned_pairs][:, local_idxs]
+        partitions_with_halos.append(
+            (local_idxs, len(core_idxs), local_pairs_matrix))
+    return partitions_with_halos
+
+
+class SmoothedPartitionProblem(object):
+    """
+        The ADMM subproblem for one partition: data and usage penalty terms
+        for the core observations, the smoothness penalty for the owned
+        pairs, and a proximal term pulling every local observation towards
+        the consensus target. The target and sqrt(rho) are cp.Parameters,
+        so the problem is compiled once and reused across iterations.
+    """
+    def __init__(self, A, b, endmember_usagepenalty,
+                       conversion_sign_constraints, pairs_matrix, num_core,
+                       num_converted_variables, smoothness_lambda,
+                       sumtooneconstraint):
+        num_endmembers = len(A)-num_converted_variables
+        num_local = pairs_matrix.shape[1]
+        self.x = cp.Variable(shape=(num_local, len(A)))
+        self.sqrt_rho = cp.Parameter(nonneg=True)
+        self.scaled_target = cp.Parameter(shape=(num_local, len(A)))
+        obj = (cp.sum_squares(self.x[:num_core]@A - b[:num_core])
+               + cp.sum_squares(cp.atoms.affine.binary_operators.multiply(
+                        self.x[:num_core,:num_endmembers],
+                        endmember_usagepenalty[:num_core]))
+               + 0.5*cp.sum_squares(self.sqrt_rho*self.x
+                                    - self.scaled_target))
+        if (pairs_matrix.shape[0] > 0):
+            obj += smoothness_lambda*cp.sum_squares(
+                    pairs_matrix@self.x[:,:num_endmembers])
+        constraints = [self.x[:,:num_endmembers] >= 0]
+        if (sumtooneconstraint):
+            constraints.append(cp.sum(self.x[:,:num_endmembers],axis=1)==1)
+        if (num_converted_variables > 0):
+            constraints.append(
+              cp.atoms.affine.binary_operators.multiply(
+                  conversion_sign_constraints,
+                  self.x[:,num_endmembers:]) >= 0)
+        self.prob = cp.Problem(cp.Minimize(obj), constraints)
+
+    def solve(self, target, rho, max_iter):
+        self.sqrt_rho.value = np.sqrt(rho)
+        self.scaled_target.value = np.sqrt(rho)*target
+        self.prob.solve(max_iter=max_iter)
+        return self.x.value, self.prob.status
+
+
+#compiled partition problems of the group owned by this worker process
+# (set by init_partition_worker)
+WORKER_PARTITION_PROBLEMS = None
+
+
+def group_partitions(partition_sizes, num_groups):
+    #Assigns the partitions to num_groups groups of similar total size
+    # (largest first, each to the currently smallest group)
+    groups = [[] for i in range(num_groups)]
+    group_sizes = np.zeros(num_groups)
+    for partition_idx in np.argsort(-np.asarray(partition_sizes),
+                                    kind="stable"):
+        group_idx = np.argmin(group_sizes)
+        groups[group_idx].append(partition_idx)
+        group_sizes[group_idx] += partition_sizes[partition_idx]
+    return [x for x in groups if len(x) > 0]
+
+
+def init_partition_worker(all_partition_kwargs):
+    #Runs once in each worker process: compiles the problems of the
+    # partitions that the worker owns for the whole solve
+    global WORKER_PARTITION_PROBLEMS
+    WORKER_PARTITION_PROBLEMS = [SmoothedPartitionProblem(**x)
+                                 for x in all_partition_kwargs]
+
+
+def solve_partition_group(targets, rho, max_iter):
+    #Runs in a worker process: one ADMM step for each partition it owns
+    return [partition_problem.solve(target=target, rho=rho,
+                                    max_iter=max_iter)
+            for partition_problem, target
+            in zip(WORKER_PARTITION_PROBLEMS, targets)]
+
+
+def compute_smoothed_objective(x, A, b, endmember_usagepenalty, pairs_matrix,
+                               smoothness_lambda, num_converted_variables):
+    num_endmembers = len(A)-num_converted_variables
+    return (np.sum(np.square(x@A - b))
+            + np.sum(np.square(x[:,:num_endmembers]*endmember_usagepenalty))
+            + smoothness_lambda*np.sum(np.square(
+                pairs_matrix@x[:,:num_endmembers])))
+
+
+def admm_smoothed_solve(A, b, num_converted_variables, endmember_usagepenalty,
+                        conversion_sign_constraints, pairs_matrix,
+                        smoothness_lambda, partitions, init_x,
+                        sumtooneconstraint, max_iter, admm_max_iter=200,
+                        admm_tol=1e-4, n_jobs=None):
+    """
+        Smoothness-regularized OMPA via consensus ADMM over overlapping
+        partitions (see get_partitions_with_halos). Every partition keeps
+        its own copy of its local observations; the consensus solution is
+        the average of the copies, and the scaled dual variables push the
+        copies to agree. rho is adapted by residual balancing.
+        Memory scales with the partition size (plus halo) rather than with
+        the square of the number of observations. With n_jobs > 1, each of
+        n_jobs worker processes owns a fixed group of partitions, whose
+        problems it compiles once; after that only the targets and rho are
+        sent each iteration. Returns the consensus solution, a status
+        string and the global objective it reaches.
+    """
+    partitions_with_halos = get_partitions_with_halos(
+                              partitions=partitions, pairs_matrix=pairs_matrix)
+    log_info("Solving",len(partitions),"partitions with halos; largest has",
+             max([len(x[0]) for x in partitions_with_halos]),"observations")
+    all_partition_kwargs = [dict(
+        A=A, b=b[local_idxs],
+        endmember_usagepenalty=endmember_usagepenalty[local_idxs],
+        conversion_sign_constraints=(
+            conversion_sign_constraints[local_idxs]
+            if num_converted_variables > 0 else None),
+        pairs_matrix=local_pairs_matrix, num_core=num_core,
+        num_converted_variables=num_converted_variables,
+        smoothness_lambda=smoothness_lambda,
+        sumtooneconstraint=sumtooneconstraint)
+        for (local_idxs, num_core, local_pairs_matrix)
+        in partitions_with_halos]
+    #number of copies of every observation
+    copy_counts = np.zeros(len(b))
+    for (local_idxs, _, _) in partitions_with_halos:
+        copy_counts[local_idxs] += 1
+
+    z = np.array(init_x, dtype=float)
+    us = [np.zeros((len(x[0]), len(A))) for x in partitions_with_halos]
+    #start rho on the scale of the data term
+    rho = max(np.mean(np.sum(np.square(A), axis=1)), 1e-6)
+    if (n_jobs is not None and n_jobs > 1):
+        #one single-process executor per group, so that every partition is
+        # always solved by the worker that compiled it
+        partition_groups = group_partitions(
+            partition_sizes=[len(x[0]) for x in partitions_with_halos],
+            num_groups=n_jobs)
+        executors = [ProcessPoolExecutor(max_workers=1,
+                        initializer=init_partition_worker,
+                        initargs=([all_partition_kwargs[x]
+                                   for x in partition_group],))
+                     for partition_group in partition_groups]
+        partition_problems = None
+    else:
+        executors = []
+        partition_problems = [SmoothedPartitionProblem(**x)
+                              for x in all_partition_kwargs]
+    del all_partition_kwargs
+    status = "optimal_inaccurate"
+    objective = np.inf
+    try:
+        for admm_iter in range(admm_max_iter):
+            targets = [z[local_idxs] - u for ((local_idxs, _, _), u)
+                       in zip(partitions_with_halos, us)]
+            if (len(executors) > 0):
+                futures = [executor.submit(solve_partition_group,
+                              targets=[targets[x] for x in partition_group],
+                              rho=rho, max_iter=max_iter)
+                           for executor, partition_group
+                           in zip(executors, partition_groups)]
+                results = [None]*len(targets)
+                for partition_group, future in zip(partition_groups,
+                                                   futures):
+                    for partition_idx, result in zip(partition_group,
+                                                     future.result()):
+                        results[partition_idx] = result
+            else:
+                results = [partition_problem.solve(target=target, rho=rho,
+                                                   max_iter=max_iter)
+                           for partition_problem, target
+                           in zip(partition_problems, targets)]
+            for partition_idx, (_, partition_status) in enumerate(results):
+                if (partition_status=="infeasible"):
+                    raise InfeasibleError("Optimization failed for partition "
+                        +str(partition_idx)+" - try lowering the parameter"
+                        +" weights?")
+
+            #consensus update
+            z_old = z
+            z_sum = np.zeros(z.shape)
+            for ((local_idxs, _, _), (x_local, _), u) in zip(
+                    partitions_with_halos, results, us):
+                np.add.at(z_sum, local_idxs, x_local + u)
+            z = z_sum/copy_counts[:,None]
+
+            #dual update and residuals
+            primal_sq = 0.0
+            dual_sq = 0.0
+            z_norm_sq = 0.0
+            u_norm_sq = 0.0
+            for ((local_idxs, _, _), (x_local, _), u) in zip(
+                    partitions_with_halos, results, us):
+                u += x_local - z[local_idxs]
+                primal_sq += np.sum(np.square(x_local - z[local_idxs]))
+                dual_sq += np.sum(np.square(z[local_idxs]
+                                            - z_old[local_idxs]))
+                z_norm_sq += np.sum(np.square(z[local_idxs]))
+                u_norm_sq += np.sum(np.square(u))
+            primal_resid = np.sqrt(primal_sq)
+            dual_resid = rho*np.sqrt(dual_sq)
+
+            objective = compute_smoothed_objective(x=z, A=A, b=b,
+                endmember_usagepenalty=endmember_usagepenalty,
+                pairs_matrix=pairs_matrix,
+                smoothness_lambda=smoothness_lambda,
+                num_converted_variables=num_converted_variables)
+            log_info("ADMM iteration",admm_iter,"objective",objective,
+                     "primal residual",primal_resid,
+                     "dual residual",dual_resid)
+            sys.stdout.flush()
+            if (primal_resid <= admm_tol*max(np.sqrt(z_norm_sq), 1.0)
+                and dual_resid <= admm_tol*max(rho*np.sqrt(u_norm_sq), 1.0)):
+                status = "optimal"
+                break
+
+            #residual balancing; the scaled duals are rescaled along with rho
+            if (primal_resid > 10*dual_resid):
+                rho *= 2.0
+                us = [u/2.0 for u in us]
+            elif (dual_resid > 10*primal_resid):
+                rho /= 2.0
+                us = [u*2.0 for u in us]
+    finally:
+        for executor in executors:
+            executor.shutdown()
+
+    return z, status, objective
+
+
+def make_chain_pairs_matrix(order):
+    #Pairs matrix (in the format of make_pairs_matrix) linking each
+    # observation to the next one in the given order
+    num_pairs = max(len(order)-1, 0)
+    rows = np.concatenate([np.arange(num_pairs), np.arange(num_pairs)])
+    cols = np.concatenate([order[:-1], order[1:]])
+    data = np.concatenate([np.ones(num_pairs), -np.ones(num_pairs)])
+    return scipy.sparse.csr_matrix((data, (rows, cols)),
+                                   shape=(num_pairs, len(order)))
+
+
+def project_rows_onto_simplex(v):
+    #Euclidean projection of every row of v onto {x >= 0, sum(x) = 1}
+    sorted_v = -np.sort(-v, axis=1)
+    cumsum = np.cumsum(sorted_v, axis=1) - 1.0
+    ks = np.arange(1, v.shape[1]+1)
+    num_positive = np.sum((sorted_v - cumsum/ks[None,:]) > 0, axis=1)
+    theta = cumsum[np.arange(len(v)), num_positive-1]/num_positive
+    return np.maximum(v - theta[:,None], 0.0)
+
+
+def get_banded_chain_hessian(A, endmember_usagepenalty, smoothness_lambda,
+                             num_converted_variables, diag_offset):
+    """
+        Hessian of the along-track smoothed objective (plus diag_offset,
+        one entry per variable, on the diagonal) in the upper banded
+        storage of scipy.linalg.cholesky_banded. Observations are assumed
+        to be in chain order, with the variables of each observation
+        stored contiguously, so the chain coupling sits exactly one
+        bandwidth (the number of variables) off the diagonal.
+    """
+    num_obs = len(endmember_usagepenalty)
+    num_vars = len(A)
+    num_endmembers = num_vars-num_converted_variables
+    blocks = np.tile(2*(A@A.T), (num_obs, 1, 1))
+    endmember_diag = 2*np.square(endmember_usagepenalty)
+    #each interior observation appears in two chain pairs
+    num_chain_pairs = np.full(num_obs, 2.0)
+    num_chain_pairs[0] -= 1
+    num_chain_pairs[-1] -= 1
+    endmember_diag += 2*smoothness_lambda*num_chain_pairs[:,None]
+    blocks[:,np.arange(num_endmembers),np.arange(num_endmembers)] +=\
+        endmember_diag
+    blocks[:,np.arange(num_vars),np.arange(num_vars)] += diag_offset[None,:]
+
+    ab = np.zeros((num_vars+1, num_obs*num_vars))
+    for offset in range(num_vars):
+        ab[num_vars-offset].reshape(num_obs, num_vars)[:, offset:] =\
+            blocks[:, np.arange(num_vars-offset), np.arange(offset,num_vars)]
+    ab[0].reshape(num_obs, num_vars)[1:, :num_endmembers] =\
+        -2*smoothness_lambda
+    return ab
+
+
+def banded_smoothed_solve(A, b, num_converted_variables,
+                          endmember_usagepenalty, conversion_sign_constraints,
+                          order, smoothness_lambda, init_x,
+                          sumtooneconstraint, admm_max_iter=10000,
+                          admm_tol=1e-5):
+    """
+        Smoothness-regularized OMPA where the observations form a chain
+        (e.g. consecutive glider samples along the track): the penalty is
+        smoothness_lambda times the squared difference in endmember
+        fractions between each observation and the next one in `order`.
+        Solved by ADMM that splits the quadratic objective from the
+        constraints. The quadratic step is a banded (block-tridiagonal)
+        Cholesky solve and the constraint step is a per-row projection,
+        so each iteration is linear in the number of observations.
+        Returns the solution, a status string and the objective it reaches.
+    """
+    num_obs = len(b)
+    num_vars = len(A)
+    num_endmembers = num_vars-num_converted_variables
+    penalty = endmember_usagepenalty[order]
+    signs = (conversion_sign_constraints[order]
+             if num_converted_variables > 0 else None)
+    c = 2*(b[order]@A.T)
+
+    #per-variable penalty weights: a single weight for all the endmember
+    # fractions (so that their update stays a plain simplex projection) and
+    # one per converted variable, each on the scale of its diagonal entry
+    hessian_diag = 2*np.sum(np.square(A), axis=1)
+    hessian_diag[:num_endmembers] += 2*np.mean(np.square(penalty), axis=0)
+    var_scale = hessian_diag.copy()
+    var_scale[:num_endmembers] = np.mean(hessian_diag[:num_endmembers])
+    rho = 1.0
+
+    def project(v):
+        z = np.array(v)
+        if (sumtooneconstraint):
+            z[:,:num_endmembers] = project_rows_onto_simplex(
+                                    v[:,:num_endmembers])
+        else:
+            z[:,:num_endmembers] = np.maximum(v[:,:num_endmembers], 0.0)
+        if (num_converted_variables > 0):
+            z[:,num_endmembers:] = np.where(signs==0, v[:,num_endmembers:],
+                signs*np.maximum(signs*v[:,num_endmembers:], 0.0))
+        return z
+
+    def factorize(rho):
+        return scipy.linalg.cholesky_banded(get_banded_chain_hessian(
+            A=A, endmember_usagepenalty=penalty,
+            smoothness_lambda=smoothness_lambda,
+            num_converted_variables=num_converted_variables,
+            diag_offset=rho*var_scale))
+
+    z = project(np.array(init_x, dtype=float)[order])
+    u = np.zeros(z.shape)
+    factor = factorize(rho)
+    status = "optimal_inaccurate"
+    for admm_iter in range(admm_max_iter):
+        weights = rho*var_scale[None,:]
+        x = scipy.linalg.cho_solve_banded((factor, False),
+                (c + weights*(z - u)).ravel()).reshape(num_obs, num_vars)
+        z_old = z
+        z = project(x + u)
+        u += x - z
+
+        primal_resid = np.sqrt(np.sum(np.square(x - z)*weights))
+        dual_resid = np.sqrt(np.sum(np.square(z - z_old)*weights))
+        if (primal_resid <= admm_tol*max(
+                np.sqrt(np.sum(np.square(z)*weights)), 1.0)
+            and dual_resid <= admm_tol*max(
+                np.sqrt(np.sum(np.square(u)*weights)), 1.0)):
+            status = "optimal"
+            break
+
+        #residual balancing, checked periodically since every change of rho
+        # needs a new factorization
+        if (admm_iter % 50 == 49 and
+            (primal_resid > 5*dual_resid or dual_resid > 5*primal_resid)):
+            factor_change = np.sqrt(primal_resid/max(dual_resid, 1e-300))
+            rho *= factor_change
+            u /= factor_change
+            factor = factorize(rho)
+    log_info("ADMM finished after",admm_iter+1,"iterations with status",status)
+
+    x = np.zeros(z.shape)
+    x[order] = z
+    objective = compute_smoothed_objective(x=x, A=A, b=b,
+        endmember_usagepenalty=endmember_usagepenalty,
+        pairs_matrix=make_chain_pairs_matrix(order),
+        smoothness_lambda=smoothness_lambda,
+        num_converted_variables=num_converted_variables)
+    return x, status, objective
@@ -2,8 +2,13 @@ from __future__ import division, print_function
 from .ompacore import OMPAProblem, ExportToCsvMixin, OMPASoln
 import numpy as np
 import pandas as pd
+import time
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from cvxpy.error import SolverError
+from .report import log_info, log_warning
+from .cache import hash_arrays
+from .util import InfeasibleError
 
 
 def get_endmember_df_for_range(endmemnames_to_use,
@@ -51,8 +56,283 @@ def get_endmember_df_for_range(endmemnames_to_use,
     return paired_up_endmember_df, endmem_names_present
 
 
-class ThermoclineArraySoln(ExportToCsvMixin):
+class ThermoclineEndmemberIndex(object):
+    """
+        Precomputed interval index over the per-bin endmember tables in
+        endmemname_to_df. The rows of each table are sorted by
+        stratification_col once, so the endmember df for a bin is found
+        with a binary search instead of filtering every table. The
+        endmember df of each bin, the prepped A (weighted A, standardization
+        statistics and conversion rows; see OMPAProblem.prep_A) for each set
+        of OMPA settings, and the compiled cvxpy problems of each bin are
+        kept, so they are reused across solve calls and can be shared
+        between the ThermoclineArrayOMPAProblems of several deployments
+        (pass it as endmember_index).
+    """
+    def __init__(self, endmemname_to_df, endmember_name_column,
+                       stratification_col, endmemnames_to_use=None):
+        if (endmemnames_to_use is None):
+            endmemnames_to_use = sorted(endmemname_to_df.keys())
+        self.endmember_name_column = endmember_name_column
+        self.stratification_col = stratification_col
+        self.endmemnames_to_use = list(endmemnames_to_use)
+        self.tables_key = self.get_tables_key(
+            endmemname_to_df=endmemname_to_df,
+            endmember_name_column=endmember_name_column,
+            stratification_col=stratification_col,
+            endmemnames_to_use=self.endmemnames_to_use)
+        self.endmemname_to_sortedtable = OrderedDict()
+        self.endmemname_to_sortedvals = OrderedDict()
+        for endmemname in self.endmemnames_to_use:
+            df = endmemname_to_df[endmemname]
+            sorted_df = pd.DataFrame(df.iloc[np.argsort(
+                np.asarray(df[stratification_col]), kind="stable")])
+            sorted_df[endmember_name_column] = endmemname
+            self.endmemname_to_sortedtable[endmemname] = sorted_df
+            self.endmemname_to_sortedvals[endmemname] = np.asarray(
+                sorted_df[stratification_col])
+        self.bin_to_endmember_df = OrderedDict()
+        self.bin_to_prepped_A = OrderedDict()
+        self.bin_to_core_problem_cache = OrderedDict()
+
+    @staticmethod
+    def get_tables_key(endmemname_to_df, endmember_name_column,
+                       stratification_col, endmemnames_to_use):
+        #content hash of the endmember tables, for checking whether an
+        # index can be reused
+        return (endmember_name_column, stratification_col,
+                tuple(endmemnames_to_use),
+                hash_arrays(*[pd.util.hash_pandas_object(
+                                 endmemname_to_df[endmemname]).values
+                              for endmemname in endmemnames_to_use]),
+                tuple(tuple(endmemname_to_df[endmemname].columns)
+                      for endmemname in endmemnames_to_use))
+
+    def matches(self, endmemname_to_df, endmember_name_column,
+                      stratification_col, endmemnames_to_use):
+        return self.tables_key==self.get_tables_key(
+            endmemname_to_df=endmemname_to_df,
+            endmember_name_column=endmember_name_column,
+            stratification_col=stratification_col,
+            endmemnames_to_use=endmemnames_to_use)
+
+    @staticmethod
+    def get_bin_key(bin_start, bin_end):
+        return (float(np.round(bin_start, decimals=2)),
+                float(np.round(bin_end, decimals=2)))
+
+    def get_endmember_df_for_range(self, bin_start, bin_end):
+        #Same as get_endmember_df_for_range, but memoized
+        bin_key = self.get_bin_key(bin_start, bin_end)
+        if (bin_key not in self.bin_to_endmember_df):
+            bin_start, bin_end = bin_key
+            correct_rows = []
+            endmem_names_present = []
+            for endmemname in self.endmemnames_to_use:
+                sorted_vals = self.endmemname_to_sortedvals[endmemname]
+                row_start, row_end = np.searchsorted(
+                    sorted_vals, [bin_start, bin_end], side="left")
+                if (row_end==row_start):
+                    continue
+                correct_rows_for_endmemname =\
+                    self.endmemname_to_sortedtable[endmemname].iloc[
+                                                      row_start:row_end]
+                assert len(correct_rows_for_endmemname)==1, (
+                 "Too many rows for bin "+str(bin_start)+" to "+str(bin_end)
+                 +" for column "+self.stratification_col
+                 +":\n"+str(correct_rows_for_endmemname))
+                endmem_names_present.append(endmemname)
+                correct_rows.append(correct_rows_for_endmemname)
+            self.bin_to_endmember_df[bin_key] = (
+                pd.concat(correct_rows), endmem_names_present)
+        return self.bin_to_endmember_df[bin_key]
+
+    def get_prepped_A(self, ompa_problem, bin_start, bin_end):
+        #output of ompa_problem.prep_A for the bin, memoized on the settings
+        # that go into A
+        key = (self.get_bin_key(bin_start, bin_end),
+               ompa_problem.get_A_settings_key())
+        if (key not in self.bin_to_prepped_A):
+            endmember_df_for_range, _ = self.get_endmember_df_for_range(
+                                            bin_start=bin_start,
+                                            bin_end=bin_end)
+            self.bin_to_prepped_A[key] = ompa_problem.prep_A(
+                endmember_df=endmember_df_for_range,
+                endmember_name_column=self.endmember_name_column)
+        return self.bin_to_prepped_A[key]
+
+    def interpolate_endmember_mats(self, strat_vals, param_names,
+                                         max_extrapolation):
+        #Linearly interpolates every endmember's params along the
+        # stratification coordinate, at each value in strat_vals. Returns
+        # the endmember names, the interpolated matrices (dims of
+        # len(strat_vals) X endmembers X params) and a boolean mask of
+        # which endmembers are available at each value: an endmember is
+        # only available within max_extrapolation of the range covered by
+        # its table (beyond the ends of the table its params are held at the
+        # end values), and where its interpolated params aren't NaN
+        strat_vals = np.asarray(strat_vals, dtype=float)
+        perobs_endmember_mat = np.zeros((len(strat_vals),
+                                         len(self.endmemnames_to_use),
+                                         len(param_names)))
+        endmember_available = np.zeros((len(strat_vals),
+                                        len(self.endmemnames_to_use)),
+                                       dtype=bool)
+        for endmemidx, endmemname in enumerate(self.endmemnames_to_use):
+            sorted_vals = self.endmemname_to_sortedvals[endmemname]
+            sorted_table = self.endmemname_to_sortedtable[endmemname]
+            has_val = np.isnan(sorted_vals)==False
+            if (np.sum(has_val)==0):
+                continue
+            sorted_vals = sorted_vals[has_val]
+            for paramidx, param_name in enumerate(param_names):
+                perobs_endmember_mat[:, endmemidx, paramidx] = np.interp(
+                    strat_vals, sorted_vals,
+                    np.asarray(sorted_table[param_name],
+                               dtype=float)[has_val])
+            endmember_available[:, endmemidx] = (
+                (strat_vals >= sorted_vals[0]-max_extrapolation)
+                & (strat_vals <= sorted_vals[-1]+max_extrapolation)
+                & np.all(np.isnan(perobs_endmember_mat[:, endmemidx]) == False,
+                         axis=-1))
+        return (list(self.endmemnames_to_use), perobs_endmember_mat,
+                endmember_available)
+
+    def get_core_problem_cache(self, bin_start, bin_end):
+        #compiled cvxpy problems for the bin (see
+        # OMPAProblem.get_parametrized_core_problem)
+        return self.bin_to_core_problem_cache.setdefault(
+                    self.get_bin_key(bin_start, bin_end), OrderedDict())
+
+
+def solve_obs_subset(ompa_problem, endmember_df_for_range,
+                     endmember_name_column, ompa_core_solve_params):
+    #Solves the observations of ompa_problem as one batch; if that fails,
+    # they are split in halves until the observations that fail are
+    # isolated, so we don't lose more observations than needed.
+    #Returns the list of OMPASolns covering the rows that could be solved,
+    # in order, and the index labels of the rows that failed. Only
+    # infeasibility and solver failures count as failed rows; any other
+    # error is raised.
+    try:
+        ompa_soln = ompa_problem.solve(
+                       endmember_df=endmember_df_for_range,
+                       endmember_name_column=endmember_name_column,
+                       **ompa_core_solve_params)
+        error = None
+    except (SolverError, InfeasibleError) as e:
+        ompa_soln = None
+        error = e
 
+    num_obs = len(ompa_problem.obs_df)
+    if (ompa_soln is not None and ompa_soln.status != "infeasible"):
+        return [ompa_soln], []
+    elif (num_obs > 1):
+        #bisect to find the observations responsible
+        half = int(num_obs/2)
+        solns, failed_obs_indices = [], []
+        for row_idxs in (np.arange(half), np.arange(half, num_obs)):
+            half_solns, half_failed_obs_indices = solve_obs_subset(
+                ompa_problem=ompa_problem.get_problem_for_obs_subset(
+                                                                row_idxs),
+                endmember_df_for_range=endmember_df_for_range,
+                endmember_name_column=endmember_name_column,
+                ompa_core_solve_params=ompa_core_solve_params)
+            solns.extend(half_solns)
+            failed_obs_indices.extend(half_failed_obs_indices)
+        return solns, failed_obs_indices
+    else:
+        cols_to_print = ompa_problem.param_names
+        if (isinstance(error, SolverError)):
+            log_info("Encountered SolverError "+str(error))
+        else:
+            log_warning("Warning! Infeasible"
+                        +(" ("+str(error)+")" if error is not None else "")
+                        +" for:")
+        log_info("obs df:")
+        log_info(ompa_problem.obs_df[cols_to_print])
+        log_info("endmember df:")
+        log_info(endmember_df_for_range[cols_to_print])
+        if (isinstance(error, SolverError)==False):
+            log_info("Try lowering the parameter weights!")
+        return [], [ompa_problem.obs_df.index[0]]
+
+
+def solve_thermocline_bin(ompa_problem, endmember_df_for_range,
+                          endmember_name_column, ompa_core_solve_params,
+                          for_worker=False):
+    #Returns (solns, failed_obs_indices, wall_time) for one bin. With
+    # for_worker=True, the problems attached to the solutions are stripped
+    # of what can't be pickled to send them back from a worker process
+    start = time.time()
+    solns, failed_obs_indices = solve_obs_subset(
+        ompa_problem=ompa_problem,
+        endmember_df_for_range=endmember_df_for_range,
+        endmember_name_column=endmember_name_column,
+        ompa_core_solve_params=ompa_core_solve_params)
+    if (for_worker):
+        for soln in solns:
+            soln.ompa_problem = soln.ompa_problem.get_worker_copy(
+                                                        keep_obs=True)
+    return solns, failed_obs_indices, time.time()-start
+
+
+def parallel_solve_thermocline_bins(bin_args, n_jobs=None, executor=None):
+    #bin_args is a list of ((bin_start, bin_end), kwargs) where kwargs are
+    # the arguments of solve_thermocline_bin. Either n_jobs (the number of
+    # processes in a pool created here) or an existing concurrent.futures
+    # executor can be supplied. Returns the results of
+    # solve_thermocline_bin in bin order. Infeasible observations are
+    # handled within each bin (see solve_obs_subset); any error that
+    # escapes a bin fails the whole solve, as it would without the pool
+    own_executor = executor is None
+    if (own_executor):
+        executor = ProcessPoolExecutor(max_workers=n_jobs)
+    try:
+        futures = []
+        for (_, kwargs) in bin_args:
+            worker_kwargs = OrderedDict(kwargs)
+            #the penalty functions are closures, which can't be pickled;
+            # the penalties themselves were already computed
+            worker_kwargs["ompa_problem"] =\
+                kwargs["ompa_problem"].get_worker_copy(keep_obs=True)
+            futures.append(executor.submit(solve_thermocline_bin,
+                                           for_worker=True, **worker_kwargs))
+        results = []
+        for ((bin_start, bin_end), _), future in zip(bin_args, futures):
+            try:
+                results.append(future.result())
+            except (InfeasibleError, SolverError):
+                for other_future in futures:
+                    other_future.cancel()
+                raise
+            except Exception as e:
+                for other_future in futures:
+                    other_future.cancel()
+                raise RuntimeError("Solving bin "+str(bin_start)+" to "
+                                   +str(bin_end)+" failed: "+repr(e)) from e
+    finally:
+        if (own_executor):
+            executor.shutdown()
+    return results
+
+
+def assembled_field(name):
+    #read-only attribute of a ThermoclineArraySoln that is taken from the
+    # merged solutions (see assemble) on first access
+    return property(lambda self: getattr(self.assemble(), name, None))
+
+
+class ThermoclineArraySoln(ExportToCsvMixin):
+    """
+        Combined solution of a ThermoclineArrayOMPAProblem over the
+        OMPASolns in thermocline_ompa_results (one per bin, or per chunk of
+        a bin). The per-observation fields used for plotting and csv export
+        (obs_df, endmember_fractions, param_residuals...) are assembled on
+        first access by ExportToCsvMixin.merge_many, in one pass that writes
+        the rows of every solution into preallocated arrays, with the
+        endmembers in the order of endmemnames_to_use.
+    """
     def __init__(self, endmemname_to_df,
                        endmember_name_column,
                        endmemnames_to_use,
@@ -62,50 +342,32 @@ class ThermoclineArraySoln(ExportToCsvMixin):
         self.endmemnames_to_use = endmemnames_to_use
         self.thermocline_ompa_problem = thermocline_ompa_problem
         self.thermocline_ompa_results = thermocline_ompa_results
+        self._assembled = None
 
-        #expand solution objects to included full set of endmembers
-        fullsetendmembers_self = [
-            x.insert_blank_endmembers_as_needed(
-                new_endmember_names=endmemnames_to_use)
-            for x in self]
-
-        #get attributes in a format that is compatible with the API
-        # of OMPASoln, for plotting and csv export purposes
-        self.obs_df = pd.concat([x.obs_df for x in fullsetendmembers_self])
-        self.endmember_names = fullsetendmembers_self[0].endmember_names
-        self.param_names = self[0].param_names
-        self.endmember_fractions = np.concatenate([
-            x.endmember_fractions for x in fullsetendmembers_self], axis=0) 
-        self.converted_variables = np.concatenate([
-            x.converted_variables for x in fullsetendmembers_self], axis=0)
-        self.param_residuals = np.concatenate([
-            x.param_residuals for x in fullsetendmembers_self], axis=0)
-        #getting the groupname_to_xxx attributes ready
-        self.groupname_to_totalconvertedvariable = OrderedDict()
-        self.groupname_to_effectiveconversionratios = OrderedDict()
-        for groupname in (self[0].groupname_to_totalconvertedvariable):
-            self.groupname_to_totalconvertedvariable[groupname] =\
-                np.concatenate([
-                    x.groupname_to_totalconvertedvariable[groupname]
-                    for x in self
-                ], axis=0)
-            self.groupname_to_effectiveconversionratios[groupname] =\
-                    OrderedDict()
-            for paramname in (self[0].
-                            groupname_to_effectiveconversionratios[groupname]): 
-                self.groupname_to_effectiveconversionratios[
-                    groupname][paramname] = (
-                 np.concatenate([
-                  x.groupname_to_effectiveconversionratios[
-                        groupname][paramname]
-                  for x in self
-                 ], axis=0))
-        #getting endmembername to usage penalty
-        self.endmembername_to_usagepenalty = OrderedDict()
-        for endmembername in self.endmember_names:
-            self.endmembername_to_usagepenalty[endmembername] =\
-             np.concatenate([x.endmembername_to_usagepenalty[endmembername]
-                             for x in fullsetendmembers_self], axis=0) 
+    obs_df = assembled_field("obs_df")
+    endmember_names = assembled_field("endmember_names")
+    endmembername_to_indices = assembled_field("endmembername_to_indices")
+    param_names = assembled_field("param_names")
+    endmember_fractions = assembled_field("endmember_fractions")
+    converted_variables = assembled_field("converted_variables")
+    param_residuals = assembled_field("param_residuals")
+    perobs_weighted_resid_sq = assembled_field("perobs_weighted_resid_sq")
+    perobs_obj = assembled_field("perobs_obj")
+    groupname_to_totalconvertedvariable = assembled_field(
+                                    "groupname_to_totalconvertedvariable")
+    groupname_to_effectiveconversionratios = assembled_field(
+                                    "groupname_to_effectiveconversionratios")
+    endmembername_to_usagepenalty = assembled_field(
+                                    "endmembername_to_usagepenalty")
+
+    def assemble(self):
+        #the per-bin results merged by ExportToCsvMixin.merge_many, computed
+        # once
+        if (self._assembled is None):
+            self._assembled = ExportToCsvMixin.merge_many(
+                        self.thermocline_ompa_results,
+                        endmember_names=self.endmemnames_to_use)
+        return self._assembled
 
     def with_endmemtype_names_quant_ambig_via_res_lim(self,
               endmemtypename_to_weight, *args, **kwargs):
@@ -149,8 +411,19 @@ class ThermoclineArraySoln(ExportToCsvMixin):
                     endmemnames_to_use=self.endmemnames_to_use,
                     thermocline_ompa_problem=None,
                     thermocline_ompa_results=solns) 
-        to_return.perobs_obj = np.concatenate(
-            [x.perobs_obj for x in to_return], axis=0) 
+        return to_return
+
+    def core_quantify_ambiguity_via_nullspace(self, *args, **kwargs):
+        #(each bin has its own endmember set, and hence nullspace)
+        solns = [
+         OMPASoln.core_quantify_ambiguity_via_nullspace(x, *args, **kwargs)
+         for x in self] 
+        to_return =  ThermoclineArraySoln(
+                    endmemname_to_df=self.endmemname_to_df,
+                    endmember_name_column=self.endmember_name_column,
+                    endmemnames_to_use=self.endmemnames_to_use,
+                    thermocline_ompa_problem=None,
+                    thermocline_ompa_results=solns) 
         return to_return
 
     def __len__(self):
@@ -167,9 +440,13 @@ class ThermoclineArrayOMPAProblem(object):
 
     def __init__(self, stratification_col,
                        tc_lower_bound, tc_upper_bound, tc_step,
-                       obs_df,
+                       obs_df, endmember_index=None,
                        **ompa_core_params):
+        #endmember_index is an optional ThermoclineEndmemberIndex (e.g. one
+        # shared with the problem for another deployment); a new one is
+        # built on the first solve otherwise
         self.stratification_col = stratification_col
+        self.endmember_index = endmember_index
         self.tc_lower_bound = tc_lower_bound
         self.tc_upper_bound = tc_upper_bound
         self.tc_step = tc_step
@@ -177,83 +454,190 @@ class ThermoclineArrayOMPAProblem(object):
         self.ompa_core_params = ompa_core_params
         if (np.min(self.obs_df[self.stratification_col])
             < self.tc_lower_bound):
-            print("==============================")
-            print("Heads up! You specified a tc lower bound of",
-                  tc_lower_bound,"but the observations df contains samples"
-                  +" with a",self.stratification_col,
-                  "as low as",np.min(self.obs_df[self.stratification_col]))
-            print("==============================")
+            log_warning("==============================")
+            log_warning("Heads up! You specified a tc lower bound of",
+                tc_lower_bound,"but the observations df contains samples"
+                +" with a",self.stratification_col,
+                "as low as",np.min(self.obs_df[self.stratification_col]))
+            log_warning("==============================")
         if (np.max(self.obs_df[self.stratification_col])
             > self.tc_upper_bound):
-            print("==============================")
-            print("Heads up! You specified a tc upper bound of",
-                  tc_upper_bound,"but the observations df contains samples"
-                  +" with a",self.stratification_col,
-                  "as high as",np.max(self.obs_df[self.stratification_col]))
-            print("==============================")
+            log_warning("==============================")
+            log_warning("Heads up! You specified a tc upper bound of",
+                tc_upper_bound,"but the observations df contains samples"
+                +" with a",self.stratification_col,
+                "as high as",np.max(self.obs_df[self.stratification_col]))
+            log_warning("==============================")
+
+    def get_endmember_index(self, endmemname_to_df, endmember_name_column,
+                                  endmemnames_to_use):
+        #the endmember index for these tables, built if needed
+        if (self.endmember_index is None
+            or self.endmember_index.matches(
+                endmemname_to_df=endmemname_to_df,
+                endmember_name_column=endmember_name_column,
+                stratification_col=self.stratification_col,
+                endmemnames_to_use=endmemnames_to_use)==False):
+            self.endmember_index = ThermoclineEndmemberIndex(
+                endmemname_to_df=endmemname_to_df,
+                endmember_name_column=endmember_name_column,
+                stratification_col=self.stratification_col,
+                endmemnames_to_use=endmemnames_to_use)
+        return self.endmember_index
+
+    def solve_interpolated(self, endmemname_to_df,
+                                 endmember_name_column="endmember_name",
+                                 endmemnames_to_use=None,
+                                 max_extrapolation=None, **solve_params):
+        #Instead of snapping each observation to a tc_step bin, the
+        # endmember properties are interpolated to every observation's
+        # stratification value, and all the observations between
+        # tc_lower_bound and tc_upper_bound are solved together with the
+        # native engine (see OMPAProblem.solve_perobs_endmember_mats, which
+        # gets solve_params). An endmember is used for an observation only
+        # if the observation is within max_extrapolation (default: tc_step)
+        # of the range covered by the endmember's table; observations with
+        # no such endmember are skipped and recorded in
+        # self.failed_obs_indices
+        if (endmemnames_to_use is None):
+            endmemnames_to_use = sorted(endmemname_to_df.keys())
+        if (max_extrapolation is None):
+            max_extrapolation = self.tc_step
+        endmember_index = self.get_endmember_index(
+            endmemname_to_df=endmemname_to_df,
+            endmember_name_column=endmember_name_column,
+            endmemnames_to_use=endmemnames_to_use)
+
+        obs_df = self.obs_df[
+            (self.obs_df[self.stratification_col] >= self.tc_lower_bound)
+            & (self.obs_df[self.stratification_col] <= self.tc_upper_bound)]
+        #rows with NA params are dropped by OMPAProblem anyway
+        obs_df = obs_df.dropna(subset=self.ompa_core_params['param_names'])
+        endmember_names, perobs_endmember_mat, endmember_available =\
+            endmember_index.interpolate_endmember_mats(
+                strat_vals=obs_df[self.stratification_col],
+                param_names=self.ompa_core_params['param_names'],
+                max_extrapolation=max_extrapolation)
+        has_endmembers = np.any(endmember_available, axis=1)
+        self.failed_obs_indices = list(obs_df.index[has_endmembers==False])
+        if (len(self.failed_obs_indices) > 0):
+            log_warning("Warning! No endmembers available for",
+                        len(self.failed_obs_indices),"observations with "
+                        +self.stratification_col,"values",
+                        np.unique(obs_df[self.stratification_col][
+                                    has_endmembers==False]))
+
+        ompa_soln = OMPAProblem(obs_df=obs_df[has_endmembers],
+                                **self.ompa_core_params
+                    ).solve_perobs_endmember_mats(
+                        endmember_names=endmember_names,
+                        perobs_endmember_mat=perobs_endmember_mat[
+                                                            has_endmembers],
+                        endmember_available=endmember_available[
+                                                            has_endmembers],
+                        **solve_params)
+        self.thermocline_ompa_results = [ompa_soln]
+
+        return ThermoclineArraySoln(
+                 endmemname_to_df=endmemname_to_df,
+                 endmember_name_column=endmember_name_column,
+                 endmemnames_to_use=endmemnames_to_use,
+                 thermocline_ompa_problem=self,
+                 thermocline_ompa_results=self.thermocline_ompa_results)
 
     def solve(self, endmemname_to_df, endmember_name_column="endmember_name",
-                    endmemnames_to_use=None,
+                    endmemnames_to_use=None, bin_n_jobs=None,
+                    bin_executor=None,
                     **ompa_core_solve_params): 
+        #The bins are independent, so they are spread over a process pool
+        # if bin_n_jobs > 1 or if a concurrent.futures executor is supplied
+        # as bin_executor (n_jobs and executor in ompa_core_solve_params
+        # still refer to the batches within a bin). Timings and failure
+        # counts per bin are stored in self.bin_summaries; only infeasible
+        # observations (or ones the solver failed on) count as failed, and
+        # any other error, in a worker or not, is raised
 
         if (endmemnames_to_use is None):
             endmemnames_to_use = sorted(endmemname_to_df.keys())
+        self.get_endmember_index(endmemname_to_df=endmemname_to_df,
+                                 endmember_name_column=endmember_name_column,
+                                 endmemnames_to_use=endmemnames_to_use)
 
-        thermocline_ompa_results = []
+        bin_args = []
         for bin_start in np.arange(self.tc_lower_bound,
                                    self.tc_upper_bound, self.tc_step):
             bin_end = bin_start + self.tc_step
             #Get the endmember dataframe for OMPA analysis corresponding to the
             #range 
             endmember_df_for_range, endmem_names_present =\
-              get_endmember_df_for_range(
-                  stratification_col=self.stratification_col,
-                  endmemnames_to_use=endmemnames_to_use,
-                  endmemname_to_df=endmemname_to_df,
-                  endmember_name_column=endmember_name_column,
-                  bin_start=bin_start,
-                  bin_end=bin_end)
+              self.endmember_index.get_endmember_df_for_range(
+                  bin_start=bin_start, bin_end=bin_end)
 
             #filter gp15_thermocline using bin_start and bin_end
             obs_df_for_range = self.obs_df[
                           (self.obs_df[self.stratification_col] >= bin_start)
                           & (self.obs_df[self.stratification_col] <= bin_end)]
             if (len(obs_df_for_range)==0):
-              print("No observations for range", bin_start, bin_end)
+              log_info("No observations for range", bin_start, bin_end)
               continue #skip this iteration of the loop
             
             #Now that you have the data frames for the observations and
-            # end members, you can define the ompa problem
-            #Do one observation at a time so that if the problem is infeasible
-            # we don't lose more observations than needed
-            for rowidx in range(len(obs_df_for_range)):
-                one_obs = obs_df_for_range.iloc[rowidx:rowidx+1]
-                try:
-                    ompa_soln = OMPAProblem(
-                                 obs_df=one_obs,
-                                 **self.ompa_core_params).solve(
-                                   endmember_df=endmember_df_for_range,
-                                   endmember_name_column=endmember_name_column,
-                                   **ompa_core_solve_params)
-
-                    if (ompa_soln.status != "infeasible"):
-                        thermocline_ompa_results.append(
-                            ompa_soln)
-                    else:
-                        print("Warning! Infeasible for:")
-                        print("obs df:")
-                        cols_to_print = self.ompa_core_params['param_names']
-                        print(one_obs[cols_to_print])
-                        print("endmember df:")
-                        print(endmember_df_for_range[cols_to_print])
-                        print("Try lowering the parameter weights!")
-                except SolverError as e:
-                    print("Encountered SolverError "+str(e))
-                    print("obs df:")
-                    cols_to_print = self.ompa_core_params['param_names']  
-                    print(one_obs[cols_to_print])
-                    print("endmember df:")
-                    print(endmember_df_for_range[cols_to_print])
+            # end members, you can define the ompa problem (the usage
+            # penalties are computed here, so that the worker processes
+            # don't need the penalty functions). A and the compiled
+            # problems come from the endmember index
+            ompa_problem = OMPAProblem(obs_df=obs_df_for_range,
+                                       **self.ompa_core_params)
+            ompa_problem.core_problem_cache =\
+                self.endmember_index.get_core_problem_cache(
+                    bin_start=bin_start, bin_end=bin_end)
+            prepped_A = self.endmember_index.get_prepped_A(
+                ompa_problem=ompa_problem,
+                bin_start=bin_start, bin_end=bin_end)
+            bin_args.append(((bin_start, bin_end), OrderedDict([
+                ("ompa_problem", ompa_problem),
+                ("endmember_df_for_range", endmember_df_for_range),
+                ("endmember_name_column", endmember_name_column),
+                ("ompa_core_solve_params", OrderedDict(
+                    ompa_core_solve_params, prepped_A=prepped_A))])))
+
+        if ((bin_n_jobs is not None and bin_n_jobs > 1)
+            or bin_executor is not None):
+            log_info("Dispatching",len(bin_args),"bins to worker processes")
+            bin_results = parallel_solve_thermocline_bins(
+                bin_args=bin_args, n_jobs=bin_n_jobs,
+                executor=bin_executor)
+        else:
+            bin_results = [solve_thermocline_bin(**kwargs)
+                           for (_, kwargs) in bin_args]
+
+        thermocline_ompa_results = []
+        #index labels (in self.obs_df) of the observations that couldn't be
+        # solved
+        self.failed_obs_indices = []
+        self.bin_summaries = []
+        for ((bin_start, bin_end), kwargs),\
+            (solns, failed_obs_indices, wall_time) in zip(bin_args,
+                                                          bin_results):
+            for soln in solns:
+                #the penalty functions were left out when shipping to the
+                # worker processes
+                soln.ompa_problem.endmembername_to_usagepenaltyfunc =\
+                    kwargs["ompa_problem"].endmembername_to_usagepenaltyfunc
+            thermocline_ompa_results.extend(solns)
+            self.failed_obs_indices.extend(failed_obs_indices)
+            self.bin_summaries.append(OrderedDict([
+                ("bin_start", bin_start), ("bin_end", bin_end),
+                ("num_obs", len(kwargs["ompa_problem"].obs_df)),
+                ("num_failed", len(failed_obs_indices)),
+                ("wall_time", wall_time)]))
+            log_info("Bin",np.round(bin_start, decimals=2),"to",
+                     np.round(bin_end, decimals=2),"-",
+                     len(kwargs["ompa_problem"].obs_df),"observations,",
+                     len(failed_obs_indices),"failed, took",
+                     ("%.3f" % wall_time),"s")
+        log_info("Solved",len(self.bin_summaries),"bins;",
+                 len(self.failed_obs_indices),"observations failed")
 
         self.thermocline_ompa_results = thermocline_ompa_results
 
@@ -263,4 +647,3 @@ class ThermoclineArrayOMPAProblem(object):
                  endmemnames_to_use=endmemnames_to_use,
                  thermocline_ompa_problem=self,
                  thermocline_ompa_results=thermocline_ompa_results)
-
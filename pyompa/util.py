@@ -1,6 +1,17 @@
 from __future__ import division, print_function
 from collections import OrderedDict
 import numpy as np
+import pandas as pd
+from .report import log_warning
+
+
+class InfeasibleError(RuntimeError):
+    """
+        Raised when an OMPA problem (or some of its observations) has no
+        feasible solution, as opposed to errors from bugs or failing
+        worker processes.
+    """
+    pass
 
 
 def assert_compatible_keys(the_dict, allowed, errorprefix):
@@ -76,8 +87,8 @@ def organize_converted_vars_by_groupname(converted_variables,
         for convar_vals_row in convar_vals:
             if ((all(convar_vals_row >= 0) or
                  all(convar_vals_row <= 0))==False):
-                print("WARNING: sign inconsistency in "
-                      +groupname+":", convar_vals_row)
+                log_warning("WARNING: sign inconsistency in "
+                            +groupname+":", convar_vals_row)
         total_convar = np.sum(convar_vals, axis=-1)
         groupname_to_totalconvertedvariable[groupname] =\
             total_convar 
@@ -100,6 +111,81 @@ def organize_converted_vars_by_groupname(converted_variables,
     return (groupname_to_totalconvertedvariable,
             groupname_to_effectiveconversionratios) 
 
+
+def apply_A(x, A):
+    #x@A, where A can also be a stack of per-observation matrices (dims of
+    # observations X vars X params)
+    if (A.ndim==3):
+        return np.einsum('ni,nip->np', x, A)
+    return x@A
+
+
+class GrowableArray(object):
+    """
+        Numpy array that can be appended to along the first axis in
+        amortized O(rows appended) time, by doubling an over-allocated
+        buffer when it fills up. view() returns the filled part (without
+        copying).
+    """
+    def __init__(self, arr):
+        self.buffer = np.array(arr)
+        self.size = len(self.buffer)
+
+    def append(self, rows):
+        rows = np.asarray(rows)
+        needed = self.size+len(rows)
+        dtype = np.result_type(self.buffer, rows)
+        if (needed > len(self.buffer) or dtype != self.buffer.dtype):
+            new_buffer = np.empty(
+                (max(needed, 2*len(self.buffer)),)+self.buffer.shape[1:],
+                dtype=dtype)
+            new_buffer[:self.size] = self.buffer[:self.size]
+            self.buffer = new_buffer
+        self.buffer[self.size:needed] = rows
+        self.size = needed
+
+    def view(self):
+        return self.buffer[:self.size]
+
+
+class GrowableDataFrame(object):
+    """
+        pandas counterpart of GrowableArray. Rows are indexed by position.
+        New rows are written into the spare rows in place, which pandas
+        only does without copying if no other view of the buffer (e.g. an
+        older result of view()) is still referenced.
+    """
+    def __init__(self, df):
+        self.buffer = df.reset_index(drop=True)
+        self.size = len(self.buffer)
+
+    def append(self, new_df):
+        if (len(new_df)==0):
+            return
+        new_df = new_df[list(self.buffer.columns)]
+        needed = self.size+len(new_df)
+        #column dtypes that concatenating new_df would give (the pandas
+        # counterpart of np.result_type); the buffer is reallocated when
+        # they change, since pandas won't write e.g. strings into a float
+        # column in place
+        dtypes = pd.concat([self.buffer.iloc[:0], new_df.iloc[:0]]).dtypes
+        if (needed > len(self.buffer)
+            or dtypes.equals(self.buffer.dtypes)==False):
+            #pad with copies of the last new row so that column dtypes
+            # are preserved
+            num_pad = max(needed, 2*len(self.buffer))-needed
+            self.buffer = pd.concat([self.buffer.iloc[:self.size], new_df,
+                                     new_df.iloc[[len(new_df)-1]*num_pad]],
+                                    ignore_index=True)
+        else:
+            for col_idx, col in enumerate(self.buffer.columns):
+                self.buffer.iloc[self.size:needed, col_idx] =\
+                    new_df[col].to_numpy()
+        self.size = needed
+
+    def view(self):
+        return self.buffer.iloc[:self.size]
+
 #import gsw
 #
 #
@@ -12,6 +12,9 @@ if __name__== '__main__':
           packages=find_packages(),
           setup_requires=[],
           install_requires=['numpy', 'pandas', 'cvxpy', 'scipy', 'toml'],
-          extras_require={'altair': ['altair']},
+          extras_require={'altair': ['altair'],
+                          'parquet': ['pyarrow'],
+                          'feather': ['pyarrow'],
+                          'netcdf': ['netCDF4']},
           scripts=['scripts/run_ompa_given_config'],
           name='pyompa')
@@ -0,0 +1,79 @@
+from __future__ import division, print_function
+import numpy as np
+import pandas as pd
+import pytest
+from pyompa.util import GrowableDataFrame
+from test_engines import make_problem
+
+
+def test_growable_dataframe_changed_dtype():
+    growable = GrowableDataFrame(pd.DataFrame({"x": [1.0, 2.0, 3.0, 4.0],
+                                               "note": [np.nan]*4}))
+    growable.append(pd.DataFrame({"x": [5.0], "note": [np.nan]}))
+    #an all-NaN float column that later gets strings
+    growable.append(pd.DataFrame({"x": [6.0], "note": ["surfacing"]}))
+    view = growable.view()
+    assert list(view["x"]) == [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+    assert view["note"].iloc[-1] == "surfacing"
+    assert view["note"].iloc[:5].isna().all()
+
+
+def solve_first_rows(num_rows):
+    ompa_problem, endmember_df = make_problem(with_conversion=True,
+                                              with_penalty=True)
+    obs_df = ompa_problem.obs_df.copy()
+    obs_df["note"] = np.nan
+    ompa_soln = ompa_problem.get_problem_for_new_obs(
+        obs_df.iloc[:num_rows]).solve(endmember_df=endmember_df,
+                                   endmember_name_column="name",
+                                   engine="native")
+    return ompa_soln, obs_df
+
+
+def test_append_observations_changed_dtype():
+    ompa_soln, obs_df = solve_first_rows(20)
+    #the second chunk fits in the spare rows left by the first
+    ompa_soln.append_observations(obs_df.iloc[20:25], engine="native")
+    new_obs_df = obs_df.iloc[25:40].copy()
+    new_obs_df["note"] = "surfacing"
+    ompa_soln.append_observations(new_obs_df, engine="native")
+    ompa_soln.append_observations(obs_df.iloc[40:], engine="native")
+
+    full_problem, endmember_df = make_problem(with_conversion=True,
+                                              with_penalty=True)
+    full_soln = full_problem.solve(endmember_df=endmember_df,
+                                   endmember_name_column="name",
+                                   engine="native")
+    assert len(ompa_soln.obs_df) == len(obs_df)
+    assert list(ompa_soln.obs_df["note"].iloc[25:40]) == ["surfacing"]*15
+    assert ompa_soln.obs_df["note"].iloc[40:].isna().all()
+    assert ompa_soln.ompa_problem.obs_df is ompa_soln.obs_df
+    np.testing.assert_allclose(ompa_soln.endmember_fractions,
+                               full_soln.endmember_fractions, atol=1e-8)
+    np.testing.assert_allclose(ompa_soln.resid_wsumsq,
+                               full_soln.resid_wsumsq, rtol=1e-8)
+
+
+def test_failed_extend_leaves_soln_unchanged():
+    ompa_soln, obs_df = solve_first_rows(20)
+    new_soln = ompa_soln.ompa_problem.get_problem_for_new_obs(
+        obs_df.iloc[20:30]).solve(
+            endmember_df=ompa_soln.endmember_df,
+            endmember_name_column=ompa_soln.endmember_name_column,
+            engine="native")
+    #breaks the append part way through
+    new_soln.converted_variables = None
+    fractions = ompa_soln.endmember_fractions.copy()
+    resid_wsumsq = ompa_soln.resid_wsumsq
+    with pytest.raises(Exception):
+        ompa_soln.extend(new_soln)
+    assert len(ompa_soln.obs_df) == 20
+    assert ompa_soln.ompa_problem.obs_df is ompa_soln.obs_df
+    np.testing.assert_array_equal(ompa_soln.endmember_fractions, fractions)
+    assert ompa_soln.resid_wsumsq == resid_wsumsq
+
+    #and a later append still works
+    new_soln = ompa_soln.append_observations(obs_df.iloc[20:30],
+                                             engine="native")
+    assert len(ompa_soln.obs_df) == 30
+    assert len(ompa_soln.endmember_fractions) == 30
@@ -0,0 +1,98 @@
+from __future__ import division, print_function
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import pytest
+from pyompa import OMPAProblem, ConvertedParamGroup, GeneralPenaltyFunc
+
+
+PARAM_NAMES = ["temp", "salinity", "phosphate", "nitrate", "oxygen",
+               "silicate"]
+
+
+def make_problem(with_conversion, with_penalty, num_obs=60, seed=0):
+    #Synthetic observations mixed from 5 endmembers, with remineralization
+    # (of either sign) and noise added. Half the rows are well inside the
+    # simplex, so that screen=True accepts some of them in closed form
+    rng = np.random.RandomState(seed)
+    endmember_df = pd.DataFrame(OrderedDict([
+        ("name", ["E%d" % i for i in range(5)]),
+        ("temp", rng.uniform(2, 20, 5)),
+        ("salinity", rng.uniform(34, 36, 5)),
+        ("phosphate", rng.uniform(0.5, 3, 5)),
+        ("nitrate", rng.uniform(5, 40, 5)),
+        ("oxygen", rng.uniform(100, 300, 5)),
+        ("silicate", rng.uniform(5, 100, 5))]))
+    fractions = np.concatenate([
+        rng.dirichlet(np.ones(5)*0.3, size=num_obs//2),
+        rng.dirichlet(np.ones(5)*20, size=num_obs-num_obs//2)])
+    obs = fractions@np.array(endmember_df[PARAM_NAMES])
+    if (with_conversion):
+        remin = rng.uniform(-5, 30, num_obs)
+        obs[:,2] += remin/170.0
+        obs[:,3] += remin*16/170.0
+        obs[:,4] -= remin
+    obs += rng.normal(size=obs.shape)*np.array([0.05, 0.01, 0.02, 0.3, 2, 1])
+    obs_df = pd.DataFrame(obs, columns=PARAM_NAMES)
+    obs_df["depth"] = rng.uniform(0, 1000, num_obs)
+
+    convertedparam_groups = ([ConvertedParamGroup(groupname="oxygen",
+        conversion_ratios=[
+            {"oxygen": -1, "phosphate": 1/170.0, "nitrate": 16/170.0},
+            {"oxygen": -1, "phosphate": 1/130.0, "nitrate": 16/130.0}],
+        always_positive=False)] if with_conversion else [])
+    usagepenaltyfuncs = ({"E0": GeneralPenaltyFunc({"depth": {
+        "type": "linear_other", "slope": 0.05, "upperbound": 500}})}
+        if with_penalty else {})
+    ompa_problem = OMPAProblem(obs_df=obs_df, param_names=PARAM_NAMES,
+        convertedparam_groups=convertedparam_groups,
+        param_weightings={"temp": 56, "salinity": 80, "phosphate": 2,
+                          "nitrate": 1, "oxygen": 1, "silicate": 1},
+        endmembername_to_usagepenaltyfunc=usagepenaltyfuncs)
+    return ompa_problem, endmember_df
+
+
+def get_objective(ompa_soln):
+    #weighted residuals plus usage penalties
+    penalty = np.sum(np.square(
+        ompa_soln.endmember_fractions
+        *ompa_soln.ompa_problem.endmember_usagepenalty))
+    return ompa_soln.resid_wsumsq + penalty
+
+
+@pytest.mark.parametrize("with_conversion", [False, True])
+@pytest.mark.parametrize("with_penalty", [False, True])
+@pytest.mark.parametrize("engine,screen", [("native", False),
+                                           ("native", True),
+                                           ("enumerate", False)])
+def test_engine_matches_cvxpy(engine, screen, with_conversion,
+                              with_penalty):
+    ompa_problem, endmember_df = make_problem(
+        with_conversion=with_conversion, with_penalty=with_penalty)
+    reference = ompa_problem.solve(endmember_df=endmember_df,
+                                   endmember_name_column="name",
+                                   engine="cvxpy")
+    reference_objective = get_objective(reference)
+    ompa_soln = ompa_problem.solve(endmember_df=endmember_df,
+                                   endmember_name_column="name",
+                                   engine=engine, screen=screen)
+    if (screen and with_penalty==False):
+        assert ompa_soln.rows_per_solve_path["closed_form"] > 0
+
+    np.testing.assert_allclose(ompa_soln.endmember_fractions,
+                               reference.endmember_fractions, atol=1e-4)
+    np.testing.assert_allclose(get_objective(ompa_soln),
+                               reference_objective, rtol=1e-5)
+    if (with_conversion):
+        #the two conversion ratios are nearly collinear, so only their total
+        # is well determined
+        np.testing.assert_allclose(
+            ompa_soln.groupname_to_totalconvertedvariable["oxygen"],
+            reference.groupname_to_totalconvertedvariable["oxygen"],
+            rtol=1e-4, atol=1e-3)
+    else:
+        assert ompa_soln.converted_variables is None
+    #the constraints hold exactly
+    assert np.all(ompa_soln.endmember_fractions >= 0)
+    np.testing.assert_allclose(
+        np.sum(ompa_soln.endmember_fractions, axis=1), 1.0, atol=1e-12)
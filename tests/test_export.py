@@ -0,0 +1,123 @@
+from __future__ import division, print_function
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import pytest
+from pyompa.export import (ExportWriter, get_netcdf_var_name,
+                           NETCDF_DEFAULT_CHUNK_SIZE)
+
+
+def make_export_df(start, num_rows):
+    #a stand-in for the output of get_export_df, with one column of every
+    # kind that the writers convert
+    rows = np.arange(start, start+num_rows)
+    return pd.DataFrame(OrderedDict([
+        ("station", ["st%d" % i for i in rows]),
+        ("time", pd.Timestamp("2020-01-01")+pd.to_timedelta(rows, "h")),
+        ("depth", rows.astype(np.int64)),
+        ("is_surface", rows % 2 == 0),
+        ("oxygen/resid", rows*0.5),
+        ("E0_frac", rows/100.0),
+        ("E1_frac", np.where(rows % 3 == 0, np.nan, 0.25))]))
+
+
+def write_chunks(output_name, chunks, **kwargs):
+    with ExportWriter(output_name=output_name, **kwargs) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    return writer
+
+
+def read_netcdf(output_name, columns):
+    netCDF4 = pytest.importorskip("netCDF4")
+    with netCDF4.Dataset(output_name) as ds:
+        ds.set_auto_mask(False)
+        df = pd.DataFrame(OrderedDict(
+            (colname, ds.variables[get_netcdf_var_name(colname)][:])
+            for colname in columns))
+        units = dict(
+            (colname, getattr(ds.variables[get_netcdf_var_name(colname)],
+                              "units", None))
+            for colname in columns)
+        chunking = ds.variables["E0_frac"].chunking()
+        conventions = ds.Conventions
+    return df, units, chunking, conventions
+
+
+@pytest.mark.parametrize("extension", [".parquet", ".feather"])
+def test_arrow_round_trip(tmp_path, extension):
+    pytest.importorskip("pyarrow")
+    output_name = str(tmp_path/("out"+extension))
+    chunks = [make_export_df(0, 5), make_export_df(5, 1),
+              make_export_df(6, 4)]
+    writer = write_chunks(output_name, chunks, chunk_size=3)
+    assert writer.num_rows == 10
+
+    expected = pd.concat(chunks, ignore_index=True)
+    read = (pd.read_parquet if extension==".parquet"
+            else pd.read_feather)(output_name)
+    assert list(read.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(read, expected, check_dtype=False)
+
+
+def test_arrow_uncompressed(tmp_path):
+    pytest.importorskip("pyarrow")
+    output_name = str(tmp_path/"out.feather")
+    write_chunks(output_name, [make_export_df(0, 3)], compression=None)
+    pd.testing.assert_frame_equal(pd.read_feather(output_name),
+                                  make_export_df(0, 3), check_dtype=False)
+
+
+def test_parquet_cannot_append(tmp_path):
+    with pytest.raises(AssertionError):
+        ExportWriter(output_name=str(tmp_path/"out.parquet"), append=True)
+
+
+def test_netcdf_round_trip_and_append(tmp_path):
+    pytest.importorskip("netCDF4")
+    output_name = str(tmp_path/"out.nc")
+    #a one-row first chunk shouldn't set the chunk length of the file
+    write_chunks(output_name, [make_export_df(0, 1), make_export_df(1, 6)])
+    write_chunks(output_name, [make_export_df(7, 3)], append=True)
+
+    expected = make_export_df(0, 10)
+    read, units, chunking, conventions = read_netcdf(output_name,
+                                                     expected.columns)
+    assert conventions == "CF-1.8"
+    assert chunking == [NETCDF_DEFAULT_CHUNK_SIZE]
+    assert units["E0_frac"] == "1" and units["E1_frac"] == "1"
+    assert units["time"] == "seconds since 1970-01-01 00:00:00"
+    assert list(read["station"]) == list(expected["station"])
+    np.testing.assert_array_equal(read["depth"], expected["depth"])
+    np.testing.assert_array_equal(read["is_surface"],
+                                  expected["is_surface"].astype(np.int8))
+    np.testing.assert_array_equal(
+        read["time"], (expected["time"]-pd.Timestamp("1970-01-01"))
+                       /pd.Timedelta(seconds=1))
+    for colname in ["oxygen/resid", "E0_frac", "E1_frac"]:
+        np.testing.assert_array_equal(read[colname], expected[colname])
+
+
+def test_netcdf_chunk_size(tmp_path):
+    pytest.importorskip("netCDF4")
+    output_name = str(tmp_path/"out.nc")
+    write_chunks(output_name, [make_export_df(0, 4)], chunk_size=2)
+    assert read_netcdf(output_name, ["E0_frac"])[2] == [2]
+
+
+def test_csv_matches_pandas(tmp_path):
+    output_name = str(tmp_path/"out.csv")
+    chunks = [make_export_df(0, 2), make_export_df(2, 3)]
+    write_chunks(output_name, chunks[:1])
+    write_chunks(output_name, chunks[1:], append=True)
+    expected_name = str(tmp_path/"expected.csv")
+    pd.concat(chunks).to_csv(expected_name, index=False)
+    with open(output_name) as f, open(expected_name) as expected_f:
+        assert f.read() == expected_f.read()
+
+
+def test_mismatched_columns(tmp_path):
+    with ExportWriter(output_name=str(tmp_path/"out.csv")) as writer:
+        writer.write(make_export_df(0, 2))
+        with pytest.raises(AssertionError):
+            writer.write(make_export_df(2, 2).drop(columns=["depth"]))
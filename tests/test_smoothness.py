@@ -0,0 +1,24 @@
+from __future__ import division, print_function
+import numpy as np
+from pyompa import OMPAProblem
+from test_engines import make_problem
+
+
+def test_single_observation_along_track():
+    #a one-observation chain has no neighbours, so the along-track
+    # smoothness penalty shouldn't change its solution
+    ompa_problem, endmember_df = make_problem(with_conversion=True,
+                                              with_penalty=False)
+    obs_df = ompa_problem.obs_df.iloc[:1].copy()
+    obs_df["time"] = 0.0
+    solns = [OMPAProblem(obs_df=obs_df,
+                 param_names=ompa_problem.param_names,
+                 convertedparam_groups=ompa_problem.convertedparam_groups,
+                 param_weightings=ompa_problem.param_weightings,
+                 **kwargs).solve(endmember_df=endmember_df,
+                                 endmember_name_column="name",
+                                 engine="native")
+             for kwargs in [{}, {"smoothness_lambda": 1000.0,
+                                 "smoothness_time_column": "time"}]]
+    np.testing.assert_allclose(solns[1].endmember_fractions,
+                               solns[0].endmember_fractions, atol=1e-4)